@@ -4,9 +4,17 @@ servers and convert them to geoparquet files containing nested
 set index information.
 """
 
+from typing import Callable
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import json
+import os
 
 import pyogrio
+import pyarrow as pa
+import pandas as pd
 import geopandas as gpd
 from collections import Counter
 import re
@@ -14,18 +22,44 @@ import re
 import global_hydrography as gh
 from global_hydrography.delineation.mnsi import MNSI_FIELDS
 from global_hydrography.preprocess import TDXPreprocessor
-from global_hydrography.process import compute_dissolve_groups, DISSOLVE_ROOT_ID, ELEMENT_COUNT
+from global_hydrography.process import (
+    create_dissolve_groups_pyramid,
+    DISSOLVE_LEVELS,
+    DISSOLVE_ROOT_ID,
+    ELEMENT_COUNT,
+)
+from global_hydrography.delineation.mnsi import dissolve_root_field
+from global_hydrography.delineation.aggregate import UPSTREAM_FIELDS
 
 
 INPUT_DIR = Path("J:\MMW\TDX_HydroRaw")
 OUTPUT_DIR = Path("J:\MMW\TDX_MNSI_Output")
 
+# Parallel processing settings
+MANIFEST_FILENAME = "manifest.json"
+RAM_BUDGET = 64 * 2**30  # bytes available to all workers together
+MAX_WORKERS = 4
+MAX_RETRIES = 2
+# Peak memory of processing a region, per byte of its input GeoPackages
+MEMORY_PER_INPUT_BYTE = 6
+# Bytes of downloaded but not yet processed GeoPackages kept on disk
+DISK_BUDGET = 200 * 2**30
+TDX_DATASETS = ('basins', 'streamnet')
+# Stages cached by incremental processing, besides the '*_global_linkno' 
+# datasets and the MNSI and dissolve groups stages of `gh.incremental`
+PYRAMID_STAGE = 'dissolve_pyramid'
+OUTPUTS_STAGE = 'outputs'
+TILES_STAGE = 'tiles'
+
 #function pulled from example 4.
 def process_tdx_streams_basins(
     input_dir: Path,
     output_dir: Path,
     tdx_hydro_region: int, 
-    preprocessor:TDXPreprocessor
+    preprocessor:TDXPreprocessor,
+    delineation_layout: bool = False,
+    arrow_native: bool = False,
+    incremental: bool = False,
 ) -> list[Path]:
     """Process a pair of TDXHydro streamnet and streamreach_basins files for 
     a given TDX Hydro Region, creating a set of GeoParquet files ready for use 
@@ -39,19 +73,59 @@ def process_tdx_streams_basins(
     LINKNO as the index.
     - Moves MNSI fields from streament to basins datasets, saving a dataset of 
     streams that don't have a matching basin geometry.
-    - Saves three output datasets to GeoParquet files in the output directory.
+    - Dissolves basins into nested levels of pre-dissolved groups, for fast
+    watershed delineation.
+    - Saves four output datasets to GeoParquet files in the output directory.
 
     Parameters:
         input_dir: Directory with raw TDX Hydro GeoPackage ('.gpkg') files
         output_dir: Directory to save processed GeoParquet ('.parquet') files
         tdx_hydro_region: The 10-digit TDX Hydro Region
         preprocessor: An instance of the TDXPreprocessor class.
+        delineation_layout: If True, write outputs sorted by ROOT_ID and 
+            DISCOVER_TIME in small row groups, so upstream sets can be read 
+            without loading whole files. See `io.write_delineation_parquet`.
+        arrow_native: If True, keep geometries as WKB in pyarrow Tables and 
+            only convert attribute columns to pandas. Uses less memory, and 
+            basins rows keep their input order. 
+            See `process_tdx_streams_basins_arrow`.
+        incremental: If True, skip the region if its files and parameters 
+            are unchanged since it was last processed, and otherwise reuse 
+            the stages whose inputs are unchanged, from a cache in 
+            output_dir. See `incremental.StageCache`.
 
     Returns: a list of output file paths
         TDX_streamnet_*.parquet  
         TDX_streamreach_basins_mnsi_*.parquet  
         TDX_streams_no_basin_*.parquet  
+        TDX_dissolve_groups_*.parquet  
     """
+    cache = None
+    if incremental:
+        cache = gh.incremental.StageCache(
+            gh.incremental.cache_dir(output_dir, tdx_hydro_region)
+        )
+        outputs_key = _outputs_key(
+            cache, input_dir, tdx_hydro_region, delineation_layout, arrow_native,
+        )
+        outputs = cache.outputs(OUTPUTS_STAGE, outputs_key)
+        if outputs is not None:
+            print(f"TDXHydroRegion = {tdx_hydro_region} is up to date")
+            return outputs
+
+    if arrow_native:
+        parquet_paths = process_tdx_streams_basins_arrow(
+            input_dir,
+            output_dir,
+            tdx_hydro_region,
+            preprocessor,
+            delineation_layout=delineation_layout,
+            cache=cache,
+        )
+        if cache is not None:
+            cache.record(OUTPUTS_STAGE, outputs_key, parquet_paths)
+        return parquet_paths
+
     # Get file paths
     print (f"Processing TDXHydroRegion = {tdx_hydro_region}")
     streamnet_file, basins_file = gh.process.select_tdx_files(
@@ -68,35 +142,17 @@ def process_tdx_streams_basins(
         f"last updated {streamnet_info['layer_metadata']['DBF_DATE_LAST_UPDATE']}"
     )
     
-    # open streamnet file as GeoDataFrame
-    streamnet_gdf = gpd.read_file(
-        streamnet_file, 
-        engine='pyogrio', 
-        layer=0, 
-        use_arrow=True,
+    # open streamnet file as GeoDataFrame, with globally unique linkno and 
+    # columns with no value dropped
+    streamnet_gdf = _read_global_linkno(
+        'streamnet', streamnet_file, tdx_hydro_region, preprocessor, cache,
     )
+    print(f"  Converted: global LINKNOs as "
+          f"{preprocessor.linkno_dtype(tdx_hydro_region)}")
 
-    # apply preprocessing to make linkno globally unique
-    preprocessor.tdx_to_global_linkno(streamnet_gdf, tdx_hydro_region)
-
-    # apply preprocessing to make drop columns with no value
-    preprocessor.tdx_drop_useless_columns(streamnet_gdf)
-
-    # compute the modified nested set index, no copy
-    print('  Computing: modified nested set index')
-    streamnet_gdf = gh.mnsi.modified_nest_set_index(streamnet_gdf)
-
-    # Set 'LINKNO' as index, to facilitate selection
-    streamnet_gdf.set_index('LINKNO', inplace=True)
-    # streamnet_gdf.sort_index(inplace=True) # larger files without speedup!
-
-    # Compute predissolve group, no copy
-    print('  Computing: dissolve groups')
-    streamnet_gdf = compute_dissolve_groups(
-        streamnet_gdf, 
-        max_elements=200, 
-        min_elements=125,
-    )
+    # compute the modified nested set index and nested predissolve groups, 
+    # with 'LINKNO' as index to facilitate selection, no copy
+    streamnet_gdf = _streamnet_mnsi(streamnet_gdf, cache)
 
 
     ## Process basins file ##
@@ -104,51 +160,430 @@ def process_tdx_streams_basins(
     basins_info = pyogrio.read_info(basins_file, layer=0)
     print(f"  Reading: layer = {basins_info['layer_name']}")
 
-    # open basins file as GeoDataFrame
-    basins_gdf = gpd.read_file(
-        basins_file, 
-        engine='pyogrio', 
-        layer=0, 
-        use_arrow=True,
-    )
-    # Rename 'streamID' to 'LINKNO' and in32 to facilitate interoperability 
-    # with streamnet files
-    basins_gdf.rename(columns={'streamID':'LINKNO'}, inplace=True)
-    basins_gdf['LINKNO'] = basins_gdf['LINKNO'].astype('int32')
-    
-    # apply preprocessing to make linkno globally unique
-    preprocessor.tdx_to_global_linkno(basins_gdf, tdx_hydro_region)
+    # open basins file as GeoDataFrame, with 'streamID' renamed to 'LINKNO' 
+    # to facilitate interoperability with streamnet files, and linkno made 
+    # globally unique, with the same dtype as streamnet LINKNOs
+    basins_gdf = _read_global_linkno(
+        'basins', basins_file, tdx_hydro_region, preprocessor, cache,
+    )
 
     # Set 'LINKNO' as index, to facilitate selection
     basins_gdf.set_index('LINKNO', inplace=True)
     # basins_gdf.sort_index(inplace=True) # larger files without speedup!
 
+
+    ## Sum drainage area and stream length upstream of each reach ##
+    _add_upstream_aggregates(streamnet_gdf, basins_gdf.geometry)
+
     
-    ## Move MNSI fields from streamnet to basins ##
-    fields_to_copy = [*MNSI_FIELDS, ELEMENT_COUNT, DISSOLVE_ROOT_ID]
-    print(f"  Moving MNSI files from streamnet to basins datasets.")
-    # Move fields, no copy 
-    basins_gdf, streams_no_basin_gdf = gh.process.create_basins_mnsi(
-        basins_gdf,
-        streamnet_gdf,
-        fields_to_copy=fields_to_copy
-    )
+    ## Move MNSI fields from streamnet to basins, no copy ##
+    basins_gdf, match = _join_basins_mnsi(basins_gdf, streamnet_gdf)
+    streams_no_basin_gdf = streamnet_gdf.iloc[match.streams_no_basin]
     # Drop MNSI fields from streamnet_gdf
     #we now wish to retain this information
     #streamnet_gdf.drop(columns=gh.mnsi.MNSI_FIELDS, inplace=True)
 
+    ## Dissolve basins into nested groups ##
+    dissolve_groups_gdf = _dissolve_groups_pyramid(
+        cache, basins_file, basins_gdf, streamnet_gdf,
+    )
+
 
     ## Write GeoParquet files ##
     gdf_dict = {
         'streamnet_mnsi': streamnet_gdf,
         'streamreach_basins_mnsi': basins_gdf,
         'streams_no_basin': streams_no_basin_gdf,
+        'dissolve_groups': dissolve_groups_gdf,
     }
     parquet_paths = []
     for dataset, gdf in gdf_dict.items():
         path = output_dir / f"TDX_{dataset}_{tdx_hydro_region}_01.parquet"
         parquet_paths.append(path)
-        gdf.to_parquet(path, compression='zstd')
+        _write_gdf(dataset, gdf, path, delineation_layout)
+
+    if cache is not None:
+        cache.record(OUTPUTS_STAGE, outputs_key, parquet_paths)
+    return parquet_paths
+
+def process_tdx_streams_basins_arrow(
+    input_dir: Path,
+    output_dir: Path,
+    tdx_hydro_region: int, 
+    preprocessor:TDXPreprocessor,
+    delineation_layout: bool = False,
+    cache: gh.incremental.StageCache | None = None,
+) -> list[Path]:
+    """Arrow-native version of `process_tdx_streams_basins`, with the same 
+    outputs.
+
+    Files are read with `pyogrio.read_arrow`, keeping geometries as WKB 
+    buffers. Only attribute columns are converted to pandas for the LINKNO 
+    conversion, MNSI, dissolve grouping and the basins join, and geometries 
+    are passed to the parquet writer without being decoded or copied, 
+    except where rows are dropped. Basins geometries are only decoded to 
+    dissolve the groups pyramid.
+
+    With a cache, the MNSI, dissolve groups and pyramid stages are reused as
+    in `process_tdx_streams_basins`, but raw files are always read.
+    """
+    print (f"Processing TDXHydroRegion = {tdx_hydro_region} (arrow)")
+    streamnet_file, basins_file = gh.process.select_tdx_files(
+        input_dir, 
+        tdx_hydro_region,
+        '.gpkg'
+    )
+
+    ## Process streamnet file ##
+    with gh.instrument.stage('read streamnet') as stage:
+        streamnet_meta, streamnet_table = pyogrio.read_arrow(streamnet_file, layer=0)
+        stage.rows = streamnet_table.num_rows
+    print(f"  Reading: {streamnet_file.name}")
+    streamnet_geometry, streamnet_df = _split_geometry(streamnet_meta, streamnet_table)
+    del streamnet_table
+
+    _to_global_linkno('streamnet', streamnet_df, tdx_hydro_region, preprocessor)
+    streamnet_df = _streamnet_mnsi(streamnet_df, cache)
+
+    ## Process basins file ##
+    with gh.instrument.stage('read basins') as stage:
+        basins_meta, basins_table = pyogrio.read_arrow(basins_file, layer=0)
+        stage.rows = basins_table.num_rows
+    print(f"  Reading: {basins_file.name}")
+    basins_geometry, basins_df = _split_geometry(basins_meta, basins_table)
+    del basins_table
+
+    _to_global_linkno('basins', basins_df, tdx_hydro_region, preprocessor)
+    basins_df.set_index('LINKNO', inplace=True)
+    # geometry follows the basins attributes and precedes the MNSI fields
+    basins_geometry_position = len(basins_df.columns)
+    # decoded once, for basin areas and the dissolve groups pyramid
+    basins_geoseries = gpd.GeoSeries.from_wkb(
+        basins_geometry.to_numpy(zero_copy_only=False), 
+        index=basins_df.index,
+        crs=basins_meta['crs'],
+    )
+
+    _add_upstream_aggregates(streamnet_df, basins_geoseries)
+
+    ## Move MNSI fields from streamnet to basins ##
+    basins_df, match = _join_basins_mnsi(basins_df, streamnet_df)
+    # geometries follow the basins kept, which have a stream
+    if len(match.basins_no_stream):
+        basins_geometry = basins_geometry.take(pa.array(match.basins))
+        basins_geoseries = basins_geoseries.iloc[match.basins]
+
+    streams_no_basin_df = streamnet_df.iloc[match.streams_no_basin]
+    streams_no_basin_geometry = streamnet_geometry.take(
+        pa.array(match.streams_no_basin)
+    )
+
+    ## Dissolve basins into nested groups ##
+    basins_gdf = gpd.GeoDataFrame(
+        basins_df[[dissolve_root_field(level) for level in range(len(DISSOLVE_LEVELS))]],
+        geometry=basins_geoseries,
+    )
+    del basins_geoseries
+    dissolve_groups_gdf = _dissolve_groups_pyramid(
+        cache, basins_file, basins_gdf, streamnet_df,
+    )
+    del basins_gdf
+
+    ## Write GeoParquet files ##
+    table_dict = {
+        'streamnet_mnsi': (streamnet_df, streamnet_geometry, streamnet_meta, None),
+        'streamreach_basins_mnsi': (
+            basins_df, basins_geometry, basins_meta, basins_geometry_position,
+        ),
+        'streams_no_basin': (
+            streams_no_basin_df, streams_no_basin_geometry, streamnet_meta, None,
+        ),
+    }
+    parquet_paths = []
+    for dataset, (df, geometry, meta, position) in table_dict.items():
+        path = output_dir / f"TDX_{dataset}_{tdx_hydro_region}_01.parquet"
+        parquet_paths.append(path)
+        with gh.instrument.stage(f'write {dataset}', rows=len(df)):
+            # geometry types and bbox of the rows kept, as `to_parquet` writes
+            bbox, geometry_types = gh.io.geometry_summary(geometry)
+            table = gh.io.geoparquet_table(
+                df, geometry, meta['crs'], geometry_types, bbox=bbox,
+                geometry_position=position,
+            )
+            gh.io.write_geoparquet_table(table, path, delineation_layout)
+        print(f'  File saved: {path.name}')
+
+    path = output_dir / f"TDX_dissolve_groups_{tdx_hydro_region}_01.parquet"
+    parquet_paths.append(path)
+    _write_gdf('dissolve_groups', dissolve_groups_gdf, path, delineation_layout)
+
+    return parquet_paths
+
+
+def create_tdx_tiles(
+    output_dir: Path,
+    tdx_hydro_region: int,
+    zoom_bands: tuple = gh.tiles.TILE_ZOOM_BANDS,
+    incremental: bool = False,
+) -> Path:
+    """Write zoom dependent, generalized streams and basins of a processed 
+    region as vector tiles, from the GeoParquet files written by 
+    `process_tdx_streams_basins`. See `tiles.create_tiles`.
+
+    If incremental, tiles are not written again while the region's outputs 
+    and the zoom bands are unchanged.
+
+    Returns: The path of the MBTiles file.
+    """
+    path = output_dir / f"TDX_tiles_{tdx_hydro_region}_01.mbtiles"
+    if incremental:
+        cache = gh.incremental.StageCache(
+            gh.incremental.cache_dir(output_dir, tdx_hydro_region)
+        )
+        key = gh.incremental.hash_key(
+            TILES_STAGE, cache.key(OUTPUTS_STAGE), zoom_bands,
+        )
+        if cache.outputs(TILES_STAGE, key) is not None:
+            print(f"Tiles for TDXHydroRegion = {tdx_hydro_region} are up to date")
+            return path
+
+    print(f"Creating tiles for TDXHydroRegion = {tdx_hydro_region}")
+    gdfs = {
+        dataset: gpd.read_parquet(
+            output_dir / f"TDX_{dataset}_{tdx_hydro_region}_01.parquet"
+        )
+        for dataset in ('streamnet_mnsi', 'streamreach_basins_mnsi', 'dissolve_groups')
+    }
+    gh.tiles.create_tiles(*gdfs.values(), path, zoom_bands)
+    print(f'  File saved: {path.name}')
+    if incremental:
+        cache.record(TILES_STAGE, key, [path])
+    return path
+
+
+def _read_global_linkno(
+    dataset: str,
+    file: Path,
+    tdx_hydro_region: int,
+    preprocessor: TDXPreprocessor,
+    cache: gh.incremental.StageCache | None = None,
+) -> gpd.GeoDataFrame:
+    """Read a raw TDX Hydro 'streamnet' or 'basins' GeoPackage, with 
+    globally unique LINKNOs. Basins 'streamID' is renamed to 'LINKNO', and 
+    useless streamnet columns are dropped.
+
+    With a cache, the converted dataset is cached as GeoParquet, and read 
+    from the cache while the file is unchanged.
+    """
+    def read() -> gpd.GeoDataFrame:
+        with gh.instrument.stage(f'read {dataset}') as stage:
+            gdf = gpd.read_file(
+                file, 
+                engine='pyogrio', 
+                layer=0, 
+                use_arrow=True,
+            )
+            stage.rows = len(gdf)
+        _to_global_linkno(dataset, gdf, tdx_hydro_region, preprocessor)
+        return gdf
+
+    if cache is None:
+        return read()
+    stage = f'{dataset}_global_linkno'
+    key = gh.incremental.hash_key(
+        stage, 
+        cache.file_key(file), 
+        tdx_hydro_region, 
+        preprocessor.linkno_dtype(tdx_hydro_region),
+    )
+    return cache.cached(stage, key, read)
+
+
+def _to_global_linkno(
+    dataset: str,
+    df: pd.DataFrame,
+    tdx_hydro_region: int,
+    preprocessor: TDXPreprocessor,
+) -> None:
+    """Convert a raw TDX Hydro 'streamnet' or 'basins' (Geo)DataFrame to 
+    globally unique LINKNOs, in place. Basins 'streamID' is renamed to 
+    'LINKNO', and useless streamnet columns are dropped."""
+    if dataset == 'basins':
+        df.rename(columns={'streamID':'LINKNO'}, inplace=True)
+    preprocessor.tdx_to_global_linkno(df, tdx_hydro_region)
+    if dataset == 'streamnet':
+        preprocessor.tdx_drop_useless_columns(df)
+
+
+def _streamnet_mnsi(
+    streamnet_df: pd.DataFrame,
+    cache: gh.incremental.StageCache | None,
+) -> pd.DataFrame:
+    """Add the MNSI fields and nested dissolve groups to streamnet, with 
+    'LINKNO' set as the index, reusing cached stages while unchanged."""
+    print('  Computing: modified nested set index')
+    streamnet_df = gh.incremental.cached_nested_set_index(streamnet_df, cache)
+    streamnet_df.set_index('LINKNO', inplace=True)
+    # streamnet_df.sort_index(inplace=True) # larger files without speedup!
+    # (when whole files are read; see `delineation_layout` for selective reads)
+
+    print('  Computing: dissolve groups')
+    return gh.incremental.cached_nested_dissolve_groups(
+        streamnet_df, 
+        cache,
+        dissolve_levels=DISSOLVE_LEVELS,
+    )
+
+
+def _add_upstream_aggregates(
+    streamnet_df: pd.DataFrame,
+    basins_geometry: gpd.GeoSeries,
+) -> None:
+    """Add the drainage area and stream length upstream of each reach to 
+    streamnet, from basins geometries indexed by LINKNO."""
+    print('  Computing: upstream drainage area and length')
+    gh.aggregate.add_upstream_aggregates(
+        streamnet_df,
+        pd.Series(gh.aggregate.basin_areas(basins_geometry), index=basins_geometry.index),
+    )
+
+
+def _join_basins_mnsi(
+    basins_df: pd.DataFrame,
+    streamnet_df: pd.DataFrame,
+) -> tuple[pd.DataFrame, gh.process.LinkMatch]:
+    """Copy the MNSI, dissolve groups and upstream fields from streamnet to 
+    basins. See `process.join_basins_mnsi`."""
+    fields_to_copy = [
+        *MNSI_FIELDS, 
+        ELEMENT_COUNT, 
+        *[dissolve_root_field(level) for level in range(len(DISSOLVE_LEVELS))],
+        *[field for field in UPSTREAM_FIELDS if field in streamnet_df.columns],
+    ]
+    print(f"  Moving MNSI files from streamnet to basins datasets.")
+    return gh.process.join_basins_mnsi(basins_df, streamnet_df, fields_to_copy)
+
+
+def _dissolve_groups_pyramid(
+    cache: gh.incremental.StageCache | None,
+    basins_file: Path,
+    basins_gdf: gpd.GeoDataFrame,
+    streamnet_df: pd.DataFrame,
+) -> gpd.GeoDataFrame:
+    """Dissolve basins into the nested dissolve groups pyramid. basins_gdf 
+    needs only its geometry and dissolve root fields."""
+    print(f"  Computing: dissolve groups pyramid")
+    return _cached_pyramid(
+        cache,
+        basins_file,
+        lambda: create_dissolve_groups_pyramid(
+            basins_gdf,
+            streamnet_df,
+            n_levels=len(DISSOLVE_LEVELS),
+        ),
+    )
+
+
+def _write_gdf(
+    dataset: str,
+    gdf: gpd.GeoDataFrame,
+    path: Path,
+    delineation_layout: bool,
+) -> None:
+    """Write a processed dataset's GeoDataFrame to GeoParquet"""
+    with gh.instrument.stage(f'write {dataset}', rows=len(gdf)):
+        if delineation_layout:
+            gh.io.write_delineation_parquet(gdf, path)
+        else:
+            gdf.to_parquet(path, compression='zstd')
+    print(f'  File saved: {path.name}')
+
+
+def _cached_pyramid(
+    cache: gh.incremental.StageCache | None,
+    basins_file: Path,
+    compute: Callable[[], gpd.GeoDataFrame],
+) -> gpd.GeoDataFrame:
+    """The dissolve groups pyramid from compute, reused while the basins 
+    file and the dissolve groups are unchanged"""
+    if cache is None:
+        return compute()
+    key = gh.incremental.hash_key(
+        PYRAMID_STAGE, 
+        cache.file_key(basins_file), 
+        cache.key(gh.incremental.DISSOLVE_STAGE),
+    )
+    return cache.cached(PYRAMID_STAGE, key, compute)
+
+
+def _outputs_key(
+    cache: gh.incremental.StageCache,
+    input_dir: Path,
+    tdx_hydro_region: int,
+    delineation_layout: bool,
+    arrow_native: bool,
+) -> str:
+    """Key of a region's output files, from its input files and the 
+    processing parameters"""
+    return gh.incremental.hash_key(
+        OUTPUTS_STAGE,
+        [
+            cache.file_key(file) 
+            for file in gh.process.select_tdx_files(
+                input_dir, tdx_hydro_region, '.gpkg',
+            )
+        ],
+        DISSOLVE_LEVELS,
+        delineation_layout,
+        arrow_native,
+    )
+
+
+def _split_geometry(meta: dict, table: pa.Table) -> tuple:
+    """Split a table from `pyogrio.read_arrow` into its WKB geometry column 
+    and a DataFrame of the other columns."""
+    geometry_name = meta['geometry_name'] or 'wkb_geometry'
+    return (
+        table.column(geometry_name),
+        table.drop_columns([geometry_name]).to_pandas(),
+    )
+
+
+def convert_tdx_region_to_parquet(
+    input_dir: Path,
+    output_dir: Path,
+    tdx_hydro_region: int, 
+    preprocessor:TDXPreprocessor,
+    batch_size: int = gh.io.STREAMING_BATCH_SIZE,
+) -> list[Path]:
+    """Stream a region's raw streamnet and basins GeoPackages to GeoParquet 
+    with globally unique LINKNOs and useless columns dropped, in bounded 
+    memory. See `io.stream_gpkg_to_parquet`.
+
+    Returns: a list of output file paths
+        TDX_streamnet_*.parquet  
+        TDX_streamreach_basins_*.parquet  
+    """
+    streamnet_file, basins_file = gh.process.select_tdx_files(
+        input_dir, 
+        tdx_hydro_region,
+        '.gpkg'
+    )
+    parquet_paths = []
+    for dataset, file, rename in (
+        ('streamnet', streamnet_file, None),
+        ('streamreach_basins', basins_file, {'streamID': 'LINKNO'}),
+    ):
+        path = output_dir / f"TDX_{dataset}_{tdx_hydro_region}_01.parquet"
+        gh.io.stream_gpkg_to_parquet(
+            file, 
+            path, 
+            tdx_hydro_region, 
+            preprocessor, 
+            rename=rename, 
+            batch_size=batch_size,
+        )
+        parquet_paths.append(path)
         print(f'  File saved: {path.name}')
 
     return parquet_paths
@@ -167,19 +602,358 @@ def get_tdx_regions(input_dir:Path) -> list[int]:
     return tdx_regions.keys()
 
 
+def load_manifest(output_dir: Path) -> dict[str, dict]:
+    """Read the manifest of processed regions from the output directory,
+    keyed by region code as a string."""
+    manifest_path = output_dir / MANIFEST_FILENAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir: Path, manifest: dict[str, dict]) -> None:
+    """Write the manifest of processed regions, replacing the previous one
+    atomically so a crash never leaves a partial manifest."""
+    manifest_path = output_dir / MANIFEST_FILENAME
+    temp_path = manifest_path.with_suffix('.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def is_region_done(manifest: dict[str, dict], tdx_hydro_region: int) -> bool:
+    """True if the manifest records the region as done and its outputs exist"""
+    entry = manifest.get(str(tdx_hydro_region), {})
+    return (
+        entry.get('status') == 'done'
+        and all(Path(path).exists() for path in entry.get('outputs', []))
+    )
+
+
+def estimate_region_memory(input_dir: Path, tdx_hydro_region: int) -> int:
+    """Estimate peak bytes used to process a region from its input file sizes"""
+    input_bytes = sum(
+        path.stat().st_size
+        for path in gh.process.select_tdx_files(input_dir, tdx_hydro_region, '.gpkg')
+    )
+    return input_bytes * MEMORY_PER_INPUT_BYTE
+
+
+def _process_region(
+    input_dir: Path,
+    output_dir: Path,
+    tdx_hydro_region: int,
+    delineation_layout: bool,
+    tiles: bool = False,
+    incremental: bool = False,
+) -> list[str]:
+    """Process one region in a worker process, with its own preprocessor.
+
+    If instrumentation is enabled, e.g. with the GLOBAL_HYDROGRAPHY_METRICS
+    environment variable, the metrics of each stage are saved to output_dir.
+    """
+    with gh.instrument.collect(
+        metrics_path(output_dir, tdx_hydro_region),
+        tdx_hydro_region=tdx_hydro_region,
+    ):
+        paths = process_tdx_streams_basins(
+            input_dir=input_dir,
+            output_dir=output_dir,
+            tdx_hydro_region=tdx_hydro_region,
+            preprocessor=TDXPreprocessor(),
+            delineation_layout=delineation_layout,
+            incremental=incremental,
+        )
+        if tiles:
+            paths.append(create_tdx_tiles(
+                output_dir, tdx_hydro_region, incremental=incremental,
+            ))
+    return [str(path) for path in paths]
+
+
+def metrics_path(output_dir: Path, tdx_hydro_region: int) -> Path:
+    """Path of a region's instrumentation metrics JSON"""
+    return Path(output_dir) / f"TDX_metrics_{tdx_hydro_region}_01.json"
+
+
+def process_regions(
+    regions: list[int],
+    input_dir: Path,
+    output_dir: Path,
+    ram_budget: int = RAM_BUDGET,
+    max_workers: int = MAX_WORKERS,
+    max_retries: int = MAX_RETRIES,
+    delineation_layout: bool = False,
+    tiles: bool = False,
+    incremental: bool = False,
+) -> dict[str, dict]:
+    """Process many regions in parallel, resuming from the output manifest.
+
+    Regions recorded as done in the manifest (with all outputs present) are
+    skipped, unless incremental. The rest are started largest first, as long as the estimated 
+    memory of all running regions stays within ram_budget, so several huge 
+    regions never run at the same time. A region larger than the whole 
+    budget runs alone. Failed regions are retried up to max_retries times.
+    The manifest is saved after every region finishes.
+
+    If a worker dies, e.g. killed for running out of memory, the pool is
+    broken and every running region fails with it. The pool is recreated,
+    and those regions are retried alone, so only the region that kills its
+    worker uses up its retries.
+
+    Parameters:
+        regions: 10-digit TDX Hydro Regions to process.
+        input_dir: Directory with raw TDX Hydro GeoPackage ('.gpkg') files
+        output_dir: Directory to save processed GeoParquet ('.parquet') files
+            and the manifest.
+        ram_budget: Bytes of memory available to all workers together.
+        max_workers: Maximum number of regions processed at once.
+        max_retries: Times to retry a region after it fails.
+        delineation_layout: See `process_tdx_streams_basins`.
+        tiles: If True, also write vector tiles. See `create_tdx_tiles`.
+        incremental: If True, check every region for changed input files, 
+            including those already done, and only recompute the stages 
+            of each region whose inputs changed. See 
+            `process_tdx_streams_basins`.
+
+    Returns: The manifest, keyed by region, with 'status' ('done' or 
+        'failed'), 'attempts', and 'outputs' or 'error'.
+    """
+    manifest = load_manifest(output_dir)
+    pending = [
+        region for region in regions 
+        if incremental or not is_region_done(manifest, region)
+    ]
+    print(f"{len(regions) - len(pending)} regions already done, "
+          f"{len(pending)} to process")
+    estimates = {region: estimate_region_memory(input_dir, region) for region in pending}
+    pending.sort(key=estimates.get, reverse=True)
+    attempts = Counter()
+    # regions running when the pool broke, which are retried alone
+    suspects = set()
+
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            # start every pending region that fits in the remaining budget
+            for region in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if running and (
+                    region in suspects 
+                    or not suspects.isdisjoint(running.values())
+                ):
+                    continue
+                running_memory = sum(estimates[r] for r in running.values())
+                if running and running_memory + estimates[region] > ram_budget:
+                    continue
+                pending.remove(region)
+                attempts[region] += 1
+                print(f'start {region}, attempt {attempts[region]}, '
+                      f'estimated {estimates[region] / 2**30:.1f} GiB')
+                future = executor.submit(
+                    _process_region, input_dir, output_dir, region, 
+                    delineation_layout, tiles, incremental,
+                )
+                running[future] = region
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = any(
+                isinstance(future.exception(), BrokenProcessPool) 
+                for future in finished
+            )
+            if broken:
+                # every running region fails with the pool, so collect them all
+                finished, _ = wait(running)
+                crashed = [
+                    running[future] for future in finished 
+                    if isinstance(future.exception(), BrokenProcessPool)
+                ]
+                print(f'Process pool broke while running {crashed}, restarting it')
+                if len(crashed) > 1:
+                    # any of them may have killed the pool, so don't count 
+                    # the attempt until each has run alone
+                    for region in crashed:
+                        attempts[region] -= 1
+                suspects.update(crashed)
+
+            for future in finished:
+                region = running.pop(future)
+                entry = {'attempts': attempts[region]}
+                try:
+                    entry.update(status='done', outputs=future.result())
+                    print(f'finish {region}')
+                except Exception as e:
+                    entry.update(status='failed', error=repr(e))
+                    print(f'ERROR for {region}: {e!r}')
+                    if attempts[region] <= max_retries:
+                        pending.append(region)
+                manifest[str(region)] = entry
+                save_manifest(output_dir, manifest)
+
+            if broken:
+                executor.shutdown(wait=True)
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+    finally:
+        executor.shutdown(wait=True)
+
+    return manifest
+
+
+class DiskBudget:
+    """Asyncio counter of bytes on disk, where reserving waits until enough
+    bytes are released. A reservation larger than the whole budget is 
+    granted once nothing else is reserved, so it never waits forever."""
+
+    def __init__(self, budget: int) -> None:
+        self.__budget = budget
+        self.__reserved = 0
+        self.__condition = asyncio.Condition()
+
+    @property
+    def reserved(self) -> int:
+        return self.__reserved
+
+    async def reserve(self, n_bytes: int) -> None:
+        async with self.__condition:
+            await self.__condition.wait_for(
+                lambda: not self.__reserved 
+                or self.__reserved + n_bytes <= self.__budget
+            )
+            self.__reserved += n_bytes
+
+    async def release(self, n_bytes: int) -> None:
+        async with self.__condition:
+            self.__reserved -= n_bytes
+            self.__condition.notify_all()
+
+
+async def download_and_process_regions(
+    regions: list[int],
+    download_dir: Path,
+    output_dir: Path,
+    disk_budget: int = DISK_BUDGET,
+    max_workers: int = MAX_WORKERS,
+    delineation_layout: bool = False,
+    delete_downloads: bool = False,
+    tiles: bool = False,
+    incremental: bool = False,
+) -> dict[str, dict]:
+    """Download regions and process each one as soon as both of its files 
+    have landed, instead of waiting for every download to finish.
+
+    Downloads of all regions run concurrently, throttled by the downloader's 
+    connection limit. Before a region is downloaded, the remote size of its 
+    files is reserved from disk_budget, and it is released once the region 
+    is processed (or failed), so downloaded but unprocessed files never 
+    exceed the budget. A region whose download fails is recorded as 
+    failed without stopping the others. Completed (streamnet, basins) pairs are put on a 
+    queue, and max_workers consumers process them in a process pool. 
+    Regions already done in the manifest are skipped, and the manifest is 
+    saved after every region finishes, as in `process_regions`.
+
+    Parameters:
+        regions: 10-digit TDX Hydro Regions to download and process.
+        download_dir: Directory to download raw TDX Hydro GeoPackages to.
+        output_dir: Directory to save processed GeoParquet ('.parquet') files
+            and the manifest.
+        disk_budget: Bytes of downloaded but unprocessed files allowed on disk.
+        max_workers: Maximum number of regions processed at once.
+        delineation_layout: See `process_tdx_streams_basins`.
+        delete_downloads: If True, delete a region's GeoPackages once it has
+            been processed successfully.
+        tiles: If True, also write vector tiles. See `create_tdx_tiles`.
+        incremental: See `process_regions`. Files already downloaded with 
+            their remote size are not downloaded again, so downloads should 
+            be kept rather than deleted.
+
+    Returns: The manifest, keyed by region, with 'status' ('done' or 
+        'failed'), 'attempts', and 'outputs' or 'error'.
+    """
+    manifest = load_manifest(output_dir)
+    pending = [
+        region for region in regions 
+        if incremental or not is_region_done(manifest, region)
+    ]
+    print(f"{len(regions) - len(pending)} regions already done, "
+          f"{len(pending)} to download and process")
+
+    budget = DiskBudget(disk_budget)
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    downloader = gh.io.TDXHydroDownloader(download_dir=download_dir)
+
+    def record(region: int, entry: dict) -> None:
+        entry['attempts'] = manifest.get(str(region), {}).get('attempts', 0) + 1
+        manifest[str(region)] = entry
+        save_manifest(output_dir, manifest)
+
+    async def produce(region: int) -> None:
+        reserved = 0
+        try:
+            size = await downloader.get_download_size(region, TDX_DATASETS)
+            await budget.reserve(size)
+            reserved = size
+            results = await downloader.download_region(region, TDX_DATASETS)
+        except Exception as e:
+            record(region, {'status': 'failed', 'error': repr(e)})
+            print(f'ERROR downloading {region}: {e!r}')
+            await budget.release(reserved)
+            return
+        await queue.put((region, size, results))
+
+    async def consume(executor: ProcessPoolExecutor) -> None:
+        while True:
+            region, size, results = await queue.get()
+            try:
+                failed = [r['file'] for r in results if r['status'] == 'failed']
+                if failed:
+                    raise IOError(f"Failed to download {failed}")
+                print(f'start {region}, {budget.reserved / 2**30:.1f} GiB '
+                      f'of downloads waiting or processing')
+                outputs = await loop.run_in_executor(
+                    executor, _process_region, 
+                    downloader.download_dir, output_dir, region, 
+                    delineation_layout, tiles, incremental,
+                )
+                record(region, {'status': 'done', 'outputs': outputs})
+                print(f'finish {region}')
+                if delete_downloads:
+                    for result in results:
+                        result['path'].unlink(missing_ok=True)
+            except Exception as e:
+                record(region, {'status': 'failed', 'error': repr(e)})
+                print(f'ERROR for {region}: {e!r}')
+            finally:
+                await budget.release(size)
+                queue.task_done()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        async with downloader:
+            consumers = [
+                asyncio.create_task(consume(executor)) for _ in range(max_workers)
+            ]
+            try:
+                await asyncio.gather(*(produce(region) for region in pending))
+                await queue.join()
+            finally:
+                for consumer in consumers:
+                    consumer.cancel()
+                await asyncio.gather(*consumers, return_exceptions=True)
+
+    return manifest
+
+
 def main() -> None:
     #regions = get_tdx_regions(INPUT_DIR)
     regions = [4020024190]
-    preprocessor = TDXPreprocessor()
-    for region in regions:
-        print(f'start {region}')
-        process_tdx_streams_basins(
-            input_dir=INPUT_DIR,
-            output_dir=OUTPUT_DIR,
-            tdx_hydro_region=region,
-            preprocessor=preprocessor,
-        )
-        print(f'finish {region}')
+    process_regions(
+        regions,
+        input_dir=INPUT_DIR,
+        output_dir=OUTPUT_DIR,
+    )
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,4 @@
+'''
+Benchmarks of Global Hydrography processing and delineation, on synthetic
+TDX Hydro Regions. Run with `python -m benchmarks.run` from the `src` directory.
+'''
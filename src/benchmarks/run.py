@@ -0,0 +1,243 @@
+'''Benchmarks of Global Hydrography processing and delineation on synthetic
+TDX Hydro Regions, saving results as JSON so runs can be compared.
+
+Usage:
+    python -m benchmarks.run --sizes 10000 100000 1000000 --output results.json
+    python -m benchmarks.run --compare baseline.json results.json
+'''
+
+from typing import Any, Callable
+
+from pathlib import Path
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow
+
+from global_hydrography.delineation import mnsi
+from global_hydrography.delineation.mnsi import LINK, MNSIIndex
+from global_hydrography.delineation.delineate import (
+    subset_network,
+    get_linkno_by_latlon,
+    get_watershed_boundary,
+)
+from global_hydrography.process import compute_dissolve_groups, create_basins_mnsi
+from benchmarks.synthetic import synthetic_tdx_region
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_REPEAT = 3
+# Number of links or points sampled for per-call benchmarks
+DEFAULT_SAMPLES = 20
+# Ratio of median times above which a benchmark is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+def time_call(
+    func: Callable[[], Any],
+    repeat: int = DEFAULT_REPEAT,
+) -> list[float]:
+    """Wall times in seconds of repeated calls of func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_region(
+    n_reaches: int,
+    repeat: int = DEFAULT_REPEAT,
+    samples: int = DEFAULT_SAMPLES,
+    seed: int = 0,
+) -> list[dict]:
+    """Run every benchmark on a synthetic region of n_reaches.
+
+    Per-call benchmarks (subset_network, get_linkno_by_latlon and
+    get_watershed_boundary) time a loop over `samples` random links or
+    points, and also report the time per call.
+
+    Returns: A list of results, with benchmark, n_reaches, calls, times,
+        min, median and per_call (the median divided by calls).
+    """
+    results = []
+
+    def record(name: str, times: list[float], calls: int = 1, **extra) -> None:
+        median = statistics.median(times)
+        results.append({
+            'benchmark': name,
+            'n_reaches': n_reaches,
+            'calls': calls,
+            'times': times,
+            'min': min(times),
+            'median': median,
+            'per_call': median / calls,
+            **extra,
+        })
+        print(f"  {name:<32} {median:10.4f} s  ({median / calls:.6f} s/call)")
+
+    print(f"{n_reaches} reaches")
+    start = time.perf_counter()
+    streamnet_gdf, basins_gdf = synthetic_tdx_region(n_reaches, seed=seed)
+    record('generate_synthetic_region', [time.perf_counter() - start])
+
+    ## Processing ##
+    record('modified_nest_set_index', time_call(
+        lambda: mnsi.modified_nest_set_index(streamnet_gdf.copy(deep=False)),
+        repeat,
+    ))
+    streams_gdf = mnsi.modified_nest_set_index(streamnet_gdf).set_index(LINK)
+
+    record('compute_dissolve_groups', time_call(
+        lambda: compute_dissolve_groups(streams_gdf), repeat,
+    ))
+    streams_gdf = compute_dissolve_groups(streams_gdf)
+
+    basins_gdf = basins_gdf.rename(columns={'streamID': LINK}).set_index(LINK)
+    basins_gdf, _ = create_basins_mnsi(basins_gdf, streams_gdf)
+
+    ## Delineation ##
+    rng = np.random.default_rng(seed)
+    links = rng.choice(basins_gdf.index.to_numpy(), size=samples)
+
+    record('subset_network', time_call(
+        lambda: [subset_network(basins_gdf, link) for link in links], repeat,
+    ), samples)
+    index = MNSIIndex(basins_gdf)
+    record('subset_network_mnsi_index', time_call(
+        lambda: [subset_network(basins_gdf, link, index) for link in links], repeat,
+    ), samples)
+
+    # points inside random basins
+    points = shapely.point_on_surface(basins_gdf.geometry.loc[links].values)
+    lons, lats = shapely.get_x(points), shapely.get_y(points)
+    record('build_spatial_index', time_call(
+        lambda: shapely.STRtree(basins_gdf.geometry.values), repeat,
+    ))
+    basins_gdf.sindex  # built once, as by the first lookup
+    record('get_linkno_by_latlon', time_call(
+        lambda: [
+            get_linkno_by_latlon(basins_gdf, lat, lon) for lat, lon in zip(lats, lons)
+        ],
+        repeat,
+    ), samples)
+
+    upstream = [subset_network(basins_gdf, link, index) for link in links]
+    record('get_watershed_boundary', time_call(
+        lambda: [get_watershed_boundary(gdf) for gdf in upstream], repeat,
+    ), samples, mean_upstream_elements=float(np.mean([len(gdf) for gdf in upstream])))
+
+    ## Parquet round-trip ##
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir) / 'basins.parquet'
+        record('parquet_write', time_call(
+            lambda: basins_gdf.to_parquet(path, compression='zstd'), repeat,
+        ))
+        record('parquet_read', time_call(lambda: gpd.read_parquet(path), repeat))
+
+    return results
+
+
+def environment() -> dict:
+    """Versions and machine info, to tell apart runs in different environments"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'geopandas': gpd.__version__,
+        'shapely': shapely.__version__,
+        'pyarrow': pyarrow.__version__,
+    }
+
+
+def run_benchmarks(
+    sizes: tuple[int] = DEFAULT_SIZES,
+    repeat: int = DEFAULT_REPEAT,
+    samples: int = DEFAULT_SAMPLES,
+    output_path: Path | None = None,
+) -> dict:
+    """Run the benchmarks for each size and save the results as JSON.
+
+    Returns: A dict of 'environment' and 'results'.
+    """
+    run = {
+        'environment': environment(),
+        'results': [
+            result for n_reaches in sizes
+            for result in benchmark_region(n_reaches, repeat, samples)
+        ],
+    }
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Results saved: {output_path}")
+    return run
+
+
+def compare_results(
+    baseline_path: Path,
+    results_path: Path,
+    threshold: float = REGRESSION_THRESHOLD,
+) -> list[dict]:
+    """Compare the median times of two runs, printing each benchmark's ratio.
+
+    Returns: The benchmarks at least threshold times slower than baseline.
+    """
+    def load(path: Path) -> dict:
+        with open(path) as f:
+            return {
+                (r['benchmark'], r['n_reaches']): r for r in json.load(f)['results']
+            }
+
+    baseline, results = load(baseline_path), load(results_path)
+    regressions = []
+    for key in sorted(baseline.keys() & results.keys(), key=lambda k: (k[1], k[0])):
+        ratio = results[key]['median'] / max(baseline[key]['median'], 1e-12)
+        flag = 'REGRESSION' if ratio >= threshold else ''
+        print(f"{key[1]:>10} {key[0]:<32} {ratio:6.2f}x {flag}")
+        if flag:
+            regressions.append({'benchmark': key[0], 'n_reaches': key[1], 'ratio': ratio})
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument('--output', type=Path, default=Path('benchmark_results.json'))
+    parser.add_argument(
+        '--compare', type=Path, nargs=2, metavar=('BASELINE', 'RESULTS'),
+        help='compare two saved runs instead of running benchmarks',
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        run_benchmarks(args.sizes, args.repeat, args.samples, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''Synthetic TDX Hydro streamnet and basins datasets for benchmarking.
+
+Networks are forests of binary river trees grown from many roots. Reaches
+are laid out on a grid in depth-first order along a boustrophedon (snake)
+path, so every upstream set is a contiguous run of cells, and each basin is
+one non-overlapping grid cell, as TDX Hydro basins tile their region.
+'''
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from global_hydrography.delineation.mnsi import (
+    LINK, DS_LINK, US_LEFT, US_RIGHT, DISCOVER, ROOT,
+    modified_nest_set_index,
+)
+
+# Width and height of a basin cell, in degrees
+CELL_SIZE = 0.001
+
+
+def synthetic_network(
+    n_reaches: int,
+    n_roots: int = 100,
+    branching: float = 0.55,
+    max_depth: int | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Generates a forest of binary river trees, in raw TDX streamnet form.
+
+    Trees are grown breadth first from n_roots outlets. Each reach at the
+    growing edge is a confluence of two upstream reaches with probability
+    branching, otherwise a headwater, and reaches at max_depth are always
+    headwaters. When every tree has died out, new roots are added, until
+    there are n_reaches. Rows and LINKNOs are shuffled, as in TDX Hydro files.
+
+    Parameters:
+        n_reaches: Number of reaches.
+        n_roots: Number of outlets to start from.
+        branching: Probability that a reach has two upstream reaches.
+            Above 0.5 trees tend to grow without limit, below it they die out.
+        max_depth: Most reaches from a headwater to its outlet, if given.
+        seed: Seed of the random generator.
+
+    Returns: A DataFrame with LINKNO, DSLINKNO, USLINKNO1, USLINKNO2, and
+        strmOrder fields, with -1 for no link.
+    """
+    rng = np.random.default_rng(seed)
+    parent = np.full(n_reaches, -1, dtype=np.int64)
+    us_left = np.full(n_reaches, -1, dtype=np.int64)
+    us_right = np.full(n_reaches, -1, dtype=np.int64)
+    depth = np.zeros(n_reaches, dtype=np.int64)
+
+    n = min(n_roots, n_reaches)
+    frontier = np.arange(n)
+    while n < n_reaches:
+        remaining = n_reaches - n
+        if max_depth is not None:
+            frontier = frontier[depth[frontier] + 1 < max_depth]
+        confluences = frontier[rng.random(len(frontier)) < branching]
+        confluences = confluences[:remaining // 2]
+        if not len(confluences):
+            # every tree died out, or one reach is left, so start new trees
+            k = min(n_roots, remaining)
+            frontier = np.arange(n, n + k)
+            n += k
+            continue
+        children = np.arange(n, n + 2 * len(confluences))
+        us_left[confluences] = children[0::2]
+        us_right[confluences] = children[1::2]
+        parent[children] = np.repeat(confluences, 2)
+        depth[children] = np.repeat(depth[confluences] + 1, 2)
+        n += len(children)
+        frontier = children
+
+    # shuffle LINKNOs and rows
+    linkno = rng.permutation(n_reaches) + 1
+    to_linkno = lambda pos: np.where(pos > -1, linkno[pos], -1)
+    df = pd.DataFrame({
+        LINK: linkno,
+        DS_LINK: to_linkno(parent),
+        US_LEFT: to_linkno(us_left),
+        US_RIGHT: to_linkno(us_right),
+        'strmOrder': __strahler_order(us_left, us_right, depth),
+    })
+    return df.iloc[rng.permutation(n_reaches)].reset_index(drop=True)
+
+
+def synthetic_tdx_region(
+    n_reaches: int,
+    n_roots: int = 100,
+    branching: float = 0.55,
+    max_depth: int | None = None,
+    seed: int = 0,
+) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """Generates a synthetic TDX Hydro Region, as read from NGA's files.
+
+    See `synthetic_network` for the parameters. Each reach's basin is a
+    grid cell, with cells assigned along a snake path in depth-first order,
+    and its stream is a line across the cell.
+
+    Returns: A tuple of GeoDataFrames
+        streamnet_gdf: streamnet fields with LineString geometries.
+        basins_gdf: 'streamID' with Polygon geometries.
+    """
+    df = synthetic_network(n_reaches, n_roots, branching, max_depth, seed)
+
+    # cell positions along a snake path, in (ROOT_ID, DISCOVER_TIME) order
+    mnsi = modified_nest_set_index(df[[LINK, DS_LINK, US_LEFT, US_RIGHT]].copy())
+    order = np.lexsort((mnsi[DISCOVER].to_numpy(), mnsi[ROOT].to_numpy()))
+    cell = np.empty(n_reaches, dtype=np.int64)
+    cell[order] = np.arange(n_reaches)
+    width = int(np.ceil(np.sqrt(n_reaches)))
+    row, col = np.divmod(cell, width)
+    col = np.where(row % 2 == 1, width - 1 - col, col)
+    x0, y0 = col * CELL_SIZE, row * CELL_SIZE
+
+    basins_gdf = gpd.GeoDataFrame(
+        {'streamID': df[LINK].to_numpy()},
+        geometry=shapely.box(x0, y0, x0 + CELL_SIZE, y0 + CELL_SIZE),
+        crs='EPSG:4326',
+    )
+    coords = np.stack([
+        np.stack([x0 + CELL_SIZE / 2, y0 + CELL_SIZE / 4], axis=1),
+        np.stack([x0 + CELL_SIZE / 2, y0 + 3 * CELL_SIZE / 4], axis=1),
+    ], axis=1)
+    streamnet_gdf = gpd.GeoDataFrame(
+        df,
+        geometry=shapely.linestrings(coords),
+        crs='EPSG:4326',
+    )
+    return (streamnet_gdf, basins_gdf)
+
+
+def __strahler_order(
+    us_left: np.ndarray,
+    us_right: np.ndarray,
+    depth: np.ndarray,
+) -> np.ndarray:
+    """Strahler stream order, computed from the deepest reaches down"""
+    order = np.ones(len(depth), dtype=np.int64)
+    by_depth = np.argsort(depth, kind="stable")
+    boundaries = np.searchsorted(depth[by_depth], np.arange(depth.max() + 2))
+    for d in range(depth.max(), -1, -1):
+        level = by_depth[boundaries[d]:boundaries[d + 1]]
+        level = level[us_left[level] > -1]
+        left = order[us_left[level]]
+        right = order[us_right[level]]
+        order[level] = np.where(left == right, left + 1, np.maximum(left, right))
+    return order
@@ -5,12 +5,21 @@ Watershed.
 
 # populate package namespace
 from global_hydrography import (
+    instrument,
+    incremental,
     io,
+    metadata,
     preprocess,
     process,
+    tiles,
 )
 
 from global_hydrography.delineation import (
     mnsi,
+    aggregate,
+    downstream,
     delineate,
+    router,
+    service,
+    boundary_cache,
 )
\ No newline at end of file
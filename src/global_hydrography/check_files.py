@@ -1,28 +1,169 @@
 import os
 from pathlib import Path
-import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import re
+import pandas as pd
+import pyogrio
 import fsspec
 
 # TODO: replace all os functions with pathlib functions
 
-# Writes the file information to output.txt
-def check_files():
-    output_file_path = 'J:\\MMW\\TDX_Hydro\\output.txt' 
-    with open(output_file_path, 'w') as output_file:
-        for file in os.listdir('J:\\MMW\\TDX_Hydro'):  # TODO: replace with pathlib
-            file_path = os.path.join('J:\\MMW\\TDX_Hydro', file) # TODO: replace with pathlib
-            try:
-                df = gpd.read_file(file_path, engine='pyogrio', use_arrow=True,)
-                    # adding `engine='pyogrio', use_arrow=True` gives a 16.7x speedup!
-                    # TODO: Refactoring to `pyogrio.read_arrow()` with give an additional 4x! or 96x from previous
-                output_file.write(f"-----------------------------------------------\n")
-                output_file.write(f"File: {file}\n")
-                df.info(buf=output_file)
-                output_file.write(f"Size: {df.size}\n")
-                output_file.write(f"-----------------------------------------------\n\n\n")
-                print(f"{file} done!")
-            except Exception as e:
-                print(f"ERROR for {file}: ", e)
+TDX_DIR = Path('J:\\MMW\\TDX_Hydro')
+INVENTORY_FILENAME = 'inventory.json'
+INVENTORY_SUFFIXES = ('.gpkg', '.geojson', '.parquet')
+HASH_CHUNK_SIZE = 8 * 2**20
+
+
+def file_hash(file_path: Path, algorithm: str = 'sha256') -> str:
+    """Hex digest of a file's content, read in chunks"""
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def inventory_file(file_path: Path, hash_algorithm: str | None = 'sha256') -> dict:
+    """Describe a file from its metadata only, without reading its features.
+
+    Returns: A dict of file, path, size, mtime, the 10-digit TDX Hydro Region
+        (or None), a content hash (if hash_algorithm), and for each layer its 
+        feature count, fields and dtypes, geometry type, CRS, total bounds 
+        and layer metadata (e.g. DBF_DATE_LAST_UPDATE). Errors reading the
+        file are recorded in 'error'.
+    """
+    file_path = Path(file_path)
+    stat = file_path.stat()
+    match = re.search(r"\d{10}", file_path.name)
+    entry = {
+        'file': file_path.name,
+        'path': str(file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'region': int(match.group(0)) if match else None,
+        'hash': None,
+        'layers': [],
+        'error': None,
+    }
+    try:
+        if hash_algorithm:
+            entry['hash'] = f"{hash_algorithm}:{file_hash(file_path, hash_algorithm)}"
+        for layer, _ in pyogrio.list_layers(file_path):
+            info = pyogrio.read_info(
+                file_path, 
+                layer=layer, 
+                force_feature_count=True, 
+                force_total_bounds=True,
+            )
+            entry['layers'].append({
+                'layer': info['layer_name'],
+                'features': int(info['features']),
+                'fields': dict(zip(info['fields'].tolist(), info['dtypes'].tolist())),
+                'geometry_type': info['geometry_type'],
+                'crs': info['crs'],
+                'total_bounds': (
+                    [float(v) for v in info['total_bounds']] 
+                    if info['total_bounds'] is not None else None
+                ),
+                'layer_metadata': info['layer_metadata'],
+            })
+    except Exception as e:
+        entry['error'] = repr(e)
+    return entry
+
+
+def inventory_files(
+    directory: Path,
+    max_workers: int = 8,
+    hash_algorithm: str | None = 'sha256',
+    suffixes: tuple[str] = INVENTORY_SUFFIXES,
+) -> list[dict]:
+    """Inventory every file in a directory with one of the suffixes, in a 
+    thread pool. See `inventory_file`.
+
+    Returns: A list of inventory entries, sorted by file name.
+    """
+    file_paths = sorted(
+        path for path in Path(directory).iterdir()
+        if path.is_file() and path.suffix in suffixes
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda path: inventory_file(path, hash_algorithm), file_paths,
+        ))
+
+
+def write_inventory(inventory: list[dict], output_path: Path) -> Path:
+    """Write an inventory to JSON, or to Parquet with one row per layer if 
+    output_path ends in '.parquet'."""
+    output_path = Path(output_path)
+    if output_path.suffix == '.parquet':
+        inventory_to_dataframe(inventory).to_parquet(output_path)
+    else:
+        with open(output_path, 'w') as f:
+            json.dump(inventory, f, indent=2)
+    return output_path
+
+
+def read_inventory(inventory_path: Path) -> list[dict]:
+    """Read an inventory written as JSON by `write_inventory`"""
+    with open(inventory_path) as f:
+        return json.load(f)
+
+
+def inventory_to_dataframe(inventory: list[dict]) -> pd.DataFrame:
+    """Flatten an inventory to one row per layer (or per file, for files 
+    without layers), with fields and layer metadata as JSON strings."""
+    rows = []
+    for entry in inventory:
+        file_info = {k: v for k, v in entry.items() if k != 'layers'}
+        for layer in entry['layers'] or [{}]:
+            row = {**file_info, **layer}
+            for key in ('fields', 'layer_metadata'):
+                row[key] = json.dumps(layer.get(key))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def changed_files(previous: list[dict], current: list[dict]) -> list[str]:
+    """Names of files in the current inventory that are new, or whose hash
+    (or size and mtime, if not hashed) differ from the previous inventory."""
+    def key(entry: dict) -> tuple:
+        if entry['hash']:
+            return (entry['hash'],)
+        return (entry['size'], entry['mtime'])
+
+    previous_keys = {entry['file']: key(entry) for entry in previous}
+    return [
+        entry['file'] for entry in current
+        if previous_keys.get(entry['file']) != key(entry)
+    ]
+
+
+# Writes a metadata inventory of the TDX Hydro files to inventory.json
+def check_files(
+    directory: Path = TDX_DIR,
+    output_path: Path = None,
+    max_workers: int = 8,
+    hash_algorithm: str | None = 'sha256',
+) -> list[dict]:
+    """Inventory the TDX Hydro files in a directory, printing a line per 
+    file, and write the inventory to output_path (defaults to 
+    'inventory.json' in the directory)."""
+    directory = Path(directory)
+    output_path = output_path if output_path else directory / INVENTORY_FILENAME
+    inventory = inventory_files(directory, max_workers, hash_algorithm)
+    for entry in inventory:
+        if entry['error']:
+            print(f"ERROR for {entry['file']}: ", entry['error'])
+        else:
+            features = sum(layer['features'] for layer in entry['layers'])
+            print(f"{entry['file']}: {features} features, {entry['size']} bytes")
+    write_inventory(inventory, output_path)
+    print(f"Inventory of {len(inventory)} files saved: {output_path}")
+    return inventory
 
 # Compares the local vs remote file size
 def check_size():
@@ -30,7 +171,7 @@ def check_size():
     ROOT_URL = "https://earth-info.nga.mil/php/download.php"
     
     for file in os.listdir('J:\\MMW\\TDX_Hydro'):
-        if(file == 'output.txt' or file == 'hydrobasins_level2.geojson'):
+        if(file in ('output.txt', INVENTORY_FILENAME, 'hydrobasins_level2.geojson')):
             continue
 
         url_file = file.replace('.', '-')
@@ -1 +1,10 @@
-from .delineate import subset_network
+from .delineate import (
+    subset_network,
+    get_linkno_by_latlon,
+    get_linknos_by_latlon,
+    delineate_watersheds,
+    delineate_linknos,
+)
+from .aggregate import UpstreamAggregator
+from .downstream import DownstreamIndex
+from .router import RegionRouter
@@ -0,0 +1,159 @@
+'''Global Hydrography (gh) aggregation of attributes over upstream sets, such
+as drainage area and stream length, from prefix sums in MNSI order.
+
+Every upstream set is a contiguous (ROOT_ID, DISCOVER_TIME) range, so once
+the cumulative sum of a column is taken in that order, the total of any
+upstream set is the difference of two prefix sums, in constant time and
+without materializing the set.
+'''
+
+from pandas import DataFrame, Series
+import numpy as np
+import geopandas as gpd
+
+from global_hydrography.delineation.mnsi import MNSI_FIELDS, MNSIIndex
+from global_hydrography.process import match_basins_to_streams
+
+# Fields of upstream totals added by `add_upstream_aggregates`
+UPSTREAM_AREA = "UPSTREAM_AREA_KM2"
+UPSTREAM_LENGTH = "UPSTREAM_LENGTH_KM"
+UPSTREAM_FIELDS = [UPSTREAM_AREA, UPSTREAM_LENGTH]
+
+# TDX Hydro streamnet field of reach length, in meters
+TDX_LENGTH = "Length"
+
+# Equal area CRS (World Cylindrical Equal Area) to measure basin areas
+EQUAL_AREA_CRS = "EPSG:6933"
+
+
+class UpstreamAggregator:
+    """Totals of numeric columns over the upstream set of any link
+
+    Prefix sums of each column are precomputed in (ROOT_ID, DISCOVER_TIME)
+    order, with one leading zero, so the total over the upstream range
+    [start, stop) of a link is `prefix[stop] - prefix[start]`. One prefix
+    array spans all roots, as upstream ranges never cross a root.
+
+    Integer columns are summed exactly as int64. Float columns are summed as
+    float64, so totals of small sets within very large regions may carry a
+    rounding error relative to the region's total. Missing values count as 0.
+    """
+
+    def __init__(
+        self,
+        df: DataFrame,
+        columns: list[str],
+        mnsi_index: MNSIIndex | None = None,
+    ) -> None:
+        """
+        Parameters:
+            df: A DataFrame with MNSI fields and LINKNO as index.
+            columns: Numeric columns to aggregate.
+            mnsi_index: An index built from df. Built if not given.
+        """
+        self.__index = mnsi_index if mnsi_index is not None else MNSIIndex(df)
+        self.__links = df.index
+        order = self.__index.order
+        self.__prefix = {}
+        for column in columns:
+            values = df[column].to_numpy()
+            dtype = np.int64 if np.issubdtype(values.dtype, np.integer) else np.float64
+            values = np.nan_to_num(values.astype(dtype, copy=False)[order])
+            prefix = np.zeros(len(values) + 1, dtype=dtype)
+            np.cumsum(values, out=prefix[1:])
+            self.__prefix[column] = prefix
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.__prefix)
+
+    def total(self, column: str, linkid: int) -> int | float:
+        """Total of column over the upstream set of linkid, itself included
+
+        Raises:
+            KeyError: If linkid is not in the index.
+        """
+        start, stop = self.__index.upstream_range(linkid)
+        prefix = self.__prefix[column]
+        return (prefix[stop] - prefix[start]).item()
+
+    def totals(
+        self,
+        column: str,
+        linkids: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Totals of column over the upstream sets of many links
+
+        Parameters:
+            column: The column to total.
+            linkids: Links to total. Defaults to every row, in row order.
+
+        Raises:
+            KeyError: If any linkid is not in the index.
+        """
+        starts, stops = self.__index.upstream_ranges(linkids)
+        prefix = self.__prefix[column]
+        return prefix[stops] - prefix[starts]
+
+    def to_frame(self, linkids: np.ndarray | None = None) -> DataFrame:
+        """Totals of every column, indexed by LINKNO"""
+        index = self.__links if linkids is None else linkids
+        return DataFrame(
+            {column: self.totals(column, linkids) for column in self.__prefix},
+            index=index,
+        )
+
+
+def basin_areas(basins: gpd.GeoSeries) -> np.ndarray:
+    """Areas of basins in square kilometers, measured in an equal area CRS"""
+    return basins.to_crs(EQUAL_AREA_CRS).area.to_numpy() / 1e6
+
+
+def add_upstream_aggregates(
+    streams_df: DataFrame,
+    basin_area: Series | None = None,
+    mnsi_index: MNSIIndex | None = None,
+) -> DataFrame:
+    """Adds upstream drainage area and stream length to a Stream Network.
+
+    Fields are only added for the data available: UPSTREAM_AREA_KM2 if
+    basin areas are given, and UPSTREAM_LENGTH_KM if streams_df has the
+    TDX Hydro Length field.
+
+    Parameters:
+        streams_df: Stream Network dataset with MNSI fields, with LINKNO as
+            index.
+        basin_area: Area of each basin in square kilometers, with LINKNO as
+            index, e.g. from `basin_areas`. Reaches without a basin add no
+            area, and basins without a reach are ignored.
+        mnsi_index: An index built from streams_df. Built if not given.
+
+    Returns: streams_df, with the fields added in place.
+    """
+    columns = {}
+    if basin_area is not None:
+        match = match_basins_to_streams(
+            basin_area.index.to_numpy(), streams_df.index.to_numpy(),
+        )
+        area = np.zeros(len(streams_df))
+        area[match.streams] = basin_area.to_numpy()[match.basins]
+        columns[UPSTREAM_AREA] = area
+    if TDX_LENGTH in streams_df.columns:
+        columns[UPSTREAM_LENGTH] = streams_df[TDX_LENGTH].to_numpy() / 1000
+
+    if not columns:
+        return streams_df
+    aggregator = UpstreamAggregator(
+        streams_df[MNSI_FIELDS].assign(**columns), list(columns), mnsi_index,
+    )
+    for column in columns:
+        totals = aggregator.totals(column)
+        if column in streams_df.columns:
+            streams_df[column] = totals
+        elif isinstance(streams_df, gpd.GeoDataFrame):
+            # keep geometry as the last column
+            loc = streams_df.columns.get_loc(streams_df.geometry.name)
+            streams_df.insert(loc, column, totals)
+        else:
+            streams_df[column] = totals
+    return streams_df
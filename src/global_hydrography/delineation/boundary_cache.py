@@ -0,0 +1,391 @@
+'''Global Hydrography (gh) cache of watershed boundaries by LINKNO, so the
+boundaries of popular outlets are unioned once rather than on every request.
+
+Boundaries are kept in a least recently used in-memory tier, bounded by the
+estimated size of their geometries, and in an on-disk tier of WKB files,
+bounded by bytes on disk. Entries are keyed by a fingerprint of the region's
+processed GeoParquet file, so they are invalidated when the file changes.
+
+Boundaries of the most requested outlets, or of the largest watersheds, can
+be precomputed offline with:
+
+    python -m global_hydrography.delineation.boundary_cache \\
+        --processed-dir TDX_MNSI_Output --cache-dir boundary_cache \\
+        --regions 4020024190 --top 1000
+'''
+
+from collections import Counter, OrderedDict
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from global_hydrography.delineation.mnsi import DISCOVER, FINISH
+from global_hydrography.delineation.router import (
+    region_parquet_path,
+    parquet_fingerprint,
+    BASINS_DATASET,
+)
+from global_hydrography.delineation.delineate import delineate_linknos
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET = 2**30
+DEFAULT_DISK_BUDGET = 20 * 2**30
+# Boundaries larger than this are only cached on disk
+DEFAULT_MAX_ENTRY_SIZE = 64 * 2**20
+DEFAULT_TOP_OUTLETS = 1000
+REQUEST_COUNTS_FILENAME = "request_counts.json"
+
+
+def estimate_geometry_size(geometry: shapely.Geometry) -> int:
+    """Estimated bytes held by a geometry, as in `router.estimate_memory_usage`"""
+    return 16 * int(shapely.get_num_coordinates(geometry)) + 100
+
+
+class BoundaryCache:
+    """Two tier, LRU cache of watershed boundaries keyed by (region, LINKNO)
+
+    Every entry belongs to a fingerprint of its region's processed file,
+    from `parquet_fingerprint`. When a region is requested with a new
+    fingerprint, its entries of other fingerprints are dropped from both
+    tiers. The disk tier is stored as
+    `{cache_dir}/{region}/{fingerprint}/{linkno}.wkb`, written atomically so
+    it can be shared by processes, though each process bounds its own
+    writes by the disk budget.
+
+    Requests are counted per (region, LINKNO), to find the most requested
+    outlets to precompute. See `save_request_counts`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | None = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        disk_budget: int = DEFAULT_DISK_BUDGET,
+        max_entry_size: int = DEFAULT_MAX_ENTRY_SIZE,
+    ) -> None:
+        """
+        Parameters:
+            cache_dir: Directory of the disk tier. If None, only memory is used.
+            memory_budget: Estimated bytes of geometries kept in memory.
+            disk_budget: Bytes of WKB files kept on disk.
+            max_entry_size: Estimated bytes above which a boundary is only
+                cached on disk.
+        """
+        self.__dir = Path(cache_dir) if cache_dir else None
+        self.__memory_budget = memory_budget
+        self.__disk_budget = disk_budget
+        self.__max_entry_size = max_entry_size
+
+        self.__lock = threading.Lock()
+        self.__memory: OrderedDict[tuple[int, int], shapely.Geometry] = OrderedDict()
+        self.__memory_sizes: dict[tuple[int, int], int] = {}
+        self.__fingerprints: dict[int, str] = {}
+        self.__disk: OrderedDict[Path, int] = self.__scan_disk()
+        # running totals of the sizes above, so puts don't re-sum every entry
+        self.__memory_usage = 0
+        self.__disk_usage = sum(self.__disk.values())
+        self.__requests: Counter[tuple[int, int]] = Counter()
+        self.__saved_requests: Counter[tuple[int, int]] = Counter()
+        self.__memory_hits = 0
+        self.__disk_hits = 0
+        self.__misses = 0
+
+    @property
+    def cache_dir(self) -> Path | None:
+        return self.__dir
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            requests = self.__memory_hits + self.__disk_hits + self.__misses
+            hits = self.__memory_hits + self.__disk_hits
+            return {
+                "memory_hits": self.__memory_hits,
+                "disk_hits": self.__disk_hits,
+                "misses": self.__misses,
+                "hit_rate": hits / requests if requests else None,
+                "memory_entries": len(self.__memory),
+                "memory_usage": self.__memory_usage,
+                "disk_entries": len(self.__disk),
+                "disk_usage": self.__disk_usage,
+            }
+
+    def get(
+        self,
+        tdx_hydro_region: int,
+        linkno: int,
+        fingerprint: str,
+    ) -> shapely.Geometry | None:
+        """A cached boundary, or None. Counts the request."""
+        key = (tdx_hydro_region, linkno)
+        with self.__lock:
+            self.__check_fingerprint(tdx_hydro_region, fingerprint)
+            self.__requests[key] += 1
+            if key in self.__memory:
+                self.__memory_hits += 1
+                self.__memory.move_to_end(key)
+                return self.__memory[key]
+
+        path = self.__path(tdx_hydro_region, linkno, fingerprint)
+        boundary = self.__read(path)
+        with self.__lock:
+            if boundary is None:
+                self.__misses += 1
+                return None
+            self.__disk_hits += 1
+            if path in self.__disk:
+                self.__disk.move_to_end(path)
+            self.__put_memory(key, boundary)
+        return boundary
+
+    def put(
+        self,
+        tdx_hydro_region: int,
+        linkno: int,
+        fingerprint: str,
+        boundary: shapely.Geometry,
+    ) -> None:
+        """Cache a boundary in both tiers"""
+        key = (tdx_hydro_region, linkno)
+        with self.__lock:
+            self.__check_fingerprint(tdx_hydro_region, fingerprint)
+            self.__put_memory(key, boundary)
+        if self.__dir is None:
+            return
+
+        path = self.__path(tdx_hydro_region, linkno, fingerprint)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        wkb = shapely.to_wkb(boundary)
+        temp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(wkb)
+        os.replace(temp_path, path)
+        with self.__lock:
+            self.__disk_usage += len(wkb) - self.__disk.get(path, 0)
+            self.__disk[path] = len(wkb)
+            self.__disk.move_to_end(path)
+            self.__evict_disk()
+
+    def invalidate(self, tdx_hydro_region: int, keep: str | None = None) -> None:
+        """Drop a region's entries, except those of the `keep` fingerprint"""
+        with self.__lock:
+            self.__invalidate(tdx_hydro_region, keep)
+
+    def most_requested(
+        self,
+        n: int,
+        tdx_hydro_region: int | None = None,
+    ) -> list[tuple[int, int, int]]:
+        """The n most requested (region, LINKNO, count), optionally of one region"""
+        with self.__lock:
+            counts = [
+                (region, linkno, count)
+                for (region, linkno), count in self.__requests.most_common()
+                if tdx_hydro_region is None or region == tdx_hydro_region
+            ]
+        return counts[:n]
+
+    def save_request_counts(self, path: Path | None = None) -> Path:
+        """Add the request counts to a JSON file, by default in the cache dir,
+        for `precompute_boundaries`"""
+        path = Path(path) if path else self.__dir / REQUEST_COUNTS_FILENAME
+        counts = Counter({
+            (region, linkno): count
+            for region, linkno, count in load_request_counts(path)
+        })
+        with self.__lock:
+            # only add the requests since the last save
+            counts.update(self.__requests - self.__saved_requests)
+            self.__saved_requests = self.__requests.copy()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, "w") as f:
+            json.dump([[*key, count] for key, count in counts.most_common()], f)
+        os.replace(temp_path, path)
+        return path
+
+    def __path(self, tdx_hydro_region: int, linkno: int, fingerprint: str) -> Path | None:
+        if self.__dir is None:
+            return None
+        return self.__dir / str(tdx_hydro_region) / fingerprint / f"{linkno}.wkb"
+
+    @staticmethod
+    def __read(path: Path | None) -> shapely.Geometry | None:
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return shapely.from_wkb(f.read())
+        except FileNotFoundError:
+            return None
+        except shapely.errors.GEOSException:
+            logger.warning(f"Ignoring corrupt cached boundary {path}")
+            return None
+
+    def __scan_disk(self) -> OrderedDict[Path, int]:
+        """Existing disk entries, from least to most recently modified"""
+        if self.__dir is None or not self.__dir.exists():
+            return OrderedDict()
+        entries = [(path, path.stat()) for path in self.__dir.glob("*/*/*.wkb")]
+        entries.sort(key=lambda entry: entry[1].st_mtime_ns)
+        return OrderedDict((path, stat.st_size) for path, stat in entries)
+
+    def __check_fingerprint(self, tdx_hydro_region: int, fingerprint: str) -> None:
+        """Drop a region's entries if its file changed. Must hold the lock."""
+        if self.__fingerprints.get(tdx_hydro_region) != fingerprint:
+            self.__invalidate(tdx_hydro_region, keep=fingerprint)
+            self.__fingerprints[tdx_hydro_region] = fingerprint
+
+    def __invalidate(self, tdx_hydro_region: int, keep: str | None) -> None:
+        """Must hold the lock"""
+        for key in [k for k in self.__memory if k[0] == tdx_hydro_region]:
+            del self.__memory[key]
+            self.__memory_usage -= self.__memory_sizes.pop(key)
+        self.__fingerprints.pop(tdx_hydro_region, None)
+        if self.__dir is None:
+            return
+        region_dir = self.__dir / str(tdx_hydro_region)
+        if not region_dir.exists():
+            return
+        for fingerprint_dir in region_dir.iterdir():
+            if fingerprint_dir.name == keep:
+                continue
+            logger.info(f"Invalidating cached boundaries in {fingerprint_dir}")
+            for path in fingerprint_dir.iterdir():
+                path.unlink(missing_ok=True)
+                self.__disk_usage -= self.__disk.pop(path, 0)
+            fingerprint_dir.rmdir()
+
+    def __put_memory(self, key: tuple[int, int], boundary: shapely.Geometry) -> None:
+        """Must hold the lock"""
+        size = estimate_geometry_size(boundary)
+        if size > self.__max_entry_size:
+            return
+        self.__memory_usage += size - self.__memory_sizes.get(key, 0)
+        self.__memory[key] = boundary
+        self.__memory_sizes[key] = size
+        self.__memory.move_to_end(key)
+        while self.__memory_usage > self.__memory_budget:
+            evicted, _ = self.__memory.popitem(last=False)
+            self.__memory_usage -= self.__memory_sizes.pop(evicted)
+
+    def __evict_disk(self) -> None:
+        """Must hold the lock"""
+        while len(self.__disk) > 1 and self.__disk_usage > self.__disk_budget:
+            path, size = self.__disk.popitem(last=False)
+            self.__disk_usage -= size
+            path.unlink(missing_ok=True)
+
+
+def load_request_counts(path: Path) -> list[tuple[int, int, int]]:
+    """(region, LINKNO, count) saved by `BoundaryCache.save_request_counts`,
+    or an empty list if there are none"""
+    try:
+        with open(path) as f:
+            return [tuple(entry) for entry in json.load(f)]
+    except FileNotFoundError:
+        return []
+
+
+def largest_outlets(basins_gdf: gpd.GeoDataFrame, n: int) -> np.ndarray:
+    """LINKNOs of the n largest watersheds, by number of upstream elements.
+
+    ELEMENT_COUNT only counts the elements not in an upstream dissolve
+    group, so watershed size is taken from the MNSI interval instead.
+    """
+    size = (basins_gdf[FINISH] - basins_gdf[DISCOVER]).to_numpy()
+    n = min(n, len(size))
+    largest = np.argpartition(-size, n - 1)[:n] if n else np.array([], dtype=int)
+    return basins_gdf.index.to_numpy()[largest]
+
+
+def precompute_boundaries(
+    basins_gdf: gpd.GeoDataFrame,
+    tdx_hydro_region: int,
+    cache: BoundaryCache,
+    fingerprint: str,
+    linknos: np.ndarray | None = None,
+    n_outlets: int = DEFAULT_TOP_OUTLETS,
+    groups_gdf: gpd.GeoDataFrame | None = None,
+) -> int:
+    """Delineate and cache the boundaries of many outlets of a region.
+
+    Outlets are delineated upstream first with `delineate.delineate_linknos`,
+    so large watersheds reuse the boundaries of outlets nested within them.
+
+    Parameters:
+        basins_gdf: The region's basins, with MNSI fields and LINKNO as index.
+        tdx_hydro_region: The 10-digit TDX Hydro Region.
+        cache: The cache to fill.
+        fingerprint: Fingerprint of the region's basins file.
+        linknos: Outlets to delineate, such as the most requested. Defaults
+            to the n_outlets largest watersheds.
+        n_outlets: Number of the largest watersheds, if linknos is not given.
+        groups_gdf: The region's dissolve groups, to delineate from.
+
+    Returns: The number of boundaries cached.
+    """
+    if linknos is None:
+        linknos = largest_outlets(basins_gdf, n_outlets)
+    linknos = np.unique(np.asarray(linknos, dtype=np.int64))
+    linknos = linknos[np.isin(linknos, basins_gdf.index.to_numpy())]
+
+    n = 0
+    for linkno, _, boundary in delineate_linknos(basins_gdf, linknos, groups_gdf):
+        cache.put(tdx_hydro_region, int(linkno), fingerprint, boundary)
+        n += 1
+    logger.info(f"Cached {n} boundaries of TDX Hydro Region {tdx_hydro_region}")
+    return n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processed-dir", type=Path, required=True)
+    parser.add_argument("--cache-dir", type=Path, required=True)
+    parser.add_argument("--regions", type=int, nargs="+", required=True)
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_OUTLETS)
+    parser.add_argument(
+        "--most-requested", action="store_true",
+        help=f"precompute the most requested outlets in {REQUEST_COUNTS_FILENAME}, "
+             "rather than the largest watersheds",
+    )
+    parser.add_argument(
+        "--groups", action="store_true",
+        help="delineate from the dissolve groups pyramid",
+    )
+    parser.add_argument("--disk-budget", type=float, default=20, help="GiB")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cache = BoundaryCache(
+        args.cache_dir, memory_budget=0, disk_budget=int(args.disk_budget * 2**30),
+    )
+    counts = load_request_counts(args.cache_dir / REQUEST_COUNTS_FILENAME)
+    for region in args.regions:
+        path = region_parquet_path(args.processed_dir, region, BASINS_DATASET)
+        fingerprint = parquet_fingerprint(path)
+        basins_gdf = gpd.read_parquet(path)
+        groups_gdf = gpd.read_parquet(
+            region_parquet_path(args.processed_dir, region, "dissolve_groups")
+        ) if args.groups else None
+        linknos = None
+        if args.most_requested:
+            linknos = [
+                linkno for r, linkno, _ in counts if r == region
+            ][:args.top]
+        precompute_boundaries(
+            basins_gdf, region, cache, fingerprint,
+            linknos=linknos, n_outlets=args.top, groups_gdf=groups_gdf,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,27 @@
 mnsi & hydro unit fields added during gh processing.
 '''
 
+from typing import Iterator
+
+import numpy as np
 import geopandas as gpd
+import pandas as pd
+from numpy.typing import ArrayLike
 from shapely.geometry import Point, Polygon
 
+from global_hydrography import instrument
 from global_hydrography.delineation.mnsi import (
-    MNSI_FIELDS, DISCOVER, FINISH, ROOT
+    MNSI_FIELDS, DISCOVER, FINISH, ROOT,
+    DISSOLVE_ROOT_ID, DISSOLVE_LEVEL, PARENT_DISSOLVE_ROOT_ID,
+    MNSIIndex, dissolve_root_field,
 )
 
 
-def subset_network(gdf: gpd.GeoDataFrame, linkid: int) -> gpd.GeoDataFrame:
+def subset_network(
+    gdf: gpd.GeoDataFrame,
+    linkid: int,
+    mnsi_index: MNSIIndex | None = None,
+) -> gpd.GeoDataFrame:
     """Subset a basins (gdf) to include only elements upstream of linkid
 
     Args:
@@ -18,6 +30,9 @@ def subset_network(gdf: gpd.GeoDataFrame, linkid: int) -> gpd.GeoDataFrame:
             basins dataset where the stream reach with linkid resides.
         linkid (int): The global unique identifier for the stream
             network of interest
+        mnsi_index (MNSIIndex, optional): An index built from gdf. If given,
+            the upstream set is found with binary searches and returned as
+            a positional slice, rather than by masking every row.
 
     Returns:
         gpd.GeoDataFrame: Subsetted GeoDataFrame containing all basins
@@ -26,6 +41,9 @@ def subset_network(gdf: gpd.GeoDataFrame, linkid: int) -> gpd.GeoDataFrame:
     # TODO: Rename function to `get_upstream_basins()` 
     # or `get_upstream_links()` if we also want to use it for streams.
 
+    if mnsi_index is not None:
+        return mnsi_index.subset(gdf, linkid)
+
     # ID target basins from linkno and extract critical mnsi info
     # this is assuming the gdf has already set index to streamID
     target_basin = gdf.loc[linkid]
@@ -45,24 +63,95 @@ def get_linkno_by_latlon(
     basins_gdf: gpd.GeoDataFrame,
     lat: float,
     lon: float,
+    max_distance: float | None = None,
 ) -> int:
     """Finds the single basin record that contains the latitude and longitude
     for a single TDX Hydro Region.
+
+    See `get_linknos_by_latlon` for how points on shared boundaries and in
+    gaps between basins are resolved.
     
     Args:
         gdf (GeoDataFrame): A GeoDataFrame representation of the
             basins dataset that contains the latitude and longitude.
         lat (float): The latitude of the selected point location. 
         lon (float): The longitude of the selected point location.
+        max_distance (float, optional): If the point is in no basin, use the
+            nearest basin within this distance, in the units of the basins CRS.
+            Defaults to None, for no fallback.
     Returns:
         int: The LINKNO for the record.
+
+    Raises:
+        ValueError: If no basin contains the point.
     """
-    point = Point(lon, lat)
+    linkno = get_linknos_by_latlon(basins_gdf, [lat], [lon], max_distance)[0]
+    if linkno == -1:
+        raise ValueError(f"No basin found at lat={lat}, lon={lon}.")
+    return linkno
 
-    return basins_gdf.loc[
-        basins_gdf.geometry.contains(point)
-    ].index.values[0]
 
+@instrument.stage('locate points')
+def get_linknos_by_latlon(
+    basins_gdf: gpd.GeoDataFrame,
+    lats: ArrayLike,
+    lons: ArrayLike,
+    max_distance: float | None = None,
+) -> np.ndarray:
+    """Finds the basin records that contain each of many latitudes and longitudes
+    for a single TDX Hydro Region, using the basins' spatial index.
+
+    The STR-tree spatial index is built on first use and cached with
+    `basins_gdf`, so later calls on the same frame only query it. Exact
+    tests are only run on basins whose bounding box holds a point.
+
+    A point on the boundary shared by several basins is assigned to the one
+    with the lowest LINKNO. A point in no basin, such as in a gap between
+    basins, is assigned to the nearest basin within max_distance (again the
+    lowest LINKNO if several are equally near), or -1.
+
+    Args:
+        basins_gdf (GeoDataFrame): Basins dataset, with LINKNO as index.
+        lats (ArrayLike): The latitudes of the point locations.
+        lons (ArrayLike): The longitudes of the point locations.
+        max_distance (float, optional): Search distance for points in no
+            basin, in the units of the basins CRS. Defaults to None, for
+            no fallback.
+    Returns:
+        np.ndarray: The LINKNO for each point, or -1 where none was found.
+    """
+    points = gpd.points_from_xy(lons, lats)
+    linknos = np.full(len(points), -1, dtype=np.int64)
+    index_linknos = basins_gdf.index.to_numpy()
+
+    # covered points: bounding box query, then exact intersects test
+    point_idx, basin_idx = basins_gdf.sindex.query(points, predicate="intersects")
+    __assign_lowest_linkno(linknos, point_idx, index_linknos[basin_idx])
+
+    missing = np.flatnonzero(linknos == -1)
+    if max_distance is not None and missing.size:
+        point_idx, basin_idx = basins_gdf.sindex.nearest(
+            points[missing], max_distance=max_distance, return_all=True,
+        )
+        __assign_lowest_linkno(
+            linknos, missing[point_idx], index_linknos[basin_idx],
+        )
+
+    return linknos
+
+
+def __assign_lowest_linkno(
+    linknos: np.ndarray,
+    point_idx: np.ndarray,
+    candidates: np.ndarray,
+) -> None:
+    """Assign each point the lowest of its candidate LINKNOs, in place"""
+    if not point_idx.size:
+        return
+    order = np.lexsort((candidates, point_idx))
+    point_idx, candidates = point_idx[order], candidates[order]
+    first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+    linknos[point_idx[first]] = candidates[first]
 
 
 def get_watershed_boundary(
@@ -77,3 +166,256 @@ def get_watershed_boundary(
         # method is 18.5x Faster, but only for non-overlapping polygons
 
     return boundary
+
+
+def get_watershed_boundary_from_groups(
+    basins_gdf: gpd.GeoDataFrame,
+    groups_gdf: gpd.GeoDataFrame,
+    linkid: int,
+    mnsi_index: MNSIIndex | None = None,
+    groups_index: MNSIIndex | None = None,
+) -> Polygon:
+    """Delineate the watershed upstream of linkid from pre-dissolved groups
+
+    Every dissolve group whose root is upstream of linkid lies entirely
+    upstream of it, so the watershed is assembled from the coarsest such
+    groups, then the finer groups not already covered, plus the basins of
+    linkid's own group that are upstream of linkid. The number of polygons
+    unioned grows with the number of levels rather than with the number of
+    upstream basins.
+
+    Args:
+        basins_gdf (gpd.GeoDataFrame): Basins dataset with MNSI and
+            DISSOLVE_ROOT_ID fields, with LINKNO as index.
+        groups_gdf (gpd.GeoDataFrame): Pre-dissolved groups for the same
+            region, from `process.create_dissolve_groups_pyramid`.
+        linkid (int): The global unique identifier of the outlet reach.
+        mnsi_index (MNSIIndex, optional): An index built from basins_gdf.
+        groups_index (MNSIIndex, optional): An index built from groups_gdf.
+
+    Returns:
+        Polygon: The upstream watershed boundary
+    """
+    target_basin = basins_gdf.loc[linkid]
+    root_id = target_basin[ROOT]
+    discover_time = target_basin[DISCOVER]
+    finish_time = target_basin[FINISH]
+
+    if groups_index is not None:
+        upstream_groups = groups_gdf.iloc[
+            groups_index.range_positions(root_id, discover_time, finish_time)
+        ]
+    else:
+        upstream_groups = groups_gdf.loc[
+            (groups_gdf[ROOT] == root_id)
+            & (groups_gdf[DISCOVER] >= discover_time)
+            & (groups_gdf[FINISH] <= finish_time)
+        ]
+
+    # skip groups that are within an upstream group of the next coarser level
+    pieces = []
+    coarser_ids = pd.Index([])
+    for level in sorted(upstream_groups[DISSOLVE_LEVEL].unique(), reverse=True):
+        level_groups = upstream_groups.loc[upstream_groups[DISSOLVE_LEVEL] == level]
+        pieces.append(level_groups.loc[
+            ~level_groups[PARENT_DISSOLVE_ROOT_ID].isin(coarser_ids)
+        ].geometry)
+        coarser_ids = pd.Index(level_groups[DISSOLVE_ROOT_ID])
+
+    # the rest of the watershed is in linkid's own, partially upstream, group
+    if target_basin[DISSOLVE_ROOT_ID] != linkid:
+        upstream_basins_gdf = subset_network(basins_gdf, linkid, mnsi_index)
+        pieces.append(upstream_basins_gdf.loc[
+            upstream_basins_gdf[DISSOLVE_ROOT_ID] == target_basin[DISSOLVE_ROOT_ID]
+        ].geometry)
+
+    return get_watershed_boundary(gpd.GeoSeries(pd.concat(pieces)))
+
+
+def delineate_watersheds(
+    basins_gdf: gpd.GeoDataFrame,
+    lats: ArrayLike,
+    lons: ArrayLike,
+    groups_gdf: gpd.GeoDataFrame | None = None,
+    max_distance: float | None = None,
+) -> Iterator[tuple[int, int, int, Polygon | None]]:
+    """Delineate the upstream watershed of many lat/lon points at once
+
+    Points are located with one spatial index query. Each distinct LINKNO is
+    delineated once, upstream links first, so a downstream watershed reuses
+    the boundaries already computed for watersheds nested within it and only
+    unions the remaining basins with them. With groups_gdf, the remaining 
+    basins are filled with the coarsest pre-dissolved groups made only of 
+    remaining basins, as in `get_watershed_boundary_from_groups`. Upstream 
+    sets are found with an MNSIIndex built once for the batch.
+
+    Results are yielded as each LINKNO is finished, not in input order.
+
+    Args:
+        basins_gdf (gpd.GeoDataFrame): Basins dataset with MNSI fields, with
+            LINKNO as index.
+        lats (ArrayLike): The latitudes of the point locations.
+        lons (ArrayLike): The longitudes of the point locations.
+        groups_gdf (gpd.GeoDataFrame, optional): Pre-dissolved groups for the
+            region, from `process.create_dissolve_groups_pyramid`. Requires
+            the dissolve group fields of every level in basins_gdf.
+            See `get_watershed_boundary_from_groups`.
+        max_distance (float, optional): See `get_linknos_by_latlon`.
+
+    Yields:
+        tuple: (position of the point in lats/lons, LINKNO, ROOT_ID, boundary).
+            Points in no basin have LINKNO and ROOT_ID of -1 and no boundary.
+    """
+    linknos = get_linknos_by_latlon(basins_gdf, lats, lons, max_distance)
+    for i in np.flatnonzero(linknos == -1):
+        yield (i, -1, -1, None)
+
+    unique_linknos, point_groups = np.unique(linknos, return_inverse=True)
+    points_by_group = np.argsort(point_groups, kind="stable")
+    group_bounds = np.searchsorted(
+        point_groups[points_by_group], np.arange(len(unique_linknos) + 1),
+    )
+    for linkid, root_id, boundary in delineate_linknos(
+        basins_gdf, unique_linknos[unique_linknos > -1], groups_gdf,
+    ):
+        position = np.searchsorted(unique_linknos, linkid)
+        for i in points_by_group[group_bounds[position]:group_bounds[position + 1]]:
+            yield (i, linkid, root_id, boundary)
+
+
+def delineate_linknos(
+    basins_gdf: gpd.GeoDataFrame,
+    linknos: ArrayLike,
+    groups_gdf: gpd.GeoDataFrame | None = None,
+    mnsi_index: MNSIIndex | None = None,
+    groups_index: MNSIIndex | None = None,
+) -> Iterator[tuple[int, int, Polygon]]:
+    """Delineate the upstream watershed of many distinct LINKNOs at once
+
+    See `delineate_watersheds`, which locates points then delineates their
+    LINKNOs with this. Results are yielded upstream links first.
+
+    Args:
+        basins_gdf (gpd.GeoDataFrame): Basins dataset with MNSI fields, with
+            LINKNO as index.
+        linknos (ArrayLike): Distinct LINKNOs in basins_gdf.
+        groups_gdf (gpd.GeoDataFrame, optional): See `delineate_watersheds`.
+        mnsi_index (MNSIIndex, optional): An index built from basins_gdf.
+            Built if not given.
+        groups_index (MNSIIndex, optional): An index built from groups_gdf.
+            Built if not given.
+
+    Yields:
+        tuple: (LINKNO, ROOT_ID, boundary).
+    """
+    with instrument.stage('index upstream sets', rows=len(basins_gdf)):
+        if mnsi_index is None:
+            mnsi_index = MNSIIndex(basins_gdf)
+        if groups_gdf is not None and groups_index is None:
+            groups_index = MNSIIndex(groups_gdf)
+
+    # visit links upstream first: by root, then latest discover time first
+    targets = basins_gdf.loc[np.asarray(linknos), MNSI_FIELDS]
+    targets = targets.sort_values([ROOT, DISCOVER], ascending=[True, False])
+
+    # boundaries finished so far in the current root, keyed by discover time
+    done = {}
+    current_root = None
+    for linkid, target in targets.iterrows():
+        root_id, discover_time, finish_time = (
+            target[ROOT], target[DISCOVER], target[FINISH]
+        )
+        if root_id != current_root:
+            done, current_root = {}, root_id
+
+        nested = __outermost_intervals([
+            (d, f) for d, f in done
+            if discover_time < d and f <= finish_time
+        ])
+        if nested:
+            upstream_basins_gdf = subset_network(basins_gdf, linkid, mnsi_index)
+            discover = upstream_basins_gdf[DISCOVER].to_numpy()
+            starts = np.array([d for d, _ in nested])
+            ends = np.array([f for _, f in nested])
+            # upstream basins not within a nested watershed already delineated
+            k = np.searchsorted(starts, discover, side="right") - 1
+            covered = (k > -1) & (discover < ends[np.maximum(k, 0)])
+            remaining = ~covered
+            group_pieces = []
+            if groups_gdf is not None:
+                group_pieces, remaining = __fill_from_groups(
+                    upstream_basins_gdf, remaining, groups_gdf, linkid,
+                )
+            pieces = gpd.GeoSeries(
+                [*(done[interval] for interval in nested),
+                 *group_pieces,
+                 *upstream_basins_gdf.geometry[remaining]],
+                crs=basins_gdf.crs,
+            )
+            boundary = get_watershed_boundary(pieces)
+        elif groups_gdf is not None:
+            boundary = get_watershed_boundary_from_groups(
+                basins_gdf, groups_gdf, linkid, mnsi_index, groups_index,
+            )
+        else:
+            boundary = get_watershed_boundary(
+                subset_network(basins_gdf, linkid, mnsi_index)
+            )
+
+        done[(discover_time, finish_time)] = boundary
+        yield (linkid, root_id, boundary)
+
+
+def __fill_from_groups(
+    upstream_basins_gdf: gpd.GeoDataFrame,
+    remaining: np.ndarray,
+    groups_gdf: gpd.GeoDataFrame,
+    linkid: int,
+) -> tuple[list[Polygon], np.ndarray]:
+    """Cover remaining upstream basins with pre-dissolved groups
+
+    From the coarsest level, a group is used if all of its upstream basins
+    are remaining, and it is not linkid's own group, which extends 
+    downstream of linkid, unless linkid is its root. Groups at each level 
+    are made of whole groups of the finer levels, so the groups used never
+    overlap, and the basins left are those of groups that are partly within
+    a nested watershed or downstream of linkid.
+
+    Returns: A tuple
+        pieces: Geometries of the groups used.
+        remaining: Mask of the upstream basins still not covered.
+    """
+    pieces = []
+    remaining = remaining.copy()
+    for level in sorted(groups_gdf[DISSOLVE_LEVEL].unique(), reverse=True):
+        field = dissolve_root_field(level)
+        ids = upstream_basins_gdf[field].to_numpy()
+        partial = np.unique(ids[~remaining])
+        own_id = upstream_basins_gdf.at[linkid, field]
+        if own_id != linkid:
+            partial = np.append(partial, own_id)
+        usable = remaining & ~np.isin(ids, partial)
+        if not usable.any():
+            continue
+        pieces.extend(groups_gdf.loc[
+            (groups_gdf[DISSOLVE_LEVEL] == level)
+            & groups_gdf[DISSOLVE_ROOT_ID].isin(np.unique(ids[usable]))
+        ].geometry)
+        remaining &= ~usable
+    return (pieces, remaining)
+
+
+def __outermost_intervals(
+    intervals: list[tuple[int, int]],
+) -> list[tuple[int, int]]:
+    """Drop MNSI (discover, finish) intervals nested within another one
+
+    MNSI intervals within a root are either nested or disjoint, so after
+    sorting by discover time an interval is nested if it starts before the
+    end of the last outermost one.
+    """
+    outermost = []
+    for d, f in sorted(intervals):
+        if not outermost or d >= outermost[-1][1]:
+            outermost.append((d, f))
+    return outermost
@@ -0,0 +1,219 @@
+'''Global Hydrography (gh) downstream queries of a Stream Network: flow paths
+to the outlet, upstream/downstream tests, lowest common confluences and
+river distances, vectorized over many links.
+
+Queries combine the modified nested set index, which tests whether one link
+is upstream of another in constant time, with a binary lifting table of
+each link's 2**k-th downstream link, which finds confluences in log(depth)
+vectorized steps.
+'''
+
+import numpy as np
+from numpy.typing import ArrayLike
+from pandas import DataFrame
+
+from global_hydrography.delineation.mnsi import (
+    DS_LINK, ROOT, DISCOVER, FINISH, MNSIIndex,
+)
+
+
+class DownstreamIndex:
+    """Compact arrays for downstream queries over a Stream Network
+
+    Links are stored by row position: the downstream position of each link
+    (an outlet is its own downstream), its depth below its outlet, and a
+    binary lifting table whose row k holds each link's 2**k-th downstream
+    link. Positions are int32, so the table takes 4 bytes per link per
+    level, with log2(max depth) levels.
+    """
+
+    def __init__(
+        self,
+        df: DataFrame,
+        mnsi_index: MNSIIndex | None = None,
+    ) -> None:
+        """
+        Parameters:
+            df: A Stream Network DataFrame with DSLINKNO and MNSI fields,
+                and LINKNO as index.
+            mnsi_index: An index built from df. Built if not given.
+
+        Raises:
+            KeyError: If a DSLINKNO is not in df.
+        """
+        self.__mnsi = mnsi_index if mnsi_index is not None else MNSIIndex(df)
+        self.__links = df.index.to_numpy(dtype=np.int64)
+        self.__root = df[ROOT].to_numpy(dtype=np.int64)
+        self.__discover = df[DISCOVER].to_numpy(dtype=np.int64)
+        self.__finish = df[FINISH].to_numpy(dtype=np.int64)
+
+        n = len(df)
+        parent = np.arange(n, dtype=np.int32)
+        ds_links = df[DS_LINK].to_numpy(dtype=np.int64)
+        has_ds = ds_links > -1
+        parent[has_ds] = self.__mnsi.positions(ds_links[has_ds])
+        self.__parent = parent
+
+        # lifting levels double the jump until every link jumps to its outlet
+        levels = [parent]
+        while True:
+            jump = levels[-1][levels[-1]]
+            if np.array_equal(jump, levels[-1]):
+                break
+            levels.append(jump)
+        self.__lift = np.stack(levels)
+        self.__depth = self.__path_totals(np.ones(n, dtype=np.int32)) - 1
+
+    def __len__(self) -> int:
+        return len(self.__links)
+
+    @property
+    def depth(self) -> np.ndarray:
+        """Number of links downstream of each link, in row order"""
+        return self.__depth
+
+    def positions(self, linkids: ArrayLike) -> np.ndarray:
+        """Row positions of linkids. See `MNSIIndex.positions`."""
+        return self.__mnsi.positions(np.atleast_1d(linkids))
+
+    def is_upstream(self, a: ArrayLike, b: ArrayLike) -> np.ndarray:
+        """True where link a is upstream of link b, or is b, compared in
+        constant time with their MNSI intervals. Vectorized over a and b."""
+        a, b = self.positions(a), self.positions(b)
+        return (
+            (self.__root[a] == self.__root[b])
+            & (self.__discover[b] <= self.__discover[a])
+            & (self.__discover[a] < self.__finish[b])
+        )
+
+    def path_to_root(self, linkid: int) -> np.ndarray:
+        """LINKNOs from linkid down to its outlet, both included"""
+        position = int(self.positions(linkid)[0])
+        path = np.empty(self.__depth[position] + 1, dtype=np.int32)
+        for i in range(len(path)):
+            path[i] = position
+            position = self.__parent[position]
+        return self.__links[path]
+
+    def paths_to_root(self, linkids: ArrayLike) -> tuple[np.ndarray, np.ndarray]:
+        """Paths to the outlet of many links, as compressed sparse rows.
+
+        All paths are followed one step downstream at a time together.
+
+        Returns: A tuple of arrays
+            offsets: path i is linknos[offsets[i]:offsets[i + 1]].
+            linknos: LINKNOs of all paths, each from its link to its outlet.
+        """
+        positions = self.positions(linkids).astype(np.int32)
+        lengths = self.__depth[positions].astype(np.int64) + 1
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        path = np.empty(offsets[-1], dtype=np.int32)
+        active = np.arange(len(positions))
+        for step in range(int(lengths.max(initial=0))):
+            active = active[lengths[active] > step]
+            path[offsets[active] + step] = positions[active]
+            positions[active] = self.__parent[positions[active]]
+        return (offsets, self.__links[path])
+
+    def ancestors(self, linkids: ArrayLike, k: ArrayLike) -> np.ndarray:
+        """The k-th link downstream of each link, or its outlet if fewer.
+        Vectorized over linkids and k."""
+        positions = self.__ancestor_positions(self.positions(linkids), k)
+        return self.__links[positions]
+
+    def confluences(self, a: ArrayLike, b: ArrayLike) -> np.ndarray:
+        """Lowest common downstream link of links a and b, or -1 if they drain
+        to different outlets. If one is upstream of the other, it is the
+        downstream one. Vectorized over a and b."""
+        return self.__links_or_missing(
+            self.__confluence_positions(self.positions(a), self.positions(b))
+        )
+
+    def distance_to_root(self, values: ArrayLike) -> np.ndarray:
+        """Totals of values over each link's path to its outlet, both
+        included, such as the river length to the outlet from the upstream
+        end of each link.
+
+        Parameters:
+            values: A value per link, in row order, e.g. reach lengths.
+        """
+        return self.__path_totals(np.asarray(values, dtype=np.float64))
+
+    def river_distances(
+        self,
+        a: ArrayLike,
+        b: ArrayLike,
+        distance_to_root: np.ndarray,
+    ) -> np.ndarray:
+        """Distances along the river between the upstream ends of links a
+        and b, through their confluence, or NaN if they drain to different
+        outlets. Vectorized over a and b.
+
+        Parameters:
+            a, b: LINKNOs.
+            distance_to_root: From `distance_to_root`, e.g. of reach lengths.
+        """
+        a, b = self.positions(a), self.positions(b)
+        c = self.__confluence_positions(a, b)
+        connected = c > -1
+        c = np.where(connected, c, 0)
+        distance = (
+            distance_to_root[a] + distance_to_root[b] - 2 * distance_to_root[c]
+        )
+        return np.where(connected, distance, np.nan)
+
+    def __path_totals(self, values: np.ndarray) -> np.ndarray:
+        """Totals of values from each link to its outlet, both included, by
+        pointer jumping in log(depth) steps.
+
+        Each link holds the total from itself down to, but excluding, the
+        link it jumps to. Outlets jump to a virtual link n with a total of 0,
+        so adding the total of the link jumped to never counts a link twice.
+        """
+        n = len(self)
+        jump = np.where(self.__is_outlet(), n, self.__parent).astype(np.int32)
+        jump = np.append(jump, np.int32(n))
+        total = np.append(values, values.dtype.type(0))
+        while (jump[:n] != n).any():
+            total = total + total[jump]
+            jump = jump[jump]
+        return total[:n]
+
+    def __is_outlet(self) -> np.ndarray:
+        """True for outlets, which are their own downstream link"""
+        return self.__parent == np.arange(len(self))
+
+    def __ancestor_positions(self, positions: np.ndarray, k: ArrayLike) -> np.ndarray:
+        positions, k = np.broadcast_arrays(positions, np.asarray(k, dtype=np.int64))
+        k = np.minimum(k, self.__depth[positions])
+        for level, jump in enumerate(self.__lift):
+            step = (k >> level) & 1 == 1
+            positions = np.where(step, jump[positions], positions)
+        return positions
+
+    def __contains(self, ancestor: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """True where positions are upstream of (or are) ancestor"""
+        return (
+            (self.__root[ancestor] == self.__root[positions])
+            & (self.__discover[ancestor] <= self.__discover[positions])
+            & (self.__discover[positions] < self.__finish[ancestor])
+        )
+
+    def __confluence_positions(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        a, b = np.broadcast_arrays(a, b)
+        connected = self.__root[a] == self.__root[b]
+        # lift a to its furthest downstream link that does not contain b,
+        # whose downstream link is then the confluence
+        lifted = a.copy()
+        for jump in self.__lift[::-1]:
+            ancestor = jump[lifted]
+            lifted = np.where(self.__contains(ancestor, b), lifted, ancestor)
+        confluence = np.where(
+            self.__contains(a, b), a, self.__parent[lifted],
+        )
+        return np.where(connected, confluence, -1)
+
+    def __links_or_missing(self, positions: np.ndarray) -> np.ndarray:
+        return np.where(positions > -1, self.__links[np.maximum(positions, 0)], -1)
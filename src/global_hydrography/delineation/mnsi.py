@@ -1,5 +1,8 @@
+import numpy as np
 from pandas import DataFrame, Series
 
+from global_hydrography import instrument
+
 # The algorithm was developed back on the information provided in this paper
 # https://doi.org/10.1016/j.envsoft.2017.06.009
 
@@ -17,8 +20,33 @@ FINISH = "FINISH_TIME"
 ROOT = "ROOT_ID"
 MNSI_FIELDS = [ROOT, FINISH, DISCOVER]
 
+# Fields added by dissolve grouping (see `process.compute_dissolve_groups`),
+# defined here so delineation can use them without importing `process`.
+DISSOLVE_ROOT_ID = "DISSOLVE_ROOT_ID"
+ELEMENT_COUNT = "ELEMENT_COUNT"
+DISSOLVE_LEVEL = "DISSOLVE_LEVEL"
+PARENT_DISSOLVE_ROOT_ID = "PARENT_DISSOLVE_ROOT_ID"
+
+
+def dissolve_root_field(level: int) -> str:
+    """Name of the field holding the dissolve group id for a pyramid level
+
+    Level 0 is the finest level and keeps the original DISSOLVE_ROOT_ID name.
+    """
+    return DISSOLVE_ROOT_ID if level == 0 else f"{DISSOLVE_ROOT_ID}_{level}"
+
+
+# Engines available for computing the modified nested set index
+ARRAY_ENGINE = "array"
+DICT_ENGINE = "dict"
+ENGINES = (ARRAY_ENGINE, DICT_ENGINE)
+
 
-def modified_nest_set_index(df: DataFrame) -> DataFrame:
+def modified_nest_set_index(
+    df: DataFrame,
+    engine: str = ARRAY_ENGINE,
+    validate: bool = False,
+) -> DataFrame:
     """Computes the modified next set index for root nodes in DataFrame
 
     Adds three (3) additional fields to the DataFrame to store the
@@ -37,12 +65,194 @@ def modified_nest_set_index(df: DataFrame) -> DataFrame:
     Parameters:
         df: DataFrame
             A DataFrame object loading from a TDX Hydro datasource
+        engine: str
+            Either "array" (default), which computes the index from NumPy
+            adjacency arrays, or "dict", the original row-by-row traversal.
+        validate: bool
+            If True, compute the index with both engines and raise a
+            ValueError if they do not agree. Defaults to False.
     Returns:
         DataFrame:
             DataFrame instance containing additional fields with modified
             nested set index information.
 
     """
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, not {engine!r}")
+
+    if validate:
+        other_engine = DICT_ENGINE if engine == ARRAY_ENGINE else ARRAY_ENGINE
+        # the dict engine needs LINKNO as a field, not the index
+        expected = modified_nest_set_index(
+            df.reset_index() if df.index.name == LINK else df.copy(),
+            engine=other_engine,
+        )
+
+    with instrument.stage('modified nested set index', rows=len(df)):
+        if engine == ARRAY_ENGINE:
+            df = __modified_nest_set_index_array(df)
+        else:
+            df = __modified_nest_set_index_dict(df)
+
+    if validate:
+        # compare by LINKNO, whichever of field or index holds it
+        links = df.index if df.index.name == LINK else df[LINK]
+        expected = expected.set_index(LINK).loc[links.to_numpy()]
+        for f in MNSI_FIELDS:
+            if not np.array_equal(df[f].to_numpy(), expected[f].to_numpy()):
+                raise ValueError(
+                    f"MNSI engines disagree on {f}: "
+                    f"{engine!r} and {other_engine!r} results differ."
+                )
+
+    return df
+
+
+def link_positions(df: DataFrame) -> tuple[np.ndarray, ...]:
+    """Maps the link fields of a TDX Hydro DataFrame to dense row positions
+
+    Parameters:
+        df: DataFrame
+            A DataFrame object with DSLINKNO, USLINKNO1 and USLINKNO2 fields,
+            and LINKNO as either a field or the index.
+    Returns:
+        tuple of np.ndarray:
+            links: the LINKNO values, in row order.
+            ds_pos: the row position of each downstream link, or -1.
+            us_left_pos: the row position of each USLINKNO1 link, or -1.
+            us_right_pos: the row position of each USLINKNO2 link, or -1.
+
+    Raises:
+        KeyError: If a non-negative link refers to a LINKNO not in df.
+    """
+    if df.index.name == LINK:
+        links = df.index.to_numpy(dtype=np.int64)
+    else:
+        links = df[LINK].to_numpy(dtype=np.int64)
+    sorter = np.argsort(links, kind="stable")
+    sorted_links = links[sorter]
+
+    def __to_positions(field: str) -> np.ndarray:
+        values = df[field].to_numpy(dtype=np.int64)
+        positions = np.full(len(values), -1, dtype=np.int64)
+        has_link = values > -1
+        found = np.searchsorted(sorted_links, values[has_link])
+        found = np.minimum(found, len(sorted_links) - 1)
+        matched = sorted_links[found] == values[has_link]
+        if not matched.all():
+            missing = values[has_link][~matched]
+            raise KeyError(
+                f"{len(missing)} {field} values are not in {LINK}, "
+                f"e.g. {missing[:5].tolist()}"
+            )
+        positions[has_link] = sorter[found]
+        return positions
+
+    return (
+        links,
+        __to_positions(DS_LINK),
+        __to_positions(US_LEFT),
+        __to_positions(US_RIGHT),
+    )
+
+
+def upstream_levels(
+    roots: np.ndarray,
+    us_left: np.ndarray,
+    us_right: np.ndarray,
+) -> list[np.ndarray]:
+    """Splits the stream network into levels by distance from its root
+
+    Parameters:
+        roots: np.ndarray
+            Row positions of the root reaches (DSLINKNO == -1).
+        us_left, us_right: np.ndarray
+            Row positions of the USLINKNO1 and USLINKNO2 reaches, or -1, as
+            returned by `link_positions`.
+    Returns:
+        list of np.ndarray:
+            Row positions for each level, starting with the roots and moving
+            upstream. Every reach reachable from a root is in exactly one level.
+
+    Raises:
+        ValueError: If a reach is reached from more than one downstream reach.
+    """
+    levels = [roots]
+    seen = np.zeros(len(us_left), dtype=bool)
+    seen[roots] = True
+    frontier = roots
+    while frontier.size:
+        frontier = np.concatenate((us_right[frontier], us_left[frontier]))
+        frontier = frontier[frontier > -1]
+        if seen[frontier].any() or len(np.unique(frontier)) != len(frontier):
+            raise ValueError("Stream network is not a tree; a reach was reached twice.")
+        seen[frontier] = True
+        levels.append(frontier)
+    return [level for level in levels if level.size]
+
+
+def __modified_nest_set_index_array(df: DataFrame) -> DataFrame:
+    """Computes the modified nested set index from NumPy adjacency arrays
+
+    The depth-first search in `__modified_nest_set_index_dict` visits
+    USLINKNO2 before USLINKNO1, and a reach's finish time is its discover
+    time plus the number of reaches in its subtree (itself included). This
+    lets the traversal be replaced by two vectorized sweeps over the tree's
+    levels: upward to count subtree sizes, then downward to hand out
+    discover times.
+    """
+    links, ds_pos, us_left, us_right = link_positions(df)
+    n = len(links)
+
+    roots = np.flatnonzero(ds_pos == -1)
+    levels = upstream_levels(roots, us_left, us_right)
+
+    # count elements in each subtree, from the headwaters down
+    size = np.ones(n, dtype=np.int64)
+    for level in reversed(levels):
+        left, right = us_left[level], us_right[level]
+        size[level] += np.where(left > -1, size[left], 0)
+        size[level] += np.where(right > -1, size[right], 0)
+
+    # the DFS clock, preallocated; 0 marks a reach not reached from any root.
+    # ROOT_ID holds LINKNOs, so it keeps their dtype
+    root_id = np.zeros(n, dtype=link_dtype(df))
+    discover = np.zeros(n, dtype=np.int32)
+    root_id[roots] = links[roots]
+    discover[roots] = 1
+    for level in levels:
+        left, right = us_left[level], us_right[level]
+        has_left, has_right = left > -1, right > -1
+        # USLINKNO2 is visited immediately after its downstream reach...
+        right_start = discover[level] + 1
+        discover[right[has_right]] = right_start[has_right]
+        # ...and USLINKNO1 once all of USLINKNO2's subtree is visited
+        left_start = right_start + np.where(has_right, size[right], 0)
+        discover[left[has_left]] = left_start[has_left]
+        root_id[right[has_right]] = root_id[level[has_right]]
+        root_id[left[has_left]] = root_id[level[has_left]]
+
+    unvisited = n - sum(len(level) for level in levels)
+    if unvisited:
+        raise ValueError(
+            f"{unvisited} reaches are not upstream of any root ({DS_LINK} == -1)."
+        )
+    finish = (discover + size).astype(np.int32)
+
+    # Add columns holding the output of the algorithm at the same locations
+    # as the original engine, right after other LINK info
+    for f, values in ((FINISH, finish), (DISCOVER, discover), (ROOT, root_id)):
+        df.insert(4, f, values)
+
+    return df
+
+
+def __modified_nest_set_index_dict(df: DataFrame) -> DataFrame:
+    """Computes the modified nested set index by a row-by-row traversal
+
+    This is the original implementation, which is kept so results from the
+    array engine can be checked against it.
+    """
 
     # Add additional columns to hold the output of modified nested set index algorithm
     # at column locations right after other LINK info 
@@ -96,7 +306,174 @@ def modified_nest_set_index(df: DataFrame) -> DataFrame:
     df_msni = DataFrame(nodes)
     df_msni = df_msni.transpose()
     for f in (ROOT, DISCOVER, FINISH):
-        df[f] = df_msni[f].astype('int32')
+        df[f] = df_msni[f].astype(df.index.dtype if f == ROOT else 'int32')
     df = df.reset_index()
 
     return df
+
+
+def link_dtype(df: DataFrame) -> np.dtype:
+    """dtype of LINKNO, which is either a field or the index of df"""
+    return df.index.dtype if df.index.name == LINK else df[LINK].dtype
+
+
+class MNSIIndex:
+    """Sorted (ROOT_ID, DISCOVER_TIME) index over a DataFrame with MNSI fields
+
+    Upstream sets are contiguous DISCOVER_TIME ranges within a ROOT_ID, so
+    once rows are sorted by (ROOT_ID, DISCOVER_TIME) the upstream set of any
+    link is found with two binary searches. If the DataFrame is already in
+    that order, the upstream set is a positional slice of it.
+
+    The index refers to row positions, so it must only be used with the
+    DataFrame it was built from, or one with the same row order.
+    """
+
+    def __init__(self, df: DataFrame) -> None:
+        """
+        Parameters:
+            df: DataFrame
+                A DataFrame with MNSI fields and LINKNO as index.
+        """
+        root = df[ROOT].to_numpy(dtype=np.int64)
+        discover = df[DISCOVER].to_numpy(dtype=np.int64)
+        # global ROOT_IDs may exceed int32, so keys use the rank of each root
+        self.__roots, root_rank = np.unique(root, return_inverse=True)
+        keys = self.__to_keys(root_rank.ravel(), discover)
+
+        self.__order = np.argsort(keys, kind="stable")
+        self.__sorted_keys = keys[self.__order]
+        self.__is_sorted = bool((np.diff(keys) >= 0).all())
+        self.__root = root
+        self.__discover = discover
+        self.__finish = df[FINISH].to_numpy(dtype=np.int64)
+
+        links = df.index.to_numpy(dtype=np.int64)
+        self.__link_order = np.argsort(links, kind="stable")
+        self.__sorted_links = links[self.__link_order]
+
+    def __len__(self) -> int:
+        return len(self.__order)
+
+    @property
+    def is_sorted(self) -> bool:
+        """True if the DataFrame rows are in (ROOT_ID, DISCOVER_TIME) order"""
+        return self.__is_sorted
+
+    @property
+    def order(self) -> np.ndarray:
+        """Row positions that sort the DataFrame by (ROOT_ID, DISCOVER_TIME)"""
+        return self.__order
+
+    @staticmethod
+    def __to_keys(root: np.ndarray, discover: np.ndarray) -> np.ndarray:
+        # root ranks and DISCOVER_TIME are less than 2**31, so they pack
+        # into one int64 key
+        return (root << 32) | discover
+
+    def position(self, linkid: int) -> int:
+        """Row position of linkid
+
+        Raises:
+            KeyError: If linkid is not in the index.
+        """
+        i = np.searchsorted(self.__sorted_links, linkid)
+        if i == len(self.__sorted_links) or self.__sorted_links[i] != linkid:
+            raise KeyError(linkid)
+        return self.__link_order[i]
+
+    def positions(self, linkids: np.ndarray) -> np.ndarray:
+        """Row positions of many linkids, vectorized `position`
+
+        Raises:
+            KeyError: If any linkid is not in the index.
+        """
+        linkids = np.asarray(linkids, dtype=np.int64)
+        i = np.searchsorted(self.__sorted_links, linkids)
+        found = i < len(self.__sorted_links)
+        found[found] = self.__sorted_links[i[found]] == linkids[found]
+        if not found.all():
+            raise KeyError(linkids[~found][:10].tolist())
+        return self.__link_order[i]
+
+    def upstream_ranges(
+        self,
+        linkids: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Starts and stops of upstream sets in (ROOT_ID, DISCOVER_TIME) order,
+        vectorized `upstream_range`.
+
+        Parameters:
+            linkids: Links to find the upstream sets of. Defaults to every
+                row, in row order.
+
+        Returns: A tuple of arrays of starts and stops.
+        """
+        if linkids is None:
+            positions = slice(None)
+        else:
+            positions = self.positions(linkids)
+        root = self.__root[positions]
+        rank = np.searchsorted(self.__roots, root)
+        starts = np.searchsorted(
+            self.__sorted_keys, self.__to_keys(rank, self.__discover[positions]),
+        )
+        stops = np.searchsorted(
+            self.__sorted_keys, self.__to_keys(rank, self.__finish[positions]),
+        )
+        return (starts, stops)
+
+    def __range(self, root_id: int, discover_time: int, finish_time: int) -> tuple[int, int]:
+        rank = np.searchsorted(self.__roots, root_id)
+        if rank == len(self.__roots) or self.__roots[rank] != root_id:
+            return (0, 0)
+        start, stop = np.searchsorted(
+            self.__sorted_keys,
+            self.__to_keys(
+                np.array([rank, rank], dtype=np.int64),
+                np.array([discover_time, finish_time], dtype=np.int64),
+            ),
+        )
+        return (int(start), int(stop))
+
+    def __positions(self, start: int, stop: int) -> slice | np.ndarray:
+        if self.__is_sorted:
+            return slice(start, stop)
+        return self.__order[start:stop]
+
+    def upstream_range(self, linkid: int) -> tuple[int, int]:
+        """Start and stop of linkid's upstream set, in (ROOT_ID, DISCOVER_TIME) order"""
+        i = self.position(linkid)
+        return self.__range(self.__root[i], self.__discover[i], self.__finish[i])
+
+    def upstream_positions(self, linkid: int) -> slice | np.ndarray:
+        """Row positions of all elements upstream of linkid, itself included
+
+        Returns:
+            slice | np.ndarray: A slice if the DataFrame is sorted by
+                (ROOT_ID, DISCOVER_TIME), otherwise an array of positions.
+        """
+        return self.__positions(*self.upstream_range(linkid))
+
+    def upstream_count(self, linkid: int) -> int:
+        """Number of elements upstream of linkid, itself included"""
+        start, stop = self.upstream_range(linkid)
+        return stop - start
+
+    def range_positions(
+        self,
+        root_id: int,
+        discover_time: int,
+        finish_time: int,
+    ) -> slice | np.ndarray:
+        """Row positions with ROOT_ID == root_id and DISCOVER_TIME in
+        [discover_time, finish_time), i.e. within an upstream set given by its
+        MNSI fields rather than by LINKNO.
+        """
+        return self.__positions(*self.__range(root_id, discover_time, finish_time))
+
+    def subset(self, df: DataFrame, linkid: int) -> DataFrame:
+        """Subset df to the elements upstream of linkid"""
+        if len(df) != len(self):
+            raise ValueError("DataFrame does not match the MNSIIndex it is used with.")
+        return df.iloc[self.upstream_positions(linkid)]
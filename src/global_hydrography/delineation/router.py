@@ -0,0 +1,292 @@
+'''Global Hydrography (gh) routing of lat/lon locations to their TDX Hydro
+Region, with processed regions loaded on demand into a memory-bounded cache.
+'''
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+logger = logging.getLogger(__name__)
+
+HYBAS_ID = "HYBAS_ID"
+BASINS_DATASET = "streamreach_basins_mnsi"
+# Seconds between checks of a cached region's file for changes
+FINGERPRINT_CHECK_INTERVAL = 5.0
+
+
+def region_parquet_path(
+    directory: Path,
+    tdx_hydro_region: int,
+    dataset: str = BASINS_DATASET,
+) -> Path:
+    """Path of a processed GeoParquet file, as named by `batch_process`"""
+    return Path(directory) / f"TDX_{dataset}_{tdx_hydro_region}_01.parquet"
+
+
+def parquet_fingerprint(path: Path) -> str:
+    """Fingerprint of a file from its size and modification time, which
+    changes whenever `batch_process` rewrites the file"""
+    stat = os.stat(path)
+    return hashlib.sha1(
+        f"{stat.st_size}-{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+
+
+def estimate_memory_usage(gdf: gpd.GeoDataFrame) -> int:
+    """Estimate the bytes held by a GeoDataFrame, including its geometries
+
+    `memory_usage(deep=True)` only counts the pointers to shapely geometries,
+    so geometries are estimated from their number of coordinates.
+    """
+    attributes = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True).sum()
+    coordinates = shapely.get_num_coordinates(gdf.geometry.values).sum()
+    # 16 bytes per xy coordinate, plus about 100 bytes of GEOS overhead per geometry
+    return int(attributes + 16 * coordinates + 100 * len(gdf))
+
+
+class RegionRouter:
+    """Find the TDX Hydro Region of any lat/lon and load its processed basins
+
+    Regions are located with the HydroBASINS Level 2 polygons that
+    `io.TDXHydroDownloader.get_hybas_ids` downloads, whose HYBAS_IDs are the
+    10-digit TDX Hydro Region codes. Processed basins are read from the
+    `batch_process` outputs when first needed and kept in a least recently
+    used cache, evicting regions once their estimated size exceeds the
+    memory budget. Concurrent requests for a region that is not yet loaded
+    wait for a single load. Each region is kept with the `parquet_fingerprint`
+    of the file it was read from, and is reloaded when the file's
+    fingerprint changes, as when `batch_process` rewrites it. The file is
+    checked at most once per fingerprint_interval seconds per region, and
+    outside the lock, so cache hits don't wait on the filesystem.
+    """
+
+    def __init__(
+        self,
+        processed_dir: Path,
+        hydrobasins_path: Path,
+        memory_budget: int = 8 * 2**30,
+        dataset: str = BASINS_DATASET,
+        fingerprint_interval: float = FINGERPRINT_CHECK_INTERVAL,
+    ) -> None:
+        """
+        Parameters:
+            processed_dir: Directory of processed GeoParquet ('.parquet') files.
+            hydrobasins_path: Path to the HydroBASINS Level 2 GeoJSON.
+            memory_budget: Bytes of loaded regions to keep cached.
+                Defaults to 8 GiB.
+            dataset: Name of the processed dataset to load for each region.
+            fingerprint_interval: Seconds between checks of a cached region's
+                file for changes. 0 checks on every request.
+        """
+        self.__processed_dir = Path(processed_dir)
+        self.__dataset = dataset
+        self.__memory_budget = memory_budget
+        self.__fingerprint_interval = fingerprint_interval
+
+        self.__hydrobasins_gdf = gpd.read_file(
+            hydrobasins_path, columns=[HYBAS_ID], engine="pyogrio",
+        )
+
+        self.__lock = threading.Lock()
+        self.__cache: OrderedDict[int, tuple[gpd.GeoDataFrame, str]] = OrderedDict()
+        self.__sizes: dict[int, int] = {}
+        self.__loading: dict[int, Future] = {}
+        # time.monotonic() of the last fingerprint check of each cached region
+        self.__checked: dict[int, float] = {}
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def memory_budget(self) -> int:
+        return self.__memory_budget
+
+    @property
+    def memory_usage(self) -> int:
+        """Estimated bytes of all cached regions"""
+        with self.__lock:
+            return sum(self.__sizes.values())
+
+    @property
+    def cached_regions(self) -> list[int]:
+        """Cached regions, from least to most recently used"""
+        with self.__lock:
+            return list(self.__cache)
+
+    @property
+    def cache_stats(self) -> dict:
+        """Requests for regions that were cached (hits) or loaded or waited
+        for (misses), and the regions and bytes cached"""
+        with self.__lock:
+            requests = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / requests if requests else None,
+                "cached_regions": list(self.__cache),
+                "memory_usage": sum(self.__sizes.values()),
+                "memory_budget": self.__memory_budget,
+            }
+
+    def get_region_by_latlon(self, lat: float, lon: float) -> int:
+        """Finds the TDX Hydro Region containing the latitude and longitude.
+
+        A point on the boundary between regions is assigned to the region
+        with the lowest HYBAS_ID.
+
+        Raises:
+            ValueError: If no region contains the point.
+        """
+        idx = self.__hydrobasins_gdf.sindex.query(
+            shapely.Point(lon, lat), predicate="intersects",
+        )
+        if not len(idx):
+            raise ValueError(f"No TDX Hydro Region found at lat={lat}, lon={lon}.")
+        return int(np.min(self.__hydrobasins_gdf[HYBAS_ID].to_numpy()[idx]))
+
+    def get_basins_by_latlon(
+        self,
+        lat: float,
+        lon: float,
+    ) -> tuple[int, gpd.GeoDataFrame]:
+        """Finds the TDX Hydro Region of a lat/lon and returns its basins.
+
+        Returns:
+            tuple: the 10-digit TDX Hydro Region and its basins GeoDataFrame.
+        """
+        region = self.get_region_by_latlon(lat, lon)
+        return (region, self.get_region(region))
+
+    def get_region(self, tdx_hydro_region: int) -> gpd.GeoDataFrame:
+        """Returns a region's processed basins, loading them if needed.
+
+        The returned GeoDataFrame is shared with other callers and must not
+        be modified.
+        """
+        return self.get_region_with_fingerprint(tdx_hydro_region)[0]
+
+    def get_region_with_fingerprint(
+        self,
+        tdx_hydro_region: int,
+    ) -> tuple[gpd.GeoDataFrame, str]:
+        """Returns a region's processed basins, loading them if needed, and
+        the `parquet_fingerprint` of the file they were read from.
+
+        The fingerprint is that of the returned GeoDataFrame, rather than of
+        the file now, so results derived from the frame are cached under the
+        file they came from.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__cache.get(tdx_hydro_region)
+            if entry is not None and (
+                now - self.__checked[tdx_hydro_region] < self.__fingerprint_interval
+            ):
+                return self.__hit(tdx_hydro_region)
+
+        # stat the file without the lock, so other requests don't wait on it
+        changed = entry is not None and self.__changed(tdx_hydro_region, entry[1])
+
+        with self.__lock:
+            current = self.__cache.get(tdx_hydro_region)
+            if current is not None and current is not entry:
+                # another request loaded the region meanwhile
+                return self.__hit(tdx_hydro_region)
+            if current is not None and not changed:
+                self.__checked[tdx_hydro_region] = now
+                return self.__hit(tdx_hydro_region)
+            if current is not None:
+                logger.info(f"TDX Hydro Region {tdx_hydro_region} changed on disk")
+                self.__remove(tdx_hydro_region)
+            self.__misses += 1
+            future = self.__loading.get(tdx_hydro_region)
+            is_loader = future is None
+            if is_loader:
+                future = Future()
+                self.__loading[tdx_hydro_region] = future
+
+        # another request is already loading this region, so wait for it
+        if not is_loader:
+            return future.result()
+
+        try:
+            entry = self.__load(tdx_hydro_region)
+        except Exception as e:
+            with self.__lock:
+                del self.__loading[tdx_hydro_region]
+            future.set_exception(e)
+            raise
+
+        with self.__lock:
+            self.__cache[tdx_hydro_region] = entry
+            self.__sizes[tdx_hydro_region] = estimate_memory_usage(entry[0])
+            self.__checked[tdx_hydro_region] = time.monotonic()
+            self.__evict()
+            del self.__loading[tdx_hydro_region]
+        future.set_result(entry)
+        return entry
+
+    def region_path(self, tdx_hydro_region: int) -> Path:
+        """Path of a region's processed GeoParquet file"""
+        return region_parquet_path(
+            self.__processed_dir, tdx_hydro_region, self.__dataset,
+        )
+
+    def evict(self, tdx_hydro_region: int) -> None:
+        """Remove a region from the cache, if present"""
+        with self.__lock:
+            if tdx_hydro_region in self.__cache:
+                self.__remove(tdx_hydro_region)
+
+    def __load(self, tdx_hydro_region: int) -> tuple[gpd.GeoDataFrame, str]:
+        path = self.region_path(tdx_hydro_region)
+        logger.info(f"Loading TDX Hydro Region {tdx_hydro_region} from {path}")
+        # fingerprint first, so a rewrite while reading changes it afterwards
+        fingerprint = parquet_fingerprint(path)
+        gdf = gpd.read_parquet(path)
+        # build the spatial index now, so it is cached with the region
+        gdf.sindex
+        return (gdf, fingerprint)
+
+    def __hit(self, tdx_hydro_region: int) -> tuple[gpd.GeoDataFrame, str]:
+        """Count a hit on a cached region and return it. Must be called
+        holding the lock."""
+        self.__hits += 1
+        self.__cache.move_to_end(tdx_hydro_region)
+        return self.__cache[tdx_hydro_region]
+
+    def __remove(self, tdx_hydro_region: int) -> None:
+        """Remove a cached region. Must be called holding the lock."""
+        del self.__cache[tdx_hydro_region]
+        del self.__sizes[tdx_hydro_region]
+        del self.__checked[tdx_hydro_region]
+
+    def __changed(self, tdx_hydro_region: int, fingerprint: str) -> bool:
+        """True if the region's file no longer has the fingerprint. A file
+        missing while it is being replaced is not treated as changed."""
+        try:
+            return parquet_fingerprint(self.region_path(tdx_hydro_region)) != fingerprint
+        except FileNotFoundError:
+            return False
+
+    def __evict(self) -> None:
+        """Evict least recently used regions until within the memory budget.
+
+        Must be called holding the lock. The most recently used region is
+        never evicted, even if it alone exceeds the budget.
+        """
+        while (
+            len(self.__cache) > 1
+            and sum(self.__sizes.values()) > self.__memory_budget
+        ):
+            region = next(iter(self.__cache))
+            self.__remove(region)
+            logger.info(f"Evicted TDX Hydro Region {region} from cache")
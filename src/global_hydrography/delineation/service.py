@@ -0,0 +1,479 @@
+'''Global Hydrography (gh) watershed delineation service, answering lat/lon
+requests over HTTP from processed TDX Hydro Regions kept warm in memory.
+
+Run locally with:
+
+    python -m global_hydrography.delineation.service \\
+        --processed-dir TDX_MNSI_Output --hydrobasins hybas_lev02.geojson \\
+        --preload 4020024190 --port 8080
+
+Endpoints, all GET and returning JSON:
+    /linkno?lat=&lon=           The region and LINKNO of the basin at a point.
+    /upstream?lat=&lon=         The LINKNOs upstream of a point.
+    /watershed?lat=&lon=        The upstream watershed boundary, as GeoJSON.
+    /metrics                    Latency histograms and cache hit rates.
+    /health                     The regions loaded.
+
+/upstream and /watershed also accept `region=&linkno=` instead of a point.
+Regions are only read from local GeoParquet files, so the service can be run
+against small fixtures with no outside services.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import threading
+import time
+import weakref
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from aiohttp import web
+
+from global_hydrography.delineation.mnsi import LINK, MNSIIndex
+from global_hydrography.delineation.router import RegionRouter
+from global_hydrography.delineation.boundary_cache import BoundaryCache
+from global_hydrography.delineation.delineate import (
+    get_linkno_by_latlon,
+    get_watershed_boundary,
+    get_watershed_boundary_from_groups,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"),
+)
+# Endpoint of requests matching no route, whose paths are not kept, so
+# scans of arbitrary paths can't grow the metrics without bound
+UNMATCHED_ENDPOINT = "unmatched"
+DEFAULT_PORT = 8080
+DEFAULT_MAX_WORKERS = 4
+
+
+class LatencyHistogram:
+    """Counts of request latencies in fixed buckets, as Prometheus keeps them.
+
+    Quantiles are estimated as the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, buckets: tuple[float] = LATENCY_BUCKETS) -> None:
+        self.__buckets = buckets
+        self.__counts = [0] * len(buckets)
+        self.__sum = 0.0
+        self.__max = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.__counts)
+
+    def record(self, seconds: float) -> None:
+        self.__counts[bisect.bisect_left(self.__buckets, seconds)] += 1
+        self.__sum += seconds
+        self.__max = max(self.__max, seconds)
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the q quantile, or None if empty"""
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for bound, n in zip(self.__buckets, self.__counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return self.__buckets[-1]
+
+    def to_dict(self) -> dict:
+        count = self.count
+        return {
+            "count": count,
+            "mean_seconds": self.__sum / count if count else None,
+            "max_seconds": self.__max,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "p99_seconds": self.quantile(0.99),
+            # str bounds, as JSON has no infinity
+            "buckets": {
+                str(bound): n for bound, n in zip(self.__buckets, self.__counts)
+            },
+        }
+
+
+class DelineationService:
+    """Delineate watersheds from regions kept in memory by a RegionRouter
+
+    Regions are loaded by the router, and an MNSIIndex is built once for
+    each loaded region, so upstream sets are found with binary searches.
+    Point lookups, region loads and geometry unions block, so they run in a
+    thread pool, leaving the event loop free to accept requests. Shapely
+    releases the GIL while unioning, so unions run in parallel on threads
+    without copying region geometries to other processes.
+    """
+
+    def __init__(
+        self,
+        router: RegionRouter,
+        groups_router: RegionRouter | None = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_distance: float | None = None,
+        boundary_cache: BoundaryCache | None = None,
+    ) -> None:
+        """
+        Parameters:
+            router: Router loading the basins of each region.
+            groups_router: Router loading the dissolve groups of each region,
+                to delineate from pre-dissolved groups. See
+                `delineate.get_watershed_boundary_from_groups`.
+            max_workers: Number of threads running blocking work.
+            max_distance: See `delineate.get_linknos_by_latlon`.
+            boundary_cache: Cache of watershed boundaries, keyed by the
+                fingerprint of each region's basins file.
+        """
+        self.__router = router
+        self.__groups_router = groups_router
+        self.__boundary_cache = boundary_cache
+        self.__max_distance = max_distance
+        self.__executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="delineation",
+        )
+
+        # indexes of loaded regions, dropped once the router evicts a region
+        self.__lock = threading.Lock()
+        self.__indexes: dict[tuple[int, bool], tuple[weakref.ref, MNSIIndex]] = {}
+        self.__index_hits = 0
+        self.__index_misses = 0
+
+        self.__latency: dict[str, LatencyHistogram] = {}
+        self.__responses: dict[str, dict[int, int]] = {}
+
+    @property
+    def router(self) -> RegionRouter:
+        return self.__router
+
+    ## Blocking work, run in the thread pool ##
+
+    def locate(self, lat: float, lon: float) -> tuple[int, int]:
+        """The TDX Hydro Region and LINKNO of the basin at lat/lon
+
+        Raises:
+            ValueError: If no region or basin is found.
+        """
+        region, basins_gdf = self.__router.get_basins_by_latlon(lat, lon)
+        linkno = get_linkno_by_latlon(basins_gdf, lat, lon, self.__max_distance)
+        return (region, int(linkno))
+
+    def upstream(self, region: int, linkno: int) -> np.ndarray:
+        """LINKNOs upstream of linkno, itself included
+
+        Raises:
+            KeyError: If linkno is not in the region.
+        """
+        basins_gdf = self.__router.get_region(region)
+        index = self.__index(region, basins_gdf)
+        return basins_gdf.index.to_numpy()[index.upstream_positions(linkno)]
+
+    def watershed(self, region: int, linkno: int) -> tuple[shapely.Geometry, int]:
+        """The watershed boundary upstream of linkno, and its number of basins
+
+        Raises:
+            KeyError: If linkno is not in the region.
+        """
+        basins_gdf, fingerprint = self.__router.get_region_with_fingerprint(region)
+        index = self.__index(region, basins_gdf)
+        count = index.upstream_count(linkno)
+        if self.__boundary_cache is not None:
+            boundary = self.__boundary_cache.get(region, linkno, fingerprint)
+            if boundary is None:
+                boundary = self.__delineate(region, linkno, basins_gdf, index)
+                self.__boundary_cache.put(region, linkno, fingerprint, boundary)
+        else:
+            boundary = self.__delineate(region, linkno, basins_gdf, index)
+        return (boundary, count)
+
+    def __delineate(
+        self,
+        region: int,
+        linkno: int,
+        basins_gdf: gpd.GeoDataFrame,
+        index: MNSIIndex,
+    ) -> shapely.Geometry:
+        if self.__groups_router is not None:
+            groups_gdf = self.__groups_router.get_region(region)
+            boundary = get_watershed_boundary_from_groups(
+                basins_gdf, groups_gdf, linkno,
+                index, self.__index(region, groups_gdf, groups=True),
+            )
+        else:
+            boundary = get_watershed_boundary(index.subset(basins_gdf, linkno))
+        return boundary
+
+    def preload(self, regions: list[int]) -> None:
+        """Load regions and build their indexes before serving requests"""
+        for region in regions:
+            self.__index(region, self.__router.get_region(region))
+            if self.__groups_router is not None:
+                groups_gdf = self.__groups_router.get_region(region)
+                self.__index(region, groups_gdf, groups=True)
+            logger.info(f"Preloaded TDX Hydro Region {region}")
+
+    def __index(
+        self,
+        region: int,
+        gdf: gpd.GeoDataFrame,
+        groups: bool = False,
+    ) -> MNSIIndex:
+        """The MNSIIndex of gdf, built if gdf is not the frame last indexed"""
+        key = (region, groups)
+        with self.__lock:
+            ref, index = self.__indexes.get(key, (None, None))
+            if ref is not None and ref() is gdf:
+                self.__index_hits += 1
+                return index
+            self.__index_misses += 1
+        # build outside the lock; concurrent builds of one region are rare
+        # and only cost time
+        index = MNSIIndex(gdf)
+        with self.__lock:
+            # drop indexes whose regions were evicted
+            self.__indexes = {
+                k: v for k, v in self.__indexes.items() if v[0]() is not None
+            }
+            self.__indexes[key] = (weakref.ref(gdf), index)
+        return index
+
+    ## Metrics ##
+
+    def record(self, endpoint: str, seconds: float, status: int) -> None:
+        """Record the latency and status of a request to an endpoint, the
+        canonical path of its route. Not thread safe, so only called from
+        the event loop."""
+        self.__latency.setdefault(endpoint, LatencyHistogram()).record(seconds)
+        statuses = self.__responses.setdefault(endpoint, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def metrics(self) -> dict:
+        with self.__lock:
+            requests = self.__index_hits + self.__index_misses
+            index_stats = {
+                "hits": self.__index_hits,
+                "misses": self.__index_misses,
+                "hit_rate": self.__index_hits / requests if requests else None,
+            }
+        metrics = {
+            "latency": {
+                endpoint: histogram.to_dict()
+                for endpoint, histogram in self.__latency.items()
+            },
+            "responses": self.__responses,
+            "region_cache": self.__router.cache_stats,
+            "index_cache": index_stats,
+        }
+        if self.__groups_router is not None:
+            metrics["groups_cache"] = self.__groups_router.cache_stats
+        if self.__boundary_cache is not None:
+            metrics["boundary_cache"] = self.__boundary_cache.stats
+        return metrics
+
+    ## Asynchronous interface ##
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Run blocking func in the thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, func, *args)
+
+    def close(self) -> None:
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        # keep request counts, to precompute the most requested boundaries
+        cache = self.__boundary_cache
+        if cache is not None and cache.cache_dir is not None:
+            cache.save_request_counts()
+
+
+# Key of the DelineationService in the aiohttp Application
+SERVICE_KEY = web.AppKey("service", DelineationService)
+
+
+def create_app(
+    service: DelineationService,
+    preload: list[int] = (),
+) -> web.Application:
+    """The aiohttp Application serving a DelineationService.
+
+    Parameters:
+        service: The service answering requests.
+        preload: Regions to load on startup, before requests are served.
+    """
+    app = web.Application(middlewares=[__metrics_middleware])
+    app[SERVICE_KEY] = service
+    app.router.add_get("/linkno", __linkno)
+    app.router.add_get("/upstream", __upstream)
+    app.router.add_get("/watershed", __watershed)
+    app.router.add_get("/metrics", __metrics)
+    app.router.add_get("/health", __health)
+
+    async def on_startup(app: web.Application) -> None:
+        if preload:
+            await service.run(service.preload, list(preload))
+
+    async def on_cleanup(app: web.Application) -> None:
+        service.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+@web.middleware
+async def __metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Record the latency of every request by its route, and answer lookup
+    errors as 404"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        try:
+            response = await handler(request)
+        except (KeyError, ValueError, FileNotFoundError) as e:
+            raise web.HTTPNotFound(
+                text=json.dumps({"error": f"{type(e).__name__}: {e}"}),
+                content_type="application/json",
+            )
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request.app[SERVICE_KEY].record(
+            __endpoint(request), time.perf_counter() - start, status,
+        )
+
+
+def __endpoint(request: web.Request) -> str:
+    """The canonical path of the route a request matched, or
+    UNMATCHED_ENDPOINT"""
+    resource = request.match_info.route.resource
+    if resource is None:
+        return UNMATCHED_ENDPOINT
+    return resource.canonical
+
+
+def __float_param(request: web.Request, name: str) -> float:
+    try:
+        return float(request.query[name])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(reason=f"'{name}' must be a number")
+
+
+async def __target(request: web.Request) -> tuple[int, int]:
+    """The (region, LINKNO) of a request, by `region` and `linkno`, or by
+    `lat` and `lon`"""
+    service = request.app[SERVICE_KEY]
+    if "linkno" in request.query:
+        try:
+            return (int(request.query["region"]), int(request.query["linkno"]))
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(
+                reason="'region' and 'linkno' must both be integers",
+            )
+    lat, lon = __float_param(request, "lat"), __float_param(request, "lon")
+    return await service.run(service.locate, lat, lon)
+
+
+async def __linkno(request: web.Request) -> web.Response:
+    service = request.app[SERVICE_KEY]
+    lat, lon = __float_param(request, "lat"), __float_param(request, "lon")
+    region, linkno = await service.run(service.locate, lat, lon)
+    return web.json_response({"region": region, LINK: linkno})
+
+
+async def __upstream(request: web.Request) -> web.Response:
+    service = request.app[SERVICE_KEY]
+    region, linkno = await __target(request)
+    linknos = await service.run(service.upstream, region, linkno)
+    return web.json_response({
+        "region": region,
+        LINK: linkno,
+        "count": len(linknos),
+        "upstream": linknos.tolist(),
+    })
+
+
+async def __watershed(request: web.Request) -> web.Response:
+    service = request.app[SERVICE_KEY]
+    region, linkno = await __target(request)
+    boundary, count = await service.run(service.watershed, region, linkno)
+    # GeoJSON is serialized by GEOS, rather than via Python dicts
+    return web.Response(
+        text=(
+            f'{{"type": "Feature", "geometry": {shapely.to_geojson(boundary)}, '
+            f'"properties": {{"region": {region}, "{LINK}": {linkno}, '
+            f'"count": {count}}}}}'
+        ),
+        content_type="application/geo+json",
+    )
+
+
+async def __metrics(request: web.Request) -> web.Response:
+    return web.json_response(request.app[SERVICE_KEY].metrics())
+
+
+async def __health(request: web.Request) -> web.Response:
+    service = request.app[SERVICE_KEY]
+    return web.json_response({
+        "status": "ok", "regions": service.router.cached_regions,
+    })
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processed-dir", type=Path, required=True)
+    parser.add_argument("--hydrobasins", type=Path, required=True)
+    parser.add_argument("--preload", type=int, nargs="*", default=[])
+    parser.add_argument(
+        "--groups", action="store_true",
+        help="delineate from the dissolve groups pyramid",
+    )
+    parser.add_argument("--memory-budget", type=float, default=8, help="GiB")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--max-distance", type=float, default=None)
+    parser.add_argument(
+        "--boundary-cache-dir", type=Path, default=None,
+        help="cache watershed boundaries on disk, as well as in memory",
+    )
+    parser.add_argument(
+        "--boundary-cache-memory", type=float, default=1,
+        help="GiB of cached boundaries kept in memory, 0 to disable",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    router = RegionRouter(
+        args.processed_dir, args.hydrobasins, int(args.memory_budget * 2**30),
+    )
+    groups_router = RegionRouter(
+        args.processed_dir, args.hydrobasins, int(args.memory_budget * 2**30),
+        dataset="dissolve_groups",
+    ) if args.groups else None
+    boundary_cache = BoundaryCache(
+        args.boundary_cache_dir, int(args.boundary_cache_memory * 2**30),
+    ) if args.boundary_cache_dir or args.boundary_cache_memory else None
+    service = DelineationService(
+        router, groups_router, args.max_workers, args.max_distance,
+        boundary_cache,
+    )
+    web.run_app(create_app(service, args.preload), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
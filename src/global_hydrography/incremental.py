@@ -0,0 +1,423 @@
+'''Global Hydrography incremental reprocessing, which skips the stages of a
+region whose inputs did not change.
+
+Stage outputs are kept in a content addressed cache, under a key that hashes
+the stage's inputs and parameters, so a stage is skipped when an output with
+its key exists. Raw GeoPackages are keyed by a content hash, which is only
+recomputed when a file's size, mtime or DBF_DATE_LAST_UPDATE changes.
+
+MNSI and dissolve group fields only depend on the tree (ROOT_ID) of each
+reach, so when the topology of a region changes, only the trees with a
+changed, added or removed reach are recomputed, and the fields of the other
+trees are carried forward from the previous output.
+'''
+
+from typing import Callable
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import geopandas as gpd
+import pyarrow.parquet as pq
+import pyogrio
+
+from global_hydrography.check_files import file_hash
+from global_hydrography.delineation.mnsi import (
+    LINK, DS_LINK, US_LEFT, US_RIGHT, ROOT, MNSI_FIELDS, ELEMENT_COUNT,
+    dissolve_root_field, modified_nest_set_index,
+)
+from global_hydrography.process import (
+    DISSOLVE_LEVELS, compute_nested_dissolve_groups, match_basins_to_streams,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bump to invalidate every cached stage output, e.g. when processing changes
+CACHE_VERSION = 1
+CACHE_DIRNAME = "cache"
+CACHE_MANIFEST = "stages.json"
+LAST_UPDATE = "DBF_DATE_LAST_UPDATE"
+
+TOPOLOGY_FIELDS = [LINK, DS_LINK, US_LEFT, US_RIGHT]
+
+# Stages cached by this module. See also `StageCache.cached` and
+# `StageCache.record` for stages cached by the caller.
+MNSI_STAGE = "mnsi"
+DISSOLVE_STAGE = "dissolve_groups"
+
+
+def cache_dir(output_dir: Path, tdx_hydro_region: int) -> Path:
+    """Directory of a region's stage cache, within the output directory"""
+    return Path(output_dir) / CACHE_DIRNAME / str(tdx_hydro_region)
+
+
+def hash_key(*parts) -> str:
+    """Key of JSON serializable parts, such as a stage name, the keys of its
+    inputs and its parameters"""
+    data = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def frame_hash(df: DataFrame, fields: list[str]) -> str:
+    """Hash of the values of fields, in row order. Fields may include the
+    index, e.g. LINKNO."""
+    digest = hashlib.sha256()
+    for field in fields:
+        digest.update(pd.util.hash_array(field_values(df, field)).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def field_values(df: DataFrame, field: str) -> np.ndarray:
+    """Values of a field, which is either a column or the index of df"""
+    return df.index.to_numpy() if df.index.name == field else df[field].to_numpy()
+
+
+def file_signature(file_path: Path) -> dict:
+    """Size, mtime and DBF_DATE_LAST_UPDATE of a GeoPackage, which are read
+    without reading its features"""
+    stat = Path(file_path).stat()
+    info = pyogrio.read_info(file_path, layer=0)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        LAST_UPDATE: (info['layer_metadata'] or {}).get(LAST_UPDATE),
+    }
+
+
+class StageCache:
+    """Content addressed cache of the stage outputs of one region
+
+    Outputs are saved as Parquet files named by stage and key, and only the
+    latest output of each stage is kept. A manifest records the key and
+    parameters of each stage's latest output, so a stage whose key changed
+    can still carry forward parts of its previous output, and the content
+    hashes of input files, so unchanged files are not hashed again.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        hash_algorithm: str | None = 'sha256',
+    ) -> None:
+        """
+        Parameters:
+            directory: Directory of the cache, e.g. from `cache_dir`.
+            hash_algorithm: Algorithm of input file hashes. If None, files
+                are keyed by their size, mtime and DBF_DATE_LAST_UPDATE.
+        """
+        self.__dir = Path(directory)
+        self.__dir.mkdir(parents=True, exist_ok=True)
+        self.__hash_algorithm = hash_algorithm
+        self.__manifest_path = self.__dir / CACHE_MANIFEST
+        if self.__manifest_path.exists():
+            with open(self.__manifest_path) as f:
+                self.__manifest = json.load(f)
+        else:
+            self.__manifest = {'files': {}, 'stages': {}}
+
+    @property
+    def directory(self) -> Path:
+        return self.__dir
+
+    def file_key(self, file_path: Path) -> str:
+        """Key of an input file's content"""
+        file_path = Path(file_path)
+        signature = file_signature(file_path)
+        if not self.__hash_algorithm:
+            return hash_key(signature)
+        entry = self.__manifest['files'].get(file_path.name)
+        if entry is None or entry['signature'] != signature:
+            digest = file_hash(file_path, self.__hash_algorithm)
+            entry = {
+                'signature': signature,
+                'hash': f"{self.__hash_algorithm}:{digest}",
+            }
+            self.__manifest['files'][file_path.name] = entry
+            self.__save_manifest()
+        return entry['hash']
+
+    def key(self, stage: str) -> str | None:
+        """Key of the latest output of stage, if any"""
+        return self.__manifest['stages'].get(stage, {}).get('key')
+
+    def path(self, stage: str, key: str) -> Path:
+        """Path of the cached output of stage with key"""
+        return self.__dir / f"{stage}_{key}.parquet"
+
+    def read(self, stage: str, key: str) -> DataFrame | None:
+        """Cached output of stage with key, or None if not cached"""
+        path = self.path(stage, key)
+        if not path.exists():
+            return None
+        if b'geo' in (pq.read_schema(path).metadata or {}):
+            return gpd.read_parquet(path)
+        return pd.read_parquet(path)
+
+    def write(self, stage: str, key: str, df: DataFrame, **params) -> Path:
+        """Cache the output of stage with key, replacing its previous output
+
+        Parameters:
+            stage: Name of the stage.
+            key: Key of the stage's inputs and parameters, e.g. from `hash_key`.
+            df: The output.
+            params: JSON serializable parameters of the stage, which must
+                match for the output to be carried forward. See `previous`.
+        """
+        path = self.path(stage, key)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        df.to_parquet(temp_path, compression='zstd')
+        os.replace(temp_path, path)
+        previous_key = self.key(stage)
+        if previous_key is not None and previous_key != key:
+            self.path(stage, previous_key).unlink(missing_ok=True)
+        self.__manifest['stages'][stage] = {
+            'key': key, 'params': self.__to_json(params),
+        }
+        self.__save_manifest()
+        return path
+
+    def cached(
+        self,
+        stage: str,
+        key: str,
+        compute: Callable[[], DataFrame],
+        **params,
+    ) -> DataFrame:
+        """Cached output of stage with key, or else the output of compute,
+        which is then cached"""
+        df = self.read(stage, key)
+        if df is not None:
+            logger.info(f"Reusing {stage} {key}")
+            return df
+        df = compute()
+        self.write(stage, key, df, **params)
+        return df
+
+    def previous(self, stage: str, **params) -> DataFrame | None:
+        """The latest output of stage, if it has the same parameters"""
+        entry = self.__manifest['stages'].get(stage)
+        if entry is None or entry['params'] != self.__to_json(params):
+            return None
+        return self.read(stage, entry['key'])
+
+    def outputs(self, stage: str, key: str) -> list[Path] | None:
+        """Output files recorded for stage with key by `record`, if they all
+        exist unchanged, or None"""
+        entry = self.__manifest['stages'].get(stage)
+        if entry is None or entry['key'] != key:
+            return None
+        for path, (size, mtime) in entry['outputs'].items():
+            path = Path(path)
+            if not path.exists():
+                return None
+            stat = path.stat()
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                return None
+        return [Path(path) for path in entry['outputs']]
+
+    def record(self, stage: str, key: str, paths: list[Path], **params) -> None:
+        """Record output files of stage with key, written outside the cache"""
+        outputs = {}
+        for path in paths:
+            stat = Path(path).stat()
+            outputs[str(path)] = [stat.st_size, stat.st_mtime]
+        self.__manifest['stages'][stage] = {
+            'key': key, 'params': self.__to_json(params), 'outputs': outputs,
+        }
+        self.__save_manifest()
+
+    @staticmethod
+    def __to_json(params: dict) -> dict:
+        # as read back from the manifest, e.g. with tuples as lists
+        return json.loads(json.dumps(params))
+
+    def __save_manifest(self) -> None:
+        # replaced atomically, as in `batch_process.save_manifest`
+        temp_path = self.__manifest_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.__manifest, f, indent=2)
+        os.replace(temp_path, self.__manifest_path)
+
+
+def untouched_rows(
+    df: DataFrame,
+    previous: DataFrame,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rows of the trees of previous whose topology is the same in df.
+
+    A tree is changed if any of its reaches was removed, or has different
+    upstream or downstream links, or if it is linked to by a new or changed
+    reach. The rows of all other trees are the same in both, so the
+    remaining rows of df form whole trees.
+
+    Parameters:
+        df: Stream Network with topology fields, and LINKNO as a field or
+            the index.
+        previous: A previous version, with topology fields and ROOT_ID, and
+            LINKNO as index.
+
+    Returns: A tuple of arrays of matching row positions
+        df_positions: Rows of df in untouched trees.
+        previous_positions: The same rows in previous.
+    """
+    previous_links = previous.index.to_numpy()
+    # match rows of df to previous rows by LINKNO, as basins to streams
+    match = match_basins_to_streams(field_values(df, LINK), previous_links)
+    same = np.ones(len(match.basins), dtype=bool)
+    for field in TOPOLOGY_FIELDS[1:]:
+        same &= (
+            field_values(df, field)[match.basins]
+            == previous[field].to_numpy()[match.streams]
+        )
+
+    # reaches linked to by new or changed reaches are in their trees
+    new_or_changed = np.concatenate((match.basins[~same], match.basins_no_stream))
+    linked = np.concatenate([
+        field_values(df, field)[new_or_changed] for field in TOPOLOGY_FIELDS[1:]
+    ])
+    linked = match_basins_to_streams(linked[linked > -1], previous_links).streams
+
+    previous_root = previous[ROOT].to_numpy()
+    changed_roots = np.unique(previous_root[
+        np.concatenate((match.streams[~same], match.streams_no_basin, linked))
+    ])
+    untouched = same & ~np.isin(previous_root[match.streams], changed_roots)
+    logger.info(
+        f"{len(changed_roots)} of {len(np.unique(previous_root))} trees changed, "
+        f"{len(match.basins_no_stream)} reaches added, "
+        f"{len(match.streams_no_basin)} removed"
+    )
+    return (match.basins[untouched], match.streams[untouched])
+
+
+def update_fields(
+    df: DataFrame,
+    previous: DataFrame | None,
+    compute: Callable[[DataFrame], DataFrame],
+    fields: list[str],
+) -> DataFrame:
+    """Adds fields to a Stream Network, computing them only for the trees
+    that changed since previous, and carrying forward the rest.
+
+    Parameters:
+        df: Stream Network with topology fields, and LINKNO as a field or
+            the index.
+        previous: The fields of a previous version, with topology fields and
+            ROOT_ID, and LINKNO as index. If None, all fields are computed.
+        compute: Adds fields to a Stream Network of whole trees, such as
+            `mnsi.modified_nest_set_index`. It may modify its argument.
+        fields: Fields added by compute.
+
+    Returns: df with the fields added, at the same columns as compute adds
+        them.
+    """
+    if previous is None:
+        return compute(df)
+    df_positions, previous_positions = untouched_rows(df, previous)
+    changed = np.ones(len(df), dtype=bool)
+    changed[df_positions] = False
+    changed_positions = np.flatnonzero(changed)
+    logger.info(
+        f"Carrying forward {len(df_positions)} of {len(df)} reaches, "
+        f"computing {len(changed_positions)}"
+    )
+
+    # compute adds fields to a new frame of the changed rows only
+    computed = compute(df.iloc[changed_positions].copy(deep=False))
+    # insert from the first column added, so later positions stay valid
+    for field in sorted(fields, key=computed.columns.get_loc):
+        computed_values = computed[field].to_numpy()
+        values = np.empty(len(df), dtype=computed_values.dtype)
+        values[changed_positions] = computed_values
+        values[df_positions] = previous[field].to_numpy()[previous_positions]
+        df.insert(computed.columns.get_loc(field), field, values)
+    return df
+
+
+def cached_nested_set_index(
+    df: DataFrame,
+    cache: StageCache | None = None,
+) -> DataFrame:
+    """`mnsi.modified_nest_set_index`, carrying forward the fields of trees
+    whose topology did not change since the cache's previous output.
+
+    Parameters:
+        df: Stream Network with topology fields, and LINKNO as a field or
+            the index.
+        cache: The region's stage cache. If None, all fields are computed.
+    """
+    if cache is None:
+        return modified_nest_set_index(df)
+    return __cached_fields(
+        MNSI_STAGE, df, cache, modified_nest_set_index, MNSI_FIELDS,
+    )
+
+
+def cached_nested_dissolve_groups(
+    df: DataFrame,
+    cache: StageCache | None = None,
+    dissolve_levels: tuple[tuple[int, int]] = DISSOLVE_LEVELS,
+) -> DataFrame:
+    """`process.compute_nested_dissolve_groups`, carrying forward the groups
+    of trees whose topology did not change since the cache's previous output
+    with the same dissolve_levels.
+
+    Parameters:
+        df: Stream Network with MNSI fields, and LINKNO as the index.
+        cache: The region's stage cache. If None, all fields are computed.
+        dissolve_levels: See `process.compute_nested_dissolve_groups`.
+    """
+    def compute(df: DataFrame) -> DataFrame:
+        return compute_nested_dissolve_groups(df, dissolve_levels)
+
+    if cache is None:
+        return compute(df)
+    fields = [
+        ELEMENT_COUNT,
+        *[dissolve_root_field(level) for level in range(len(dissolve_levels))],
+    ]
+    return __cached_fields(
+        DISSOLVE_STAGE, df, cache, compute, fields,
+        dissolve_levels=dissolve_levels,
+    )
+
+
+def __cached_fields(
+    stage: str,
+    df: DataFrame,
+    cache: StageCache,
+    compute: Callable[[DataFrame], DataFrame],
+    fields: list[str],
+    **params,
+) -> DataFrame:
+    """Adds fields with `update_fields`, from the cached output with the
+    same topology and params, or else the previous output, and caches them.
+
+    The output of a stage is keyed by the topology of df, so changes of
+    other fields of a Stream Network don't recompute it.
+    """
+    key = hash_key(stage, frame_hash(df, TOPOLOGY_FIELDS), params)
+    previous = cache.read(stage, key)
+    is_cached = previous is not None
+    if not is_cached:
+        previous = cache.previous(stage, **params)
+    df = update_fields(df, previous, compute, fields)
+    if not is_cached:
+        cache.write(stage, key, __fields_frame(df, fields), **params)
+    return df
+
+
+def __fields_frame(df: DataFrame, fields: list[str]) -> DataFrame:
+    """Topology fields, ROOT_ID and fields of df, with LINKNO as index, to
+    carry forward with `update_fields`"""
+    columns = list(dict.fromkeys([*TOPOLOGY_FIELDS[1:], ROOT, *fields]))
+    return DataFrame(
+        {field: field_values(df, field) for field in columns},
+        index=pd.Index(field_values(df, LINK), name=LINK),
+    )
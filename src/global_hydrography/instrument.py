@@ -0,0 +1,294 @@
+"""
+Global Hydrography instrumentation of processing stages, recording wall
+time, CPU time, peak memory, row counts and iteration rates.
+
+A stage's peak memory ('peak_rss_bytes') is the highest resident memory
+sampled while it runs, which needs psutil. The process's high-water mark
+('max_rss_bytes') is also recorded, but never decreases, so it is that of
+the largest stage run so far in the process, not of the current stage.
+
+Stages are timed with `stage`, as a context manager or a decorator:
+
+    with instrument.stage('modified nested set index', rows=len(df)) as s:
+        ...
+        s.iterations += len(level)
+
+    @instrument.stage('read streamnet')
+    def read_streamnet(...):
+        ...
+
+Metrics are logged, and kept by any enclosing `collect` block, which can save
+them as JSON. Instrumentation is disabled unless `enable()` is called or the
+GLOBAL_HYDROGRAPHY_METRICS environment variable is set. While disabled,
+`stage` returns a no-op context and decorated functions are called directly.
+"""
+
+from typing import Callable
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+import contextvars
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENV = "GLOBAL_HYDROGRAPHY_METRICS"
+# Seconds between samples of resident memory while a stage runs
+RSS_SAMPLE_INTERVAL = 0.05
+
+# module state uses single underscores, which class bodies do not mangle
+_enabled = os.environ.get(METRICS_ENV, "").lower() in ("1", "true", "yes")
+_warned_no_psutil = False
+_collector: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "collector", default=None,
+)
+
+
+def enable() -> None:
+    """Enable instrumentation in this process"""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Disable instrumentation in this process"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def max_rss() -> int | None:
+    """Peak resident memory of this process since it started in bytes, or
+    None if unknown. It never decreases, so it is not the peak of any later
+    part of the process, for which see `RSSSampler`."""
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss)
+    return None
+
+
+class RSSSampler:
+    """Samples resident memory in a background thread, while started, to
+    find the peak of a part of the process. Without psutil, `peak` is None.
+
+    Parameters:
+        interval: Seconds between samples. Peaks shorter than this may be
+            missed.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL) -> None:
+        self.__interval = interval
+        self.__peak: int | None = None
+        self.__stopped = threading.Event()
+        self.__thread: threading.Thread | None = None
+
+    @property
+    def peak(self) -> int | None:
+        """Highest resident memory sampled, in bytes"""
+        return self.__peak
+
+    def start(self) -> "RSSSampler":
+        if psutil is None:
+            _warn_no_psutil()
+            return self
+        self.__process = psutil.Process()
+        self.__sample()
+        self.__thread = threading.Thread(
+            target=self.__run, name="rss-sampler", daemon=True,
+        )
+        self.__thread.start()
+        return self
+
+    def stop(self) -> int | None:
+        """Stop sampling, after a last sample, and return the peak"""
+        if self.__thread is not None:
+            self.__stopped.set()
+            self.__thread.join()
+            self.__thread = None
+            self.__sample()
+        return self.__peak
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.__interval):
+            self.__sample()
+
+    def __sample(self) -> None:
+        rss = self.__process.memory_info().rss
+        if self.__peak is None or rss > self.__peak:
+            self.__peak = rss
+
+
+def _warn_no_psutil() -> None:
+    """Warn, once per process, that peak memory isn't recorded"""
+    global _warned_no_psutil
+    if not _warned_no_psutil:
+        _warned_no_psutil = True
+        logger.warning(
+            "psutil is not installed, so the peak memory of stages is not "
+            "recorded. Install it, as in environment.yml, for peak_rss_bytes."
+        )
+
+
+def stage(name: str, rows: int | None = None) -> "Stage":
+    """Time a stage, as a context manager or a decorator. See module docs.
+
+    Parameters:
+        name: Name of the stage, used in logs and metrics.
+        rows: Number of rows processed, if known before the stage.
+    """
+    if not _enabled:
+        return _NullStage(name)
+    return Stage(name, rows)
+
+
+class Stage:
+    """A timed stage. Set `rows` and add to `iterations` within the stage."""
+
+    def __init__(self, name: str, rows: int | None = None) -> None:
+        self.name = name
+        self.rows = rows
+        self.iterations = 0
+        self.metrics: dict = {}
+
+    def __enter__(self) -> "Stage":
+        self.__rss = RSSSampler().start()
+        self.__wall = time.perf_counter()
+        self.__cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        wall = time.perf_counter() - self.__wall
+        self.metrics = {
+            "stage": self.name,
+            "wall_seconds": wall,
+            "cpu_seconds": time.process_time() - self.__cpu,
+            "peak_rss_bytes": self.__rss.stop(),
+            "max_rss_bytes": max_rss(),
+            "rows": self.rows,
+            "iterations": self.iterations,
+            "iterations_per_second": self.iterations / wall if wall else None,
+            "failed": exc_type is not None,
+        }
+        collector = _collector.get()
+        if collector is not None:
+            collector.append(self.metrics)
+        logger.info(format_metrics(self.metrics))
+
+    def __call__(self, func: Callable) -> Callable:
+        return _instrumented(self.name, func)
+
+
+class _NullStage:
+    """Stage returned when disabled, ignoring rows and iterations"""
+
+    __slots__ = ("name",)
+    rows = 0
+    iterations = 0
+    metrics: dict = {}
+
+    def __init__(self, name: str) -> None:
+        object.__setattr__(self, "name", name)
+
+    def __setattr__(self, name, value) -> None:
+        pass
+
+    def __enter__(self) -> "_NullStage":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def __call__(self, func: Callable) -> Callable:
+        return _instrumented(self.name, func)
+
+
+def _instrumented(name: str, func: Callable) -> Callable:
+    """Wrap func to run as a stage whenever instrumentation is enabled, even
+    if it was disabled when func was decorated"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with Stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class collect:
+    """Context manager collecting the metrics of all stages within it, and
+    saving them as JSON to path on exit, if given and enabled.
+
+    Parameters:
+        path: Path of the metrics JSON.
+        **attributes: Added to the JSON, e.g. the TDX Hydro Region.
+    """
+
+    def __init__(self, path: Path | None = None, **attributes) -> None:
+        self.path = Path(path) if path else None
+        self.attributes = attributes
+        self.stages: list[dict] = []
+
+    def __enter__(self) -> "collect":
+        self.__token = _collector.set(self.stages)
+        self.__rss = RSSSampler()
+        if self.path is not None and _enabled:
+            self.__rss.start()
+        self.__wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        _collector.reset(self.__token)
+        peak = self.__rss.stop()
+        if self.path is None or not _enabled:
+            return
+        metrics = {
+            **self.attributes,
+            "wall_seconds": time.perf_counter() - self.__wall,
+            "peak_rss_bytes": peak,
+            "max_rss_bytes": max_rss(),
+            "failed": exc_type is not None,
+            "stages": self.stages,
+        }
+        with open(self.path, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+
+def format_metrics(metrics: dict) -> str:
+    """One line summary of a stage's metrics"""
+    line = (
+        f"{metrics['stage']}: {metrics['wall_seconds']:.2f}s wall, "
+        f"{metrics['cpu_seconds']:.2f}s CPU"
+    )
+    if metrics["peak_rss_bytes"] is not None:
+        line += f", peak RSS {metrics['peak_rss_bytes'] / 2**30:.2f} GiB"
+    if metrics["max_rss_bytes"] is not None:
+        line += f", process max RSS {metrics['max_rss_bytes'] / 2**30:.2f} GiB"
+    if metrics["rows"] is not None:
+        line += f", {metrics['rows']} rows"
+    if metrics["iterations"]:
+        line += (
+            f", {metrics['iterations']} iterations "
+            f"({metrics['iterations_per_second']:.0f}/s)"
+        )
+    return line
@@ -6,31 +6,157 @@ from typing import Iterable
 
 import os
 import sys
+import json
 from pathlib import Path
 import time
 import logging
 
 import fsspec
 import asyncio
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import pyproj
+import shapely
 import aiohttp
 
+from global_hydrography.delineation.mnsi import LINK, MNSI_FIELDS, DISCOVER, FINISH, ROOT
+from global_hydrography.preprocess import TDXPreprocessor
+from global_hydrography import instrument
+from global_hydrography.metadata import MetadataCache, HYBAS_IDS
+
 logger = logging.getLogger(__name__)
 
+# Rows per row group in the delineation layout. Small enough that reading a
+# headwater watershed touches one or two row groups.
+DELINEATION_ROW_GROUP_SIZE = 10_000
+
+# Rows per row group of the LINKNO index written next to delineation layout
+# files, so looking up one LINKNO reads a single small row group.
+LINKNO_INDEX_ROW_GROUP_SIZE = 50_000
+
+# Features per record batch when streaming GeoPackages to GeoParquet.
+# Peak memory of the conversion scales with this, not with the file size.
+STREAMING_BATCH_SIZE = 65_536
+
+# GeoParquet metadata version, and names of geometry types by shapely type
+# id, as written by `GeoDataFrame.to_parquet`
+GEOPARQUET_VERSION = "1.1.0"
+GEOMETRY_TYPE_NAMES = (
+    "Point", "LineString", "LineString", "Polygon", "MultiPoint",
+    "MultiLineString", "MultiPolygon", "GeometryCollection",
+)
+
+# Errors that indicate the host dropped or reset a connection
+CONNECTION_ERRORS = (
+    aiohttp.ClientPayloadError,
+    aiohttp.ServerDisconnectedError,
+    aiohttp.ClientOSError,
+    asyncio.TimeoutError,
+    ConnectionResetError,
+)
+
+
+class AdaptiveConcurrencyLimiter:
+    """Async context manager limiting concurrent downloads, adapting the limit
+    to how the host responds.
+
+    The limit is halved (to no less than 1) whenever a connection is reset,
+    and raised by one after `increase_after` consecutive successful
+    downloads, up to `maximum`.
+    """
+
+    def __init__(
+        self,
+        initial: int = 2,
+        maximum: int = 8,
+        increase_after: int = 4,
+    ) -> None:
+        self.__limit = max(1, min(initial, maximum))
+        self.__maximum = maximum
+        self.__increase_after = increase_after
+        self.__active = 0
+        self.__successes = 0
+        self.__condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    async def __aenter__(self) -> "AdaptiveConcurrencyLimiter":
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: self.__active < self.__limit)
+            self.__active += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self.__condition:
+            self.__active -= 1
+            self.__condition.notify_all()
+
+    def record_success(self) -> None:
+        self.__successes += 1
+        if self.__successes >= self.__increase_after and self.__limit < self.__maximum:
+            self.__limit += 1
+            self.__successes = 0
+            logger.info(f"Increased connection limit to {self.__limit}")
+
+    def record_reset(self) -> None:
+        self.__successes = 0
+        if self.__limit > 1:
+            self.__limit = max(1, self.__limit // 2)
+            logger.info(f"Connection reset, decreased connection limit to {self.__limit}")
+
 
 class TDXHydroDownloader:
 
     ROOT_URL = "https://earth-info.nga.mil/php/download.php"
 
+    # size of chunks written to disk while downloading
+    CHUNK_SIZE = 2**20
+
     def __init__(
         self, 
         filesystem: fsspec.filesystem = None, 
         download_dir: Path = None,
+        connection_limit: int = 2,
+        max_connections: int = 8,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        metadata_cache: MetadataCache = None,
     ) -> None:
+        """
+        Parameters:
+            filesystem: An asynchronous fsspec HTTP filesystem. Defaults to one
+                from `init_fsspec_filesystem`, allowing max_connections.
+            download_dir: Directory to save files to.
+            connection_limit: Initial number of simultaneous downloads.
+            max_connections: Most simultaneous downloads the limit may grow to.
+            max_retries: Times to retry a file after a failed attempt.
+            backoff: Seconds to wait before the first retry, doubling after
+                each further failed attempt.
+            metadata_cache: Cache of the list of HYBAS ids. Defaults to a
+                `MetadataCache` in the default cache directory.
+        """
         self.__filesystem: fsspec.filesystem = (
-            filesystem if filesystem else self.init_fsspec_filesystem()
+            filesystem if filesystem 
+            else self.init_fsspec_filesystem(connection_limit=max_connections)
         )
         self.__download_dir: Path = self.create_data_directory(download_dir)
+        self.__connection_limit = connection_limit
+        self.__max_connections = max_connections
+        self.__max_retries = max_retries
+        self.__backoff = backoff
+        self.__limiter: AdaptiveConcurrencyLimiter | None = None
+        self.__session: aiohttp.ClientSession | None = None
+        self.__metadata_cache = metadata_cache if metadata_cache else MetadataCache()
+
+    @property
+    def download_dir(self) -> Path:
+        return self.__download_dir
 
     @staticmethod
     def init_fsspec_filesystem(
@@ -75,60 +201,647 @@ class TDXHydroDownloader:
     def get_hybas_ids(
         self, 
         hydrobasins_filename: str = "hydrobasins_level2",
-    ) -> list[str]:
-        """Downloads the large hydrobasins file and extracts the HYBAS ids from the file"""
+    ) -> list[int]:
+        """Returns the HYBAS ids of all TDX Hydro Regions, from the metadata
+        cache, or else from the large hydrobasins file"""
+        return self.__metadata_cache.get(
+            HYBAS_IDS, lambda: self.__fetch_hybas_ids(hydrobasins_filename),
+        )
+
+    def __fetch_hybas_ids(self, hydrobasins_filename: str) -> list[int]:
+        """Downloads the large hydrobasins file, unless already downloaded,
+        and extracts the HYBAS ids from its attributes"""
         hydrobasins_url = f"{self.ROOT_URL}?file={hydrobasins_filename}"
-        logger.debug(f"Downloading from {hydrobasins_url}")
-        fs = fsspec.filesystem("http", asynchronous=False)  # use synchronous filesystem
+        file_name = hydrobasins_filename + ".geojson"
+        local_filepath = self.__download_dir / file_name
 
         try:
-            fs.exists(hydrobasins_url)
-            # download the file
-            file_name = hydrobasins_filename + ".geojson"
-            local_filepath = self.__download_dir / file_name
-            fs.get_file(hydrobasins_url, str(local_filepath))
-            # parse file to extract HYDAS ids
-            hydro_gdf = gpd.read_file(local_filepath)
-            hybas_ids = hydro_gdf["HYBAS_ID"].tolist()
-            return hybas_ids
+            if not local_filepath.exists():
+                logger.debug(f"Downloading from {hydrobasins_url}")
+                fs = fsspec.filesystem("http", asynchronous=False)  # use synchronous filesystem
+                temp_path = local_filepath.with_name(file_name + ".part")
+                fs.get_file(hydrobasins_url, str(temp_path))
+                os.replace(temp_path, local_filepath)
+            # read only the HYBAS_ID attribute, skipping geometry
+            hydro_df = pyogrio.read_dataframe(
+                local_filepath, columns=["HYBAS_ID"], read_geometry=False,
+            )
+            return [int(hybas_id) for hybas_id in hydro_df["HYBAS_ID"]]
         except Exception as e:
             logger.error(
                 f"Unable to locate or parse file at {hydrobasins_url}. Provide override to default with `hydrobasins_url` argument, or check Basin GeoJSON File with ID Numbers"
             )
             raise e
 
+    async def __aenter__(self) -> "TDXHydroDownloader":
+        """Open the HTTP session used by `download_region`"""
+        self.__session = await self.__filesystem.set_session()
+        self.__limiter = AdaptiveConcurrencyLimiter(
+            initial=self.__connection_limit,
+            maximum=self.__max_connections,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.__session.close()  # Explicitly close the session
+
+    def file_url(self, file_name: str, extension: str = "gpkg") -> str:
+        return f"{self.ROOT_URL}?file={file_name}-{extension}"
+
+    async def get_download_size(
+        self,
+        hybas_id: str | int,
+        dataset_names: Iterable[str],
+    ) -> int:
+        """Total remote size in bytes of a region's files, counting missing
+        files and files of unknown size as 0"""
+        sizes = await asyncio.gather(
+            *(
+                self.__remote_size(self.file_url(f"{hybas_id}-{dataset}"))
+                for dataset in dataset_names
+            ),
+            return_exceptions=True,
+        )
+        return sum(size for size in sizes if isinstance(size, int))
+
+    async def download_region(
+        self,
+        hybas_id: str | int,
+        dataset_names: Iterable[str],
+    ) -> list[dict]:
+        """Coroutine to download all files of one region. Must be used within
+        `async with downloader:`.
+
+        Returns: A list of results for each file, see `__download_file`.
+        """
+        return await asyncio.gather(*(
+            self.__download_file(f"{hybas_id}-{dataset}")
+            for dataset in dataset_names
+        ))
+
+    async def __remote_size(self, url: str) -> int | None:
+        """Size of the remote file, or None if the host doesn't report it"""
+        return (await self.__remote_info(url)).get("size")
+
+    async def __remote_info(self, url: str) -> dict:
+        """HEAD details of the remote file, with its 'size', 'ETag' and
+        'Last-Modified' if the host reports them, or {} if the request fails"""
+        try:
+            return await self.__filesystem._info(url)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            logger.warning(f"Unable to get size of {url}, with exception `{e}`")
+            return {}
+
+    @staticmethod
+    def __validator(headers: dict) -> str | None:
+        """The version of a remote file, for an If-Range header: a strong
+        ETag, else Last-Modified, or None if the host reports neither"""
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return headers.get("Last-Modified")
+
+    @staticmethod
+    def __validator_path(temp_path: Path) -> Path:
+        """File keeping the version of the remote file a '.part' file holds"""
+        return temp_path.with_name(temp_path.name + ".validator")
+
+    def __discard(self, temp_path: Path) -> None:
+        """Remove a '.part' file that can't be resumed, and its version"""
+        temp_path.unlink(missing_ok=True)
+        self.__validator_path(temp_path).unlink(missing_ok=True)
+
     async def __download_file(
         self,
         file_name: str,
         extension: str = "gpkg",
-    ) -> None:
-        url = f"{self.ROOT_URL}?file={file_name}-{extension}"
+    ) -> dict:
+        """Download a file, skipping it if already complete.
+
+        Data is written to a '.part' file next to save_path, which is renamed
+        to save_path once its size matches the remote size. After a failed
+        attempt, the download resumes from the end of the '.part' file with an
+        HTTP Range request, after an exponential backoff. A '.part' file left
+        by a previous run is resumed the same way. The version of the remote
+        file (its ETag or Last-Modified) is kept next to the '.part' file and
+        sent as If-Range, so a file replaced on the host is downloaded again
+        from the start rather than spliced onto the old version. A '.part'
+        file larger than the remote file is discarded.
+
+        Returns: A dict of file, path, status ('skipped', 'downloaded' or
+            'failed'), bytes downloaded, seconds and throughput in bytes per
+            second.
+        """
+        url = self.file_url(file_name, extension)
         save_path = self.__download_dir.joinpath(f"{file_name}.{extension}") #TODO: remove file_name to preserve original filename
+        temp_path = save_path.with_name(save_path.name + ".part")
+        result = {
+            "file": save_path.name,
+            "path": save_path,
+            "status": "failed",
+            "bytes": 0,
+            "seconds": 0.0,
+        }
         try:
-
-            logger.info(f"Attempting download of {url}")
-            await self.__filesystem._get_file(url, str(save_path))
-            logger.info(f"Downloaded file and save to {save_path}")
-        except Exception as e:
+            remote_info = await self.__remote_info(url)
+        except FileNotFoundError as e:
             logger.error(f"Failed to download {url}, with exception `{e}`")
+            return result
+        remote_size = remote_info.get("size")
+        validator = self.__validator(remote_info)
+        if save_path.exists() and save_path.stat().st_size == remote_size:
+            logger.info(f"Skipping {save_path}, already downloaded")
+            result["status"] = "skipped"
+            return result
+
+        start_time = time.perf_counter()
+        for attempt in range(self.__max_retries + 1):
+            if attempt:
+                delay = self.__backoff * 2 ** (attempt - 1)
+                logger.info(f"Retrying {url} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            try:
+                async with self.__limiter:
+                    logger.info(f"Attempting download of {url}")
+                    result["bytes"] += await self.__download_to(
+                        url, temp_path, remote_size, validator,
+                    )
+                size = temp_path.stat().st_size
+                if remote_size is not None and size > remote_size:
+                    # can't be fixed by resuming, so start again
+                    self.__discard(temp_path)
+                    raise IOError(
+                        f"Download larger than the remote file, {size} of "
+                        f"{remote_size} bytes"
+                    )
+                if remote_size is not None and size != remote_size:
+                    raise IOError(
+                        f"Incomplete download, {size} of {remote_size} bytes"
+                    )
+                os.replace(temp_path, save_path)
+                self.__validator_path(temp_path).unlink(missing_ok=True)
+                self.__limiter.record_success()
+                result["status"] = "downloaded"
+                break
+            except CONNECTION_ERRORS + (aiohttp.ClientError, IOError) as e:
+                if isinstance(e, CONNECTION_ERRORS):
+                    self.__limiter.record_reset()
+                logger.warning(
+                    f"Attempt {attempt + 1} to download {url} failed, "
+                    f"with exception `{e!r}`"
+                )
+
+        result["seconds"] = time.perf_counter() - start_time
+        result["throughput"] = result["bytes"] / max(result["seconds"], 1e-9)
+        if result["status"] == "downloaded":
+            logger.info(
+                f"Downloaded file and save to {save_path}, "
+                f"{result['bytes'] / 2**20:.1f} MiB in {result['seconds']:.1f}s "
+                f"({result['throughput'] / 2**20:.2f} MiB/s)"
+            )
+        else:
+            logger.error(
+                f"Failed to download {url} after {self.__max_retries + 1} attempts, "
+                f"partial file kept at {temp_path}"
+            )
+        return result
+
+    async def __download_to(
+        self,
+        url: str,
+        temp_path: Path,
+        remote_size: int | None,
+        validator: str | None,
+    ) -> int:
+        """Download url to temp_path, resuming from temp_path's current size
+        if it holds the same version of the file as the host reported.
+
+        Returns: The number of bytes downloaded.
+        """
+        validator_path = self.__validator_path(temp_path)
+        offset = temp_path.stat().st_size if temp_path.exists() else 0
+        saved = validator_path.read_text() if validator_path.exists() else None
+        if offset and (
+            (remote_size is not None and offset > remote_size)
+            or (validator is not None and saved != validator)
+        ):
+            logger.info(f"Discarding {temp_path}, of another version of {url}")
+            self.__discard(temp_path)
+            offset, saved = 0, None
+        if remote_size is not None and offset == remote_size:
+            return 0
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if saved is not None:
+                # the whole file is sent instead if it changed since
+                headers["If-Range"] = saved
+
+        downloaded = 0
+        async with self.__session.get(url, headers=headers) as response:
+            if response.status == 416:
+                self.__discard(temp_path)
+                raise IOError(
+                    f"Range of {temp_path} not satisfiable, discarded it"
+                )
+            response.raise_for_status()
+            # the host may ignore the range, or the file may have changed,
+            # so the whole file is sent
+            if response.status != 206:
+                offset = 0
+                saved = self.__validator(response.headers)
+                if saved is not None:
+                    validator_path.write_text(saved)
+                else:
+                    validator_path.unlink(missing_ok=True)
+            with open(temp_path, "ab" if offset else "wb") as f:
+                async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+        return downloaded
 
     async def download_files(
         self,
         hybas_ids: Iterable[str | int],
         dataset_names: Iterable[str],
-    ) -> None:
-        """Coroutine to download corresponding files"""
-        session = await self.__filesystem.set_session()
-
-        tasks = []
-        for hybas_id in hybas_ids:
-            for dataset in dataset_names:
-                file_name = f"{hybas_id}-{dataset}"
-                tasks.append(self.__download_file(file_name))
-
-        # Run all tasks concurrently
-        await asyncio.gather(*tasks)
-        await session.close()  # Explicitly close the session
+    ) -> list[dict]:
+        """Coroutine to download corresponding files
+
+        Returns: A list of results for each file, see `__download_file`.
+        """
+        async with self:
+            tasks = []
+            for hybas_id in hybas_ids:
+                for dataset in dataset_names:
+                    file_name = f"{hybas_id}-{dataset}"
+                    tasks.append(self.__download_file(file_name))
+
+            # Run all tasks concurrently
+            results = await asyncio.gather(*tasks)
+
+        downloaded = [r for r in results if r["status"] == "downloaded"]
+        total_bytes = sum(r["bytes"] for r in downloaded)
+        logger.info(
+            f"{len(downloaded)} files downloaded ({total_bytes / 2**20:.1f} MiB), "
+            f"{sum(r['status'] == 'skipped' for r in results)} skipped, "
+            f"{sum(r['status'] == 'failed' for r in results)} failed"
+        )
+        return results
+
+
+def stream_gpkg_to_parquet(
+    gpkg_path: Path,
+    parquet_path: Path,
+    tdx_hydro_region: int,
+    preprocessor: TDXPreprocessor,
+    rename: dict[str, str] | None = None,
+    batch_size: int = STREAMING_BATCH_SIZE,
+) -> Path:
+    """Convert a TDX Hydro GeoPackage to GeoParquet, one record batch at a time.
+
+    Features are read as Arrow record batches with `pyogrio.open_arrow`. For
+    each batch, only the attribute columns are converted to pandas to apply
+    `preprocessor.tdx_to_global_linkno` and `tdx_drop_useless_columns`; the
+    WKB geometry column is passed through untouched. Each batch is written
+    as it is processed, so peak memory is set by batch_size.
+
+    Parameters:
+        gpkg_path: Path to a raw TDX Hydro GeoPackage ('.gpkg') file.
+        parquet_path: Path of the GeoParquet file to write.
+        tdx_hydro_region: The 10-digit TDX Hydro Region of the file.
+        preprocessor: An instance of the TDXPreprocessor class.
+        rename: Optional mapping of columns to rename before preprocessing,
+            e.g. `{'streamID': 'LINKNO'}` for basins files.
+        batch_size: Number of features per record batch.
+
+    Returns: The path written to.
+
+    Raises:
+        ValueError: If the GeoPackage has no features.
+    """
+    writer = None
+    rows = 0
+    with pyogrio.open_arrow(
+        gpkg_path, layer=0, batch_size=batch_size, use_pyarrow=True,
+    ) as (meta, reader), instrument.stage(
+        f"stream {Path(gpkg_path).name} to parquet",
+    ) as stage:
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        try:
+            for batch in reader:
+                rows += batch.num_rows
+                stage.iterations += 1
+                table = pa.Table.from_batches([batch])
+                geometry = table.column(geometry_name)
+
+                df = table.drop_columns([geometry_name]).to_pandas()
+                if rename:
+                    df.rename(columns=rename, inplace=True)
+                preprocessor.tdx_to_global_linkno(df, tdx_hydro_region)
+                preprocessor.tdx_drop_useless_columns(df)
+
+                table = geoparquet_table(
+                    df, geometry, meta["crs"], meta["geometry_type"],
+                    preserve_index=False,
+                )
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(parquet_path, schema, compression="zstd")
+                writer.write_table(table.cast(schema))
+        finally:
+            stage.rows = rows
+            if writer is not None:
+                writer.close()
+
+    if writer is None:
+        raise ValueError(f"No features found in {gpkg_path}")
+    return parquet_path
+
+
+def geometry_summary(
+    geometry: pa.ChunkedArray | pa.Array,
+    batch_size: int = STREAMING_BATCH_SIZE,
+) -> tuple[list[float] | None, list[str]]:
+    """Bounding box and geometry types of WKB geometries, for GeoParquet
+    metadata. Geometries are decoded batch_size at a time, so they are
+    never all decoded at once.
+
+    Returns: A tuple
+        bbox: (minx, miny, maxx, maxy) of all geometries, or None if there
+            are none.
+        geometry_types: Sorted names of the geometry types, with ' Z' for 3D
+            geometries, as `GeoDataFrame.to_parquet` writes them.
+    """
+    bounds = []
+    type_ids = set()
+    for start in range(0, len(geometry), batch_size):
+        batch = shapely.from_wkb(
+            geometry.slice(start, batch_size).to_numpy(zero_copy_only=False)
+        )
+        bounds.append(shapely.total_bounds(batch))
+        ids = shapely.get_type_id(batch)
+        ids[shapely.has_z(batch)] += len(GEOMETRY_TYPE_NAMES)
+        type_ids.update(np.unique(ids[ids > -1]).tolist())
+    bbox = None
+    if bounds:
+        bounds = np.array(bounds)
+        bbox = [
+            *np.nanmin(bounds[:, :2], axis=0).tolist(),
+            *np.nanmax(bounds[:, 2:], axis=0).tolist(),
+        ]
+        if not np.isfinite(bbox).all():
+            bbox = None
+    names = GEOMETRY_TYPE_NAMES + tuple(f"{name} Z" for name in GEOMETRY_TYPE_NAMES)
+    return (bbox, sorted({names[i] for i in type_ids}))
+
+
+def geoparquet_table(
+    attributes: pd.DataFrame,
+    geometry: pa.ChunkedArray | pa.Array,
+    crs: str | None,
+    geometry_type: str | list[str] | None,
+    bbox: tuple[float] | None = None,
+    preserve_index: bool | None = None,
+    geometry_position: int | None = None,
+) -> pa.Table:
+    """Combine attributes and a WKB geometry column into a GeoParquet table.
+
+    The geometry column is added as is, without decoding or copying it, and
+    named 'geometry'. By default it follows the attribute columns, and any
+    index is kept as pandas metadata, as with `GeoDataFrame.to_parquet`.
+
+    Parameters:
+        attributes: The non-geometry columns, one row per geometry.
+        geometry: WKB geometries, e.g. from `pyogrio.read_arrow`.
+        crs: The CRS of the geometries, in any form pyproj accepts.
+        geometry_type: The geometry type, e.g. 'MultiPolygon', a list of
+            types, or None. See `geometry_summary` for the types present.
+        bbox: Optional (minx, miny, maxx, maxy) of all geometries. See
+            `geometry_summary`.
+        preserve_index: Passed to `pyarrow.Table.from_pandas`.
+        geometry_position: Column position of the geometry. Defaults to
+            after all attribute columns.
+
+    Returns: A pyarrow Table with 'geo' metadata of GEOPARQUET_VERSION.
+    """
+    table = pa.Table.from_pandas(attributes, preserve_index=preserve_index)
+    if geometry_position is None:
+        geometry_position = len(attributes.columns)
+    table = table.add_column(
+        geometry_position, pa.field("geometry", geometry.type), geometry,
+    )
+
+    if geometry_type in (None, "Unknown"):
+        geometry_types = []
+    elif isinstance(geometry_type, str):
+        geometry_types = [geometry_type]
+    else:
+        geometry_types = list(geometry_type)
+    column = {"encoding": "WKB"}
+    if crs:
+        column["crs"] = __projjson(crs)
+    column["geometry_types"] = geometry_types
+    if bbox is not None:
+        column["bbox"] = [float(x) for x in bbox]
+    geo = {
+        "version": GEOPARQUET_VERSION,
+        "primary_column": "geometry",
+        "columns": {"geometry": column},
+    }
+    return table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), b"geo": json.dumps(geo)}
+    )
+
+
+def __projjson(crs) -> dict:
+    """PROJJSON of a CRS, without the ids of datum ensemble members, which
+    older PROJ versions don't recognize, as `GeoDataFrame.to_parquet` writes"""
+    def remove_member_ids(json_dict: dict) -> None:
+        for key, value in json_dict.items():
+            if isinstance(value, dict):
+                remove_member_ids(value)
+            elif key == "members" and isinstance(value, list):
+                for member in value:
+                    member.pop("id", None)
+
+    json_dict = pyproj.CRS.from_user_input(crs).to_json_dict()
+    remove_member_ids(json_dict)
+    return json_dict
+
+
+def write_geoparquet_table(
+    table: pa.Table,
+    path: Path,
+    delineation_layout: bool = False,
+) -> Path:
+    """Write a table from `geoparquet_table` to a GeoParquet file.
+
+    Parameters:
+        table: A pyarrow Table with GeoParquet metadata.
+        path: Path of the GeoParquet file to write.
+        delineation_layout: If True, sort rows and size row groups as
+            `write_delineation_parquet` does. Requires MNSI fields.
+
+    Returns: The path written to.
+    """
+    if delineation_layout:
+        table = table.sort_by([(ROOT, "ascending"), (DISCOVER, "ascending")])
+        pq.write_table(
+            table,
+            path,
+            compression="zstd",
+            row_group_size=DELINEATION_ROW_GROUP_SIZE,
+            write_statistics=True,
+        )
+        if LINK in table.column_names:
+            write_linkno_index(table.select([LINK, *MNSI_FIELDS]), path)
+    else:
+        pq.write_table(table, path, compression="zstd")
+    return path
+
+
+def write_delineation_parquet(
+    gdf: gpd.GeoDataFrame,
+    path: Path,
+    row_group_size: int = DELINEATION_ROW_GROUP_SIZE,
+) -> Path:
+    """Write a GeoParquet file laid out for selective reads of upstream sets.
+
+    Rows are sorted by ROOT_ID and DISCOVER_TIME, so every upstream set is a
+    contiguous run of rows, and written in small row groups with column
+    statistics. Readers filtering on those fields, such as
+    `read_upstream_basins`, then skip every row group outside the range.
+    If gdf has LINKNOs, a LINKNO index is also written next to the file,
+    see `write_linkno_index`.
+
+    Parameters:
+        gdf: A GeoDataFrame with MNSI fields.
+        path: Path of the GeoParquet file to write.
+        row_group_size: Maximum number of rows per row group.
+
+    Returns: The path written to.
+    """
+    gdf = gdf.sort_values([ROOT, DISCOVER], kind="stable")
+    gdf.to_parquet(
+        path,
+        compression="zstd",
+        row_group_size=row_group_size,
+        write_statistics=True,
+    )
+    if LINK in (gdf.index.name, *gdf.columns):
+        links = gdf.index if gdf.index.name == LINK else gdf[LINK]
+        write_linkno_index(
+            pa.table({
+                LINK: links.to_numpy(),
+                **{field: gdf[field].to_numpy() for field in MNSI_FIELDS},
+            }),
+            path,
+        )
+    return path
+
+
+def linkno_index_path(path: Path) -> Path:
+    """Path of the LINKNO index of a delineation layout GeoParquet file"""
+    return Path(path).with_suffix(".linkno.parquet")
+
+
+def write_linkno_index(
+    table: pa.Table,
+    path: Path,
+    row_group_size: int = LINKNO_INDEX_ROW_GROUP_SIZE,
+) -> Path:
+    """Write the LINKNO index of a delineation layout GeoParquet file.
+
+    The delineation layout is sorted by MNSI fields, so a filter on LINKNO
+    can't skip any row groups. The index holds only the LINKNO and MNSI
+    fields, sorted by LINKNO in row groups with statistics, so the MNSI
+    fields of one LINKNO are read from a single row group.
+
+    Parameters:
+        table: A pyarrow Table of the LINKNO and MNSI fields.
+        path: Path of the GeoParquet file indexed.
+
+    Returns: The path of the index, from `linkno_index_path`.
+    """
+    index_path = linkno_index_path(path)
+    pq.write_table(
+        table.sort_by(LINK),
+        index_path,
+        compression="zstd",
+        row_group_size=row_group_size,
+        write_statistics=True,
+    )
+    return index_path
+
+
+def read_upstream_range(
+    path: Path,
+    root_id: int,
+    discover_time: int,
+    finish_time: int,
+) -> gpd.GeoDataFrame:
+    """Read the rows of a GeoParquet file within an upstream MNSI range.
+
+    Only row groups whose ROOT_ID and DISCOVER_TIME statistics overlap the
+    range are read, so this is fast on files written by
+    `write_delineation_parquet`, and correct (if slower) on any other file.
+
+    Parameters:
+        path: Path of a GeoParquet file with MNSI fields.
+        root_id: ROOT_ID of the upstream set.
+        discover_time: DISCOVER_TIME of the outlet of the upstream set.
+        finish_time: FINISH_TIME of the outlet of the upstream set.
+
+    Returns: A GeoDataFrame of the rows in the upstream set.
+    """
+    return gpd.read_parquet(
+        path,
+        filters=[
+            (ROOT, "==", root_id),
+            (DISCOVER, ">=", discover_time),
+            (DISCOVER, "<", finish_time),
+        ],
+    )
+
+
+def read_upstream_basins(path: Path, linkid: int) -> gpd.GeoDataFrame:
+    """Read the basins upstream of linkid from a GeoParquet file.
+
+    First finds the MNSI fields of linkid in the file's LINKNO index, which
+    reads a single row group, then reads the row groups overlapping its
+    upstream set with `read_upstream_range`. Without an index, or with one
+    older than the file, linkid is found by reading the file's whole LINKNO
+    and MNSI columns. Callers that already know the MNSI fields of linkid
+    should call `read_upstream_range` directly.
+
+    Parameters:
+        path: Path of a basins GeoParquet file with MNSI fields, ideally
+            written by `write_delineation_parquet`.
+        linkid: The global unique identifier of the outlet reach.
+
+    Returns: A GeoDataFrame of the basins upstream of linkid, itself included.
+
+    Raises:
+        KeyError: If linkid is not in the file.
+    """
+    index_path = linkno_index_path(path)
+    try:
+        is_current = index_path.stat().st_mtime_ns >= os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        is_current = False
+    target = pq.read_table(
+        index_path if is_current else path,
+        columns=[LINK, *MNSI_FIELDS],
+        filters=[(LINK, "==", linkid)],
+    ).to_pylist()
+    if not target:
+        raise KeyError(linkid)
+    target = target[0]
+    return read_upstream_range(
+        path, target[ROOT], target[DISCOVER], target[FINISH],
+    )
 
 
 async def main(hybas_ids: Iterable[int | str] = None, datasets: Iterable[str] = None):
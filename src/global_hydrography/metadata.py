@@ -0,0 +1,275 @@
+"""
+Global Hydrography on-disk cache of small metadata files, such as the GEOGLOWS
+TDX header crosswalk and the list of TDX Hydro Regions, so they are fetched
+once and shared by every process, including nodes without internet access.
+
+Snapshots bundled with the package, for a cold start without internet
+access, are written from the sources with:
+
+    python -m global_hydrography.metadata
+"""
+
+from typing import Any, Callable
+
+import os
+import json
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Bump when the format of cache entries changes, so old entries are ignored
+METADATA_CACHE_VERSION = 1
+
+# Seconds before a cache entry is refreshed, when online
+DEFAULT_TTL = 30 * 24 * 3600
+
+# Environment variables to set the cache directory and force offline mode
+CACHE_DIR_ENV = "GLOBAL_HYDROGRAPHY_CACHE_DIR"
+OFFLINE_ENV = "GLOBAL_HYDROGRAPHY_OFFLINE"
+
+# Snapshots bundled with the package, used when nothing else is available.
+# Write them with `main`, or from a populated cache with
+# `MetadataCache.save_snapshot`.
+SNAPSHOT_DIR = Path(__file__).parent / "data"
+
+# Names of cached metadata
+TDX_HEADER_CROSSWALK = "tdx_header_numbers"
+HYBAS_IDS = "hybas_ids"
+
+# Seconds since a lock file was last touched before it is taken to be left
+# by a process that died. The process fetching touches it every
+# LOCK_HEARTBEAT seconds, however long the fetch takes.
+LOCK_TIMEOUT = 120
+LOCK_HEARTBEAT = 10
+
+
+def default_cache_dir() -> Path:
+    """The cache directory from the GLOBAL_HYDROGRAPHY_CACHE_DIR environment
+    variable, or '~/.cache/global_hydrography'"""
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+    return Path.home() / ".cache" / "global_hydrography"
+
+
+def is_offline() -> bool:
+    """True if the GLOBAL_HYDROGRAPHY_OFFLINE environment variable is set"""
+    return os.environ.get(OFFLINE_ENV, "").lower() in ("1", "true", "yes")
+
+
+class MetadataCache:
+    """Versioned on-disk cache of JSON metadata, shared across processes
+
+    Entries are read from, in order:
+    1. the cache, if younger than the TTL;
+    2. the fetch function, unless offline, writing the cache;
+    3. the cache, however old;
+    4. the snapshot bundled with the package.
+
+    Entries are written to a temporary file and renamed, so readers never
+    see a partial entry. A lock file makes one process fetch an entry while
+    others wait for it, instead of all fetching it at once. The fetching
+    process touches the lock file while it runs, so others only remove it
+    once it has gone untouched for LOCK_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = None,
+        ttl: float = DEFAULT_TTL,
+        offline: bool = None,
+        snapshot_dir: Path = SNAPSHOT_DIR,
+    ) -> None:
+        """
+        Parameters:
+            cache_dir: Directory of the cache. Defaults to `default_cache_dir()`.
+            ttl: Seconds before an entry is fetched again. Defaults to 30 days.
+            offline: If True, never fetch. Defaults to `is_offline()`.
+            snapshot_dir: Directory of bundled snapshots.
+        """
+        cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.__dir = cache_dir / f"v{METADATA_CACHE_VERSION}"
+        self.__ttl = ttl
+        self.__offline = is_offline() if offline is None else offline
+        self.__snapshot_dir = Path(snapshot_dir)
+
+    @property
+    def cache_dir(self) -> Path:
+        return self.__dir
+
+    @property
+    def offline(self) -> bool:
+        return self.__offline
+
+    def path(self, name: str) -> Path:
+        """Path of a cache entry"""
+        return self.__dir / f"{name}.json"
+
+    def get(self, name: str, fetch: Callable[[], Any]) -> Any:
+        """Returns the data of a cache entry, fetching it if needed.
+
+        Parameters:
+            name: Name of the entry.
+            fetch: Function returning the JSON-serializable data.
+
+        Raises:
+            LookupError: If the entry is not cached, cannot be fetched and
+                has no snapshot.
+        """
+        entry = self.__read(self.path(name))
+        if entry is not None and self.__is_fresh(entry):
+            return entry["data"]
+
+        if not self.__offline:
+            try:
+                return self.__fetch(name, fetch)
+            except Exception as e:
+                logger.warning(f"Unable to fetch metadata '{name}', with exception `{e!r}`")
+
+        if entry is not None:
+            logger.warning(
+                f"Using metadata '{name}' cached "
+                f"{(time.time() - entry['fetched_at']) / 86400:.0f} days ago"
+            )
+            return entry["data"]
+
+        entry = self.__read(self.__snapshot_dir / f"{name}.json")
+        if entry is not None:
+            logger.warning(f"Using bundled snapshot of metadata '{name}'")
+            return entry["data"]
+
+        raise LookupError(
+            f"Metadata '{name}' is not cached in {self.__dir}, "
+            f"{'is not fetched offline' if self.__offline else 'could not be fetched'}, "
+            f"and has no bundled snapshot in {self.__snapshot_dir}. Write the "
+            f"snapshots on a machine with internet access with "
+            f"`python -m global_hydrography.metadata`."
+        )
+
+    def invalidate(self, name: str) -> None:
+        """Remove a cache entry, so it is fetched again"""
+        self.path(name).unlink(missing_ok=True)
+
+    def save_snapshot(self, name: str) -> Path:
+        """Copy a cache entry to the bundled snapshots, for offline use"""
+        path = self.__snapshot_dir / f"{name}.json"
+        self.__snapshot_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self.path(name), path)
+        return path
+
+    def __is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["fetched_at"] < self.__ttl
+
+    @staticmethod
+    def __read(path: Path) -> dict | None:
+        """Read an entry, ignoring missing, corrupt or other version entries"""
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != METADATA_CACHE_VERSION:
+            return None
+        return entry
+
+    def __fetch(self, name: str, fetch: Callable[[], Any]) -> Any:
+        self.__dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(name)
+        lock_path = path.with_suffix(".lock")
+
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                # another process is fetching, so use its entry once written
+                entry = self.__read(path)
+                if entry is not None and self.__is_fresh(entry):
+                    return entry["data"]
+                if self.__is_stale(lock_path):
+                    # the lock was left by a process that died
+                    logger.warning(f"Removing stale lock {lock_path}")
+                    lock_path.unlink(missing_ok=True)
+                time.sleep(0.1)
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(
+            target=self.__heartbeat, args=(lock_path, stop_heartbeat), daemon=True,
+        )
+        heartbeat.start()
+        try:
+            os.close(fd)
+            # another process may have written the entry before we got the lock
+            entry = self.__read(path)
+            if entry is not None and self.__is_fresh(entry):
+                return entry["data"]
+            logger.info(f"Fetching metadata '{name}'")
+            data = fetch()
+            entry = {
+                "version": METADATA_CACHE_VERSION,
+                "name": name,
+                "fetched_at": time.time(),
+                "data": data,
+            }
+            temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+            return data
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            lock_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def __is_stale(lock_path: Path) -> bool:
+        """True if the lock file has not been touched for LOCK_TIMEOUT"""
+        try:
+            return time.time() - lock_path.stat().st_mtime > LOCK_TIMEOUT
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def __heartbeat(lock_path: Path, stop: threading.Event) -> None:
+        """Touch the lock file every LOCK_HEARTBEAT seconds until stopped"""
+        while not stop.wait(LOCK_HEARTBEAT):
+            try:
+                os.utime(lock_path)
+            except FileNotFoundError:
+                return
+
+
+def main() -> None:
+    """Fetch every metadata entry and save it as a bundled snapshot"""
+    import fsspec
+    # imported here, as both modules read their metadata through this one
+    from global_hydrography.io import TDXHydroDownloader
+    from global_hydrography.preprocess import TDXPreprocessor
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--cache-dir", type=Path, default=None)
+    parser.add_argument("--snapshot-dir", type=Path, default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # a TTL of 0 fetches every entry again
+    cache = MetadataCache(
+        args.cache_dir, ttl=0, offline=False, snapshot_dir=args.snapshot_dir,
+    )
+    TDXPreprocessor(cache).tdx_header_crosswalk
+    with tempfile.TemporaryDirectory() as download_dir:
+        # a synchronous filesystem, as the default needs an event loop
+        TDXHydroDownloader(
+            fsspec.filesystem("http"), download_dir, metadata_cache=cache,
+        ).get_hybas_ids()
+    for name in (TDX_HEADER_CROSSWALK, HYBAS_IDS):
+        logger.info(f"Saved snapshot of '{name}' to {cache.save_snapshot(name)}")
+
+
+if __name__ == "__main__":
+    main()
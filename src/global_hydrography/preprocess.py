@@ -1,13 +1,58 @@
+import numpy as np
 from pandas import DataFrame
 import requests
 
+from global_hydrography import instrument
+from global_hydrography.metadata import MetadataCache, TDX_HEADER_CROSSWALK
+
 GEOGLOW_TDX_HEADER_URL = "https://geoglows-v2.s3-us-west-2.amazonaws.com/tdxhydro-processing/tdx_header_numbers.json"
 
+# Global LINKNOs are LINKNO + TDX_HEADER_NUMBER * GLOBAL_LINKNO_MULTIPLIER,
+# so local LINKNOs must be less than this to stay unique.
+GLOBAL_LINKNO_MULTIPLIER = 10_000_000
+
+LINKNO_FIELDS = [
+    "LINKNO", "DSLINKNO", "USLINKNO1", "USLINKNO2", # For streamnet files
+    'streamID', # For basins files. Identical to "LINKNO".
+]
+
+
+def global_linkno_dtype(header_id: int) -> np.dtype:
+    """Smallest integer dtype holding every global LINKNO of a TDX header.
+
+    The dtype depends only on the header, never on the data, so every batch
+    or file of a region gets the same dtype. int32 holds the global LINKNOs
+    of headers up to 213; higher headers need int64.
+
+    Raises:
+        OverflowError: If the header's global LINKNOs do not fit in int64.
+    """
+    largest = (header_id + 1) * GLOBAL_LINKNO_MULTIPLIER - 1
+    for dtype in (np.int32, np.int64):
+        if largest <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f"Global LINKNOs of TDX header {header_id} overflow int64.")
+
+
+def fetch_tdx_header_crosswalk() -> dict[str, int]:
+    """Downloads the GEOGLOWS TDX header crosswalk"""
+    response = requests.get(GEOGLOW_TDX_HEADER_URL, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
 
 class TDXPreprocessor:
 
     __tdx_header_crosswalk = None
 
+    def __init__(self, metadata_cache: MetadataCache = None) -> None:
+        """
+        Parameters:
+            metadata_cache: Cache of the TDX header crosswalk. Defaults to a
+                `MetadataCache` in the default cache directory.
+        """
+        self.__metadata_cache = metadata_cache if metadata_cache else MetadataCache()
+
     @property
     def tdx_header_crosswalk(self) -> dict[int, int]:
         """Getter method for tdx header lookup dictionary
@@ -22,12 +67,16 @@ class TDXPreprocessor:
         if self.__tdx_header_crosswalk is not None:
             return self.__tdx_header_crosswalk
 
-        response = requests.get(GEOGLOW_TDX_HEADER_URL)
+        # otherwise read it from the on-disk cache, fetching it if needed
+        crosswalk = self.__metadata_cache.get(
+            TDX_HEADER_CROSSWALK, fetch_tdx_header_crosswalk,
+        )
         self.__tdx_header_crosswalk = {
-            int(k): int(v) for k, v in response.json().items()
+            int(k): int(v) for k, v in crosswalk.items()
         }
         return self.__tdx_header_crosswalk
 
+    @instrument.stage('global LINKNO')
     def tdx_to_global_linkno(
         self,
         df: DataFrame,
@@ -37,6 +86,9 @@ class TDXPreprocessor:
 
         This includes the LINKNO field but also the upstream and downstream links
 
+        All link fields are converted together in a single NumPy pass, to
+        the dtype given by `linkno_dtype`.
+
         This operation is based off Geoglows V2 approach using the following equation.
         `LINKNO_NEW = LINKNO_OLD + (TDX_HEADER_NUMBER * 10_000_000)`
 
@@ -57,27 +109,90 @@ class TDXPreprocessor:
             DataFrame:
                 A DataFrame or GeoDataFrame with the appropriate globally unique conversions applied to to linkid fields.
 
-
+        Raises:
+            OverflowError: If a local LINKNO is too large to be made globally unique.
         """
 
-        fields = [
-            "LINKNO", "DSLINKNO", "USLINKNO1", "USLINKNO2", # For streamnet files
-            'streamID', # For basins files. Identical to "LINKNO".
-        ]
+        fields_to_use = self.__link_fields(df)
+        if not fields_to_use:
+            return df
+
+        header_id = self.__header_id(tdx_hydro_region)
+        dtype = global_linkno_dtype(header_id)
+
+        # all link fields at once, checked before casting to the output dtype
+        values = df[fields_to_use].to_numpy()
+        if values.size and values.max() >= GLOBAL_LINKNO_MULTIPLIER:
+            raise OverflowError(
+                f"Local LINKNO {values.max()} is not less than "
+                f"{GLOBAL_LINKNO_MULTIPLIER}, so it would overlap the global "
+                f"LINKNOs of the next TDX header."
+            )
+        values = values.astype(dtype)
+        # note that fields with -1 indicate no link and we do not
+        # want to transform those, which is why we have this where
+        np.add(
+            values, header_id * GLOBAL_LINKNO_MULTIPLIER, 
+            out=values, where=values > -1,
+        )
+        df[fields_to_use] = values
+        return df
 
-        # Only use fields if in df
-        fields_to_use = []
-        for field in fields:
-            if any(df.columns.isin([field])):
-                fields_to_use.append(field)
-
-        header_id = int(self.tdx_header_crosswalk[tdx_hydro_region])
-        for field in fields_to_use:
-            # note that fields with -1 indicate no link and we do not
-            # want to transform those, which is why we have this loc statement
-            df.loc[df[field] > -1, field] += header_id * 10_000_000
+    def global_to_tdx_linkno(
+        self,
+        df: DataFrame,
+        tdx_hydro_region: int,
+    ) -> DataFrame:
+        """Transforms globally unique LINKNO fields back to the native LINKNOs
+        of the TDXHydroRegion dataset, the inverse of `tdx_to_global_linkno`.
+        Fields are converted to int32.
+
+        Parameters:
+            df: DataFrame
+                A pandas.DataFrame or geopandas.GeoDataFrame object.
+            tdx_hydro_region: int
+                The 10-digit integer id of the TDX Hydro dataset.
+
+        Return:
+            DataFrame:
+                A DataFrame or GeoDataFrame with native LINKNOs.
+
+        Raises:
+            ValueError: If a LINKNO is not a global LINKNO of tdx_hydro_region.
+        """
+        fields_to_use = self.__link_fields(df)
+        if not fields_to_use:
+            return df
+
+        offset = self.__header_id(tdx_hydro_region) * GLOBAL_LINKNO_MULTIPLIER
+        values = df[fields_to_use].to_numpy(dtype=np.int64, copy=True)
+        has_link = values > -1
+        linked = values[has_link]
+        if linked.size and (
+            linked.min() < offset
+            or linked.max() >= offset + GLOBAL_LINKNO_MULTIPLIER
+        ):
+            raise ValueError(
+                f"LINKNOs are not all global LINKNOs of TDX Hydro Region "
+                f"{tdx_hydro_region}."
+            )
+        np.subtract(values, offset, out=values, where=has_link)
+        df[fields_to_use] = values.astype(np.int32)
         return df
 
+    def linkno_dtype(self, tdx_hydro_region: int) -> np.dtype:
+        """The dtype of global LINKNO fields from `tdx_to_global_linkno`,
+        for keeping parquet schemas compact. See `global_linkno_dtype`."""
+        return global_linkno_dtype(self.__header_id(tdx_hydro_region))
+
+    def __header_id(self, tdx_hydro_region: int) -> int:
+        return int(self.tdx_header_crosswalk[int(tdx_hydro_region)])
+
+    @staticmethod
+    def __link_fields(df: DataFrame) -> list[str]:
+        """Link fields in df"""
+        return [field for field in LINKNO_FIELDS if field in df.columns]
+
 
     def tdx_drop_useless_columns(
         self,
@@ -1,17 +1,24 @@
 from pathlib import Path
-import re
-import pyogrio
+from typing import NamedTuple
+import numpy as np
 import geopandas as gpd
 import pandas as pd
 
-from global_hydrography.delineation.mnsi import MNSI_FIELDS
-from global_hydrography.preprocess import TDXPreprocessor
-from global_hydrography.delineation.mnsi import MNSI_FIELDS, DISCOVER, FINISH, ROOT
-from global_hydrography.delineation import subset_network
+from global_hydrography import instrument
+from global_hydrography.delineation.mnsi import (
+    MNSI_FIELDS, FINISH, link_dtype, link_positions,
+    DISSOLVE_ROOT_ID, ELEMENT_COUNT, DISSOLVE_LEVEL, PARENT_DISSOLVE_ROOT_ID,
+    dissolve_root_field,
+)
 
 
-DISSOLVE_ROOT_ID = "DISSOLVE_ROOT_ID"
-ELEMENT_COUNT = "ELEMENT_COUNT"
+# (max_elements, min_elements) for each level of nested dissolve groups,
+# from finest to coarsest. Coarser groups are built from whole finer groups.
+DISSOLVE_LEVELS = (
+    (200, 125),
+    (5_000, 3_000),
+    (100_000, 60_000),
+)
 
 
 def select_tdx_files(
@@ -44,6 +51,49 @@ def select_tdx_files(
     return (streamnet_filepath, basins_filepath)
 
 
+class LinkMatch(NamedTuple):
+    """Row positions of basins and streams, matched by LINKNO"""
+    # basins with a stream, and the positions of their streams
+    basins: np.ndarray
+    streams: np.ndarray
+    # basins without a stream, and streams without a basin
+    basins_no_stream: np.ndarray
+    streams_no_basin: np.ndarray
+
+    def stats(self) -> dict[str, int]:
+        """Number of matched basins, basins without a stream and streams
+        without a basin"""
+        return {
+            'matched': len(self.basins),
+            'basins_no_stream': len(self.basins_no_stream),
+            'streams_no_basin': len(self.streams_no_basin),
+        }
+
+
+def match_basins_to_streams(
+    basins_links: np.ndarray,
+    streams_links: np.ndarray,
+) -> LinkMatch:
+    """Match basins to streams by LINKNO, with sorted binary searches on the
+    LINKNO arrays rather than a DataFrame merge.
+
+    Parameters:
+        basins_links: LINKNO of each basins row.
+        streams_links: LINKNO of each streams row.
+
+    Returns: A LinkMatch of row positions, each in row order.
+    """
+    stream_pos = __positions_in(basins_links, streams_links)
+    has_stream = stream_pos > -1
+    has_basin = __positions_in(streams_links, basins_links) > -1
+    return LinkMatch(
+        basins=np.flatnonzero(has_stream),
+        streams=stream_pos[has_stream],
+        basins_no_stream=np.flatnonzero(~has_stream),
+        streams_no_basin=np.flatnonzero(~has_basin),
+    )
+
+
 def create_basins_mnsi(
     basins_gdf: gpd.GeoDataFrame,
     streams_mnsi_gdf: gpd.GeoDataFrame,
@@ -51,37 +101,83 @@ def create_basins_mnsi(
 ) -> tuple[gpd.GeoDataFrame]:
     """Create Basins GeoDataFrame with MNSI fields from streamnet_mnsi_gdf.
 
+    Basins are matched to streams by `match_basins_to_streams`, and the 
+    fields are attached to a shallow copy of the basins, so geometries are 
+    not copied. Basins without a stream are dropped, as with the right join
+    this replaces, but basins keep their input order.
+
     Parameters:
-        basins_gdf: TDX Streamreach Basins dataset, with 'streamID' renamed to 'LINKNO'.
-        streams_mnsi_gdf: TDX Stream Network dataset with MNSI fields added.
+        basins_gdf: TDX Streamreach Basins dataset, with 'streamID' renamed 
+            to 'LINKNO', and LINKNO as index.
+        streams_mnsi_gdf: TDX Stream Network dataset with MNSI fields added,
+            and LINKNO as index.
+        fields_to_copy: Fields to copy from streams to basins.
 
     Return: A tuple of GeoDataFrames
-        basins_mnsi_gdf: A copy of the basins_gdf appended with three MNSI fields.
+        basins_mnsi_gdf: The basins_gdf appended with the fields_to_copy.
         streams_no_basin_gdf: A gdf of the streamnet LINKs that have no associated basins.
     """
-
-    # Perform a right join, for all rows in streamnet,
-    # potentially creating some rows with no basin geometries
-    basins_mnsi_gdf = pd.merge(
-        basins_gdf,
-        streams_mnsi_gdf[fields_to_copy],
-        how="right",
-        on="LINKNO",
-    )
-    # Save streamnet rows that don't have a basin geometry
-    streams_no_basin_gdf = streams_mnsi_gdf.loc[
-        basins_mnsi_gdf[basins_mnsi_gdf.geometry == None].index
-    ].copy(deep=True)
-
-    # Drop no-geometry rows from basins gdf
-    basins_mnsi_gdf.drop(
-        streams_no_basin_gdf.index.to_list(),
-        inplace=True,
+    basins_mnsi_gdf, match = join_basins_mnsi(
+        basins_gdf, streams_mnsi_gdf, fields_to_copy,
     )
+    streams_no_basin_gdf = streams_mnsi_gdf.iloc[match.streams_no_basin]
 
     return (basins_mnsi_gdf, streams_no_basin_gdf)
 
 
+def join_basins_mnsi(
+    basins_df: pd.DataFrame,
+    streams_mnsi_df: pd.DataFrame,
+    fields_to_copy:list[str]=MNSI_FIELDS
+) -> tuple[pd.DataFrame, LinkMatch]:
+    """Copy fields from streams to the matching basins, as in 
+    `create_basins_mnsi`, also returning the match, so columns kept outside 
+    the DataFrames, such as WKB geometries, can be taken to follow the rows.
+
+    Parameters:
+        basins_df: Basins (Geo)DataFrame with LINKNO as index.
+        streams_mnsi_df: Streams (Geo)DataFrame with MNSI fields added, and 
+            LINKNO as index.
+        fields_to_copy: Fields to copy from streams to basins.
+
+    Return: A tuple
+        basins_mnsi_df: A shallow copy of the basins with a stream, 
+            appended with the fields_to_copy.
+        match: The LinkMatch of basins to streams.
+    """
+    with instrument.stage('match basins to streams', rows=len(basins_df)):
+        match = match_basins_to_streams(
+            basins_df.index.to_numpy(), 
+            streams_mnsi_df.index.to_numpy(),
+        )
+    stats = match.stats()
+    print(f"    Matched {stats['matched']} basins to streams, "
+          f"{stats['basins_no_stream']} basins without a stream, "
+          f"{stats['streams_no_basin']} streams without a basin.")
+
+    if len(match.basins_no_stream):
+        basins_mnsi_df = basins_df.iloc[match.basins].copy(deep=False)
+    else:
+        basins_mnsi_df = basins_df.copy(deep=False)
+    for field in fields_to_copy:
+        basins_mnsi_df[field] = streams_mnsi_df[field].to_numpy()[match.streams]
+
+    return (basins_mnsi_df, match)
+
+
+def __positions_in(values: np.ndarray, links: np.ndarray) -> np.ndarray:
+    """Position in links of each of values, or -1 if not in links"""
+    positions = np.full(len(values), -1, dtype=np.int64)
+    if not len(links):
+        return positions
+    sorter = np.argsort(links, kind="stable")
+    found = np.searchsorted(links, values, sorter=sorter)
+    found = np.minimum(found, len(links) - 1)
+    matched = links[sorter[found]] == values
+    positions[matched] = sorter[found[matched]]
+    return positions
+
+
 def compute_dissolve_groups(
     gdf: gpd.GeoDataFrame,
     max_elements: int = 200,
@@ -89,8 +185,16 @@ def compute_dissolve_groups(
 ) -> gpd.GeoDataFrame:
     """Adds additional field to indicating downstream most linkid of dissolve group
 
+    Groups are cut in a single pass from the headwaters down. Each reach's
+    ELEMENT_COUNT is the number of upstream elements (itself included) not
+    already in a dissolve group. When a reach's count exceeds max_elements,
+    its upstream reaches with more than min_elements are cut into their own
+    dissolve groups; if that is not enough, the largest upstream reaches are
+    cut regardless of min_elements. Root reaches close the remaining group.
+
     Args:
-        gdf (gpd.GeoDataFrame): Hydrography dataset with MNSI fields and LINKNO as index
+        gdf (gpd.GeoDataFrame): Hydrography dataset with MNSI fields, upstream
+            and downstream link fields, and LINKNO as index
         max_elements (int, optional): Maximum number of upstream elements to pre-dissolve.
             Defaults to 200.
         min_elements (int, optional): Minimum number of upstream elements to pre-dissolve.
@@ -106,95 +210,265 @@ def compute_dissolve_groups(
     """
     if min_elements < 2:
         raise ValueError("min_elements needs to be greater than two.")
-    _min_elements = min_elements
 
-    # we are going to be mutating the dataframe, so let's make a copy
-    gdf = gdf.copy(deep=True)
-
-    # we'll use the upstream element count for aggregation, initial this can be
-    # determined using nested set indices. Later we'll need a new method.
+    with instrument.stage('dissolve groups', rows=len(gdf)) as stage:
+        links, ds_pos, _, _ = link_positions(gdf)
+        levels = __levels_from_parent(ds_pos)
+
+        element_count, group_root = __accumulate_element_counts(
+            levels, ds_pos, np.ones(len(links), dtype=np.int64), links,
+            max_elements, min_elements,
+        )
+        dissolve_root_id = __propagate_dissolve_root_ids(
+            levels, ds_pos, np.where(group_root, links, -1),
+        )
+        # each level is one iteration of the accumulation loop
+        stage.iterations += len(levels)
+
+    # add columns to a shallow copy, so geometry isn't duplicated
+    gdf = gdf.copy(deep=False)
     insert_loc = gdf.columns.get_loc(FINISH) + 1
-    gdf.insert(insert_loc, ELEMENT_COUNT, gdf[FINISH] - gdf[DISCOVER])
-    gdf.insert(insert_loc+1, DISSOLVE_ROOT_ID, None)
-
-    previous = gdf[ROOT].count()
-    while gdf.loc[gdf[DISSOLVE_ROOT_ID].isnull(), ROOT].count() > max_elements:
-        gdf = __identify_dissolve_groups(gdf, max_elements, _min_elements)
-        remaining = gdf.loc[gdf[DISSOLVE_ROOT_ID].isnull(), ROOT].count()
-        print(f"    Previous elements {previous}, new elements {remaining}")
-        # if we failed to make any dissolve progress, lower the threshold.
-        if previous == remaining:
-            _min_elements -= 25
-            print(f"    No progress was made. New min threshold is {_min_elements}")
-            continue
-        elif _min_elements != min_elements:
-            _min_elements = min_elements
-            print(f"    Min threshold reset to {min_elements}")
-
-        previous = remaining
-
-        gdf = __update_element_counts(gdf)
-
-    gdf[DISSOLVE_ROOT_ID] = gdf[DISSOLVE_ROOT_ID].astype('int32')
-    # gdf = gdf.drop(columns=[ELEMENT_COUNT])
-    print(f"    Dissolve Groups completed!")
+    gdf.insert(insert_loc, ELEMENT_COUNT, element_count.astype('int32'))
+    # group ids are LINKNOs, so they keep the LINKNO dtype
+    gdf.insert(insert_loc+1, DISSOLVE_ROOT_ID, dissolve_root_id.astype(link_dtype(gdf)))
+
+    print(f"    Dissolve Groups completed! {group_root.sum()} groups "
+          f"from {len(gdf)} elements.")
     return gdf
 
 
-def __update_element_counts(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Update element count to exclude elements already in dissolve group"""
-    sub = gdf.loc[gdf[DISSOLVE_ROOT_ID].isnull()]
+def compute_nested_dissolve_groups(
+    gdf: gpd.GeoDataFrame,
+    dissolve_levels: tuple[tuple[int, int]] = DISSOLVE_LEVELS,
+) -> gpd.GeoDataFrame:
+    """Adds a dissolve group id field for each of several nested levels
+
+    The first level is computed by `compute_dissolve_groups`, adding the
+    ELEMENT_COUNT and DISSOLVE_ROOT_ID fields. Each coarser level groups whole
+    groups of the level below, so every group is the union of groups at the
+    finer levels. Coarser levels are stored in fields named by
+    `dissolve_root_field()`, e.g. DISSOLVE_ROOT_ID_1.
 
-    # define help function with knowledge of sub
-    def __count(x) -> int:
-        return subset_network(sub, x)[ROOT].count()
+    Args:
+        gdf (gpd.GeoDataFrame): Hydrography dataset with MNSI fields, upstream
+            and downstream link fields, and LINKNO as index
+        dissolve_levels (tuple, optional): (max_elements, min_elements) for
+            each level, from finest to coarsest, counted in reaches.
+            Defaults to DISSOLVE_LEVELS.
 
-    # loop elements in the subset, updating the corresponding element in
-    # parent data frame
-    for i in sub.index:
-        gdf.loc[i, ELEMENT_COUNT] = __count(i)
+    Returns:
+        gpd.GeoDataFrame: Modified GeoDataFrame with a dissolve group id for
+            each level
+    """
+    max_elements, min_elements = dissolve_levels[0]
+    gdf = compute_dissolve_groups(gdf, max_elements, min_elements)
+
+    links, ds_pos, _, _ = link_positions(gdf)
+    for level, (max_elements, min_elements) in enumerate(dissolve_levels[1:], 1):
+        finer_ids = gdf[dissolve_root_field(level - 1)].to_numpy()
+
+        # contract the network into a tree of the finer groups, with each
+        # group weighted by the number of reaches it contains
+        group_links, group_of_reach = np.unique(finer_ids, return_inverse=True)
+        group_pos = np.flatnonzero(links == finer_ids)
+        group_pos = group_pos[np.argsort(links[group_pos])]
+        group_ds_pos = ds_pos[group_pos]
+        group_parent = np.where(
+            group_ds_pos > -1, group_of_reach[group_ds_pos], -1,
+        )
+        weight = np.bincount(group_of_reach, minlength=len(group_links))
+
+        with instrument.stage(
+            f'dissolve groups level {level}', rows=len(group_links),
+        ) as stage:
+            group_levels = __levels_from_parent(group_parent)
+            _, group_root = __accumulate_element_counts(
+                group_levels, group_parent, weight, group_links,
+                max_elements, min_elements,
+            )
+            coarse_ids = __propagate_dissolve_root_ids(
+                group_levels, group_parent, np.where(group_root, group_links, -1),
+            )
+            stage.iterations += len(group_levels)
+
+        gdf.insert(
+            gdf.columns.get_loc(dissolve_root_field(level - 1)) + 1,
+            dissolve_root_field(level),
+            coarse_ids[group_of_reach].astype(link_dtype(gdf)),
+        )
+        print(f"    Dissolve level {level} completed! {group_root.sum()} groups "
+              f"from {len(group_links)} level {level - 1} groups.")
     return gdf
 
 
-def __identify_dissolve_groups(
-    gdf: gpd.GeoDataFrame,
-    max_elements: int,
-    min_elements: int,
+def create_dissolve_groups_pyramid(
+    basins_gdf: gpd.GeoDataFrame,
+    streams_gdf: gpd.GeoDataFrame,
+    n_levels: int = len(DISSOLVE_LEVELS),
 ) -> gpd.GeoDataFrame:
-    # the stop condition is when all upstream not already in a dissolve group and within
-    # the grouping have been exhausted
-    while (
-        gdf.loc[
-            (gdf[DISSOLVE_ROOT_ID].isnull()) & (gdf[ELEMENT_COUNT] <= max_elements),
-            ELEMENT_COUNT,
-        ].max()
-        > min_elements
-    ):
-        # find the element with the largest element count still above the processing threshold
-        # we want to process largest first because otherwise we'd pre-dissolve the upstream
-        # elements and then pre-dissolve them again with the downstream element (inefficient).
-        df = gdf.loc[
-            (gdf[DISSOLVE_ROOT_ID].isnull()) & (gdf[ELEMENT_COUNT] <= max_elements)
-        ]
-        element = df.sort_values([ELEMENT_COUNT], ascending=False).iloc[0]
-        # dissolve the polygon using helper function
-        gdf = __tag_dissolve_group(gdf, element.name)
-
-    return gdf
+    """Dissolve basins into one polygon per group, for each nested level
 
+    Parameters:
+        basins_gdf: Basins dataset with dissolve group fields from
+            `compute_nested_dissolve_groups`, with LINKNO as index.
+        streams_gdf: Stream Network dataset with MNSI and dissolve group fields,
+            with LINKNO as index. Used for the attributes of group roots that
+            may not have a basin geometry.
+        n_levels: Number of nested dissolve levels to create.
+
+    Returns: A GeoDataFrame with one row per group per level and fields
+        DISSOLVE_LEVEL: the level of the group, 0 being the finest.
+        DISSOLVE_ROOT_ID: LINKNO of the downstream most element of the group.
+        PARENT_DISSOLVE_ROOT_ID: the group containing this one at the next
+            coarser level, or -1 for the coarsest level.
+        ROOT_ID, FINISH_TIME, DISCOVER_TIME: MNSI fields of the group root.
+        ELEMENT_COUNT: number of reaches in the group.
+    """
+    pyramid = []
+    previous = None
+    for level in range(n_levels):
+        field = dissolve_root_field(level)
+
+        # each level is dissolved from the polygons of the level below
+        source = basins_gdf if previous is None else previous
+        with instrument.stage(f'dissolve pyramid level {level}', rows=len(source)):
+            dissolved = source[[field, source.geometry.name]].dissolve(
+                by=field, method='coverage',
+            )
+        dissolved.index.name = DISSOLVE_ROOT_ID
+
+        group_roots = streams_gdf.loc[dissolved.index]
+        if level + 1 < n_levels:
+            parent_ids = group_roots[dissolve_root_field(level + 1)].to_numpy()
+        else:
+            parent_ids = np.full(len(dissolved), -1)
+        element_count = streams_gdf[field].value_counts()
+
+        dissolved.insert(0, DISSOLVE_LEVEL, np.int8(level))
+        dissolved.insert(
+            1, PARENT_DISSOLVE_ROOT_ID, parent_ids.astype(dissolved.index.dtype),
+        )
+        for i, f in enumerate(MNSI_FIELDS, 2):
+            dissolved.insert(i, f, group_roots[f].to_numpy())
+        dissolved.insert(
+            2 + len(MNSI_FIELDS),
+            ELEMENT_COUNT,
+            element_count.loc[dissolved.index].to_numpy().astype('int32'),
+        )
+        pyramid.append(dissolved.reset_index())
+
+        # carry the next level's group id, to dissolve the next level from
+        if level + 1 < n_levels:
+            previous = dissolved.assign(
+                **{dissolve_root_field(level + 1): parent_ids}
+            )
+
+    return gpd.GeoDataFrame(
+        pd.concat(pyramid, ignore_index=True),
+        crs=basins_gdf.crs,
+    )
 
-def __tag_dissolve_group(gdf: gpd.GeoDataFrame, linkid: int) -> gpd.GeoDataFrame:
-    """Dissolves polygons upstream of linkid and places them in gdf"""
 
-    # subset network to only elements upstream of the linkid
-    sub = subset_network(gdf, linkid)
-    # further subset to only elements not already in dissolve group
-    sub = sub.loc[sub[DISSOLVE_ROOT_ID].isnull()]
+def __levels_from_parent(parent: np.ndarray) -> list[np.ndarray]:
+    """Splits a tree, given as each node's parent position, into depth levels
 
-    # get id's for the rows that are now represented by a dissolved polygon
-    elements = sub.index
+    Depths are found by pointer jumping, so it takes log(depth) vectorized
+    steps rather than one step per level.
 
-    # update elements to indicate they are part of this dissolve group
-    gdf.loc[elements, DISSOLVE_ROOT_ID] = linkid
+    Returns:
+        list of np.ndarray: positions of the nodes at each depth, roots first.
 
-    return gdf
+    Raises:
+        ValueError: If parent contains a cycle.
+    """
+    depth = (parent > -1).astype(np.int64)
+    ancestor = parent.copy()
+    for _ in range(len(parent).bit_length() + 2):
+        active = np.flatnonzero(ancestor > -1)
+        if not active.size:
+            break
+        jump = ancestor[active]
+        depth[active] += depth[jump]
+        ancestor[active] = ancestor[jump]
+    else:
+        raise ValueError("Stream network is not a tree; it contains a cycle.")
+
+    order = np.argsort(depth, kind='stable')
+    splits = np.flatnonzero(np.diff(depth[order])) + 1
+    return np.split(order, splits)
+
+
+def __accumulate_element_counts(
+    levels: list[np.ndarray],
+    parent: np.ndarray,
+    weight: np.ndarray,
+    ids: np.ndarray,
+    max_elements: int,
+    min_elements: int,
+) -> tuple[np.ndarray]:
+    """Count elements not yet in a dissolve group, cutting groups as needed
+
+    Levels are processed from the headwaters down, so the counts of the
+    upstream nodes are final by the time they are added to their parent.
+    Upstream nodes with equal counts are cut in order of their ids, so
+    groups don't depend on the row order of the nodes.
+
+    Returns: A tuple of arrays, in row order
+        element_count: remaining upstream elements, including the node itself
+        group_root: True where the node is the downstream most element of
+            a dissolve group
+    """
+    element_count = weight.astype(np.int64)
+    group_root = np.zeros(len(parent), dtype=bool)
+
+    for level in reversed(levels[1:]):
+        downstream = parent[level]
+        count = element_count[level]
+        np.add.at(element_count, downstream, count)
+
+        # cut upstream nodes large enough to be a group on their own
+        cut = (element_count[downstream] > max_elements) & (count > min_elements)
+        np.subtract.at(element_count, downstream[cut], count[cut])
+        group_root[level[cut]] = True
+
+        # if still too large, temporarily drop min_elements and cut the
+        # largest remaining upstream nodes until under max_elements
+        still_over = ~cut & (element_count[downstream] > max_elements)
+        if still_over.any():
+            nodes, downstream, count = (
+                level[still_over], downstream[still_over], count[still_over]
+            )
+            order = np.lexsort((ids[nodes], -count, downstream))
+            nodes, downstream, count = nodes[order], downstream[order], count[order]
+            # elements already cut from the same downstream node, largest first
+            cumulative = np.cumsum(count) - count
+            starts = np.r_[0, np.flatnonzero(np.diff(downstream)) + 1]
+            cumulative -= np.repeat(cumulative[starts], np.diff(np.r_[starts, len(nodes)]))
+            cut = cumulative < element_count[downstream] - max_elements
+            np.subtract.at(element_count, downstream[cut], count[cut])
+            group_root[nodes[cut]] = True
+
+    # roots close whatever group remains
+    if levels:
+        group_root[levels[0]] = True
+
+    return (element_count, group_root)
+
+
+def __propagate_dissolve_root_ids(
+    levels: list[np.ndarray],
+    parent: np.ndarray,
+    dissolve_root_id: np.ndarray,
+) -> np.ndarray:
+    """Pass each group root's id upstream to the rest of its group
+
+    dissolve_root_id holds the group id for group roots and -1 elsewhere.
+    """
+    dissolve_root_id = dissolve_root_id.copy()
+    for level in levels[1:]:
+        dissolve_root_id[level] = np.where(
+            dissolve_root_id[level] > -1,
+            dissolve_root_id[level],
+            dissolve_root_id[parent[level]],
+        )
+    return dissolve_root_id
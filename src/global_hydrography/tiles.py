@@ -0,0 +1,271 @@
+"""
+Global Hydrography zoom dependent, generalized layers of streams and basins
+for map rendering, written as vector tiles (MBTiles of MVT), so the web tier
+serves pre-cut tiles instead of full resolution geometry.
+"""
+
+from typing import NamedTuple
+
+import os
+import gzip
+import json
+import shutil
+import sqlite3
+import logging
+import tempfile
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+import geopandas as gpd
+import shapely
+import pyogrio
+
+from global_hydrography import instrument
+from global_hydrography.delineation.mnsi import (
+    LINK, ROOT, DISSOLVE_ROOT_ID, DISSOLVE_LEVEL, ELEMENT_COUNT,
+)
+
+logger = logging.getLogger(__name__)
+
+STREAMS_LAYER = "streams"
+BASINS_LAYER = "basins"
+STREAM_ORDER = "strmOrder"
+
+
+class ZoomBand(NamedTuple):
+    """Generalization of the streams and basins layers over a zoom range
+
+    Parameters:
+        min_zoom, max_zoom: Zoom levels of the band, inclusive.
+        min_stream_order: Lowest stream order of streams drawn.
+        dissolve_level: Level of the dissolve groups pyramid drawn as basins,
+            from `process.create_dissolve_groups_pyramid`, or None for the
+            individual basins.
+    """
+    min_zoom: int
+    max_zoom: int
+    min_stream_order: int
+    dissolve_level: int | None
+
+
+# Zoom bands from coarsest to finest. Dissolve levels index
+# `process.DISSOLVE_LEVELS`, whose groups hold up to 100k, 5k and 200 basins.
+TILE_ZOOM_BANDS = (
+    ZoomBand(0, 5, min_stream_order=7, dissolve_level=2),
+    ZoomBand(6, 8, min_stream_order=5, dissolve_level=1),
+    ZoomBand(9, 11, min_stream_order=3, dissolve_level=0),
+    ZoomBand(12, 14, min_stream_order=1, dissolve_level=None),
+)
+
+
+def pixel_size(zoom: int, tile_size: int = 256) -> float:
+    """Degrees of longitude per pixel at a zoom level, at the equator"""
+    return 360 / (tile_size * 2**zoom)
+
+
+def simplify_tolerance(band: ZoomBand) -> float:
+    """Half a pixel at the band's finest zoom, below which simplification
+    can't be seen, in degrees"""
+    return pixel_size(band.max_zoom) / 2
+
+
+def generalize_streams(
+    streams_gdf: gpd.GeoDataFrame,
+    band: ZoomBand,
+) -> gpd.GeoDataFrame:
+    """Streams of at least the band's stream order, simplified for its zooms.
+
+    Parameters:
+        streams_gdf: Stream Network dataset with MNSI fields, with LINKNO as
+            index, in EPSG:4326.
+        band: The zoom band.
+
+    Returns: A GeoDataFrame with LINKNO, strmOrder and ROOT_ID fields.
+    """
+    streams_gdf = streams_gdf.loc[
+        streams_gdf[STREAM_ORDER] >= band.min_stream_order,
+        [STREAM_ORDER, ROOT, streams_gdf.geometry.name],
+    ].reset_index()
+    streams_gdf.geometry = shapely.simplify(
+        streams_gdf.geometry.values, simplify_tolerance(band),
+        preserve_topology=True,
+    )
+    return streams_gdf
+
+
+def generalize_basins(
+    basins_gdf: gpd.GeoDataFrame,
+    groups_gdf: gpd.GeoDataFrame,
+    band: ZoomBand,
+) -> gpd.GeoDataFrame:
+    """Basins or dissolve groups of the band, simplified for its zooms.
+
+    Polygons are simplified together as a coverage, so shared edges are
+    simplified once and adjacent polygons keep no gaps or overlaps.
+
+    Parameters:
+        basins_gdf: Basins dataset with MNSI fields, with LINKNO as index,
+            in EPSG:4326.
+        groups_gdf: Dissolve groups pyramid of the same region.
+        band: The zoom band.
+
+    Returns: A GeoDataFrame with LINKNO (the basin or group root), ROOT_ID
+        and ELEMENT_COUNT fields.
+    """
+    if band.dissolve_level is None:
+        gdf = basins_gdf[[ROOT, basins_gdf.geometry.name]].reset_index()
+        gdf.insert(2, ELEMENT_COUNT, np.int32(1))
+    else:
+        gdf = groups_gdf.loc[
+            groups_gdf[DISSOLVE_LEVEL] == band.dissolve_level,
+            [DISSOLVE_ROOT_ID, ROOT, ELEMENT_COUNT, groups_gdf.geometry.name],
+        ].rename(columns={DISSOLVE_ROOT_ID: LINK}).reset_index(drop=True)
+    gdf.geometry = shapely.coverage_simplify(
+        gdf.geometry.values, simplify_tolerance(band),
+    )
+    return gdf
+
+
+def create_tiles(
+    streams_gdf: gpd.GeoDataFrame,
+    basins_gdf: gpd.GeoDataFrame,
+    groups_gdf: gpd.GeoDataFrame,
+    path: Path,
+    zoom_bands: tuple[ZoomBand] = TILE_ZOOM_BANDS,
+) -> Path:
+    """Generalize streams and basins for each zoom band and write them as
+    one MBTiles file of MVT tiles, with a 'streams' and a 'basins' layer.
+
+    Parameters:
+        streams_gdf: Stream Network dataset with MNSI fields, LINKNO as index.
+        basins_gdf: Basins dataset with MNSI fields, LINKNO as index.
+        groups_gdf: Dissolve groups pyramid of the same region.
+        path: Path of the MBTiles file to write.
+        zoom_bands: Non-overlapping zoom bands.
+
+    Returns: The path written to.
+    """
+    if streams_gdf.crs is not None and not streams_gdf.crs.equals("EPSG:4326"):
+        streams_gdf = streams_gdf.to_crs("EPSG:4326")
+        basins_gdf = basins_gdf.to_crs("EPSG:4326")
+        groups_gdf = groups_gdf.to_crs("EPSG:4326")
+
+    with tempfile.TemporaryDirectory(dir=Path(path).parent) as temp_dir:
+        sources = []
+        for band in zoom_bands:
+            layers = {
+                STREAMS_LAYER: lambda: generalize_streams(streams_gdf, band),
+                BASINS_LAYER: lambda: generalize_basins(basins_gdf, groups_gdf, band),
+            }
+            for layer, generalize in layers.items():
+                name = f"{layer} z{band.min_zoom}-{band.max_zoom}"
+                with instrument.stage(f"tiles {name}") as stage:
+                    gdf = generalize()
+                    stage.rows = len(gdf)
+                    if gdf.empty:
+                        logger.info(f"No features in {name}")
+                        continue
+                    source = Path(temp_dir) / f"{layer}_{band.min_zoom}.mbtiles"
+                    write_layer_tiles(gdf, source, layer, band)
+                sources.append(source)
+        if not sources:
+            raise ValueError("No features in any zoom band.")
+        merge_mbtiles(sources, path)
+    return path
+
+
+def write_layer_tiles(
+    gdf: gpd.GeoDataFrame,
+    path: Path,
+    layer: str,
+    band: ZoomBand,
+) -> Path:
+    """Write one layer over a zoom band as an MBTiles file, with GDAL's MVT
+    writer clipping and quantizing features to each tile"""
+    pyogrio.write_dataframe(
+        gdf, path, layer=layer, driver="MBTiles",
+        dataset_options={
+            "MINZOOM": band.min_zoom,
+            "MAXZOOM": band.max_zoom,
+            # already simplified for the band
+            "SIMPLIFICATION": 0,
+        },
+    )
+    return path
+
+
+def merge_mbtiles(sources: list[Path], path: Path) -> Path:
+    """Merge MBTiles files of MVT tiles into one, combining the layers of
+    tiles at the same position.
+
+    An MVT tile is a protobuf message of repeated layers, so the layers of
+    two tiles are combined by concatenating their uncompressed bytes. The
+    'json' metadata keeps the merged vector_layers, without tilestats.
+    """
+    temp_path = Path(path).with_suffix(f".{os.getpid()}.tmp")
+    temp_path.unlink(missing_ok=True)
+    shutil.copyfile(sources[0], temp_path)
+    # connections are closed, not just committed, before the file is moved
+    with closing(sqlite3.connect(temp_path)) as dst, dst:
+        metadata = dict(dst.execute("SELECT name, value FROM metadata"))
+        vector_layers = json.loads(metadata.get("json", "{}")).get("vector_layers", [])
+        bounds = [float(v) for v in metadata["bounds"].split(",")]
+
+        for source in sources[1:]:
+            with closing(sqlite3.connect(source)) as src:
+                rows = src.execute(
+                    "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+                )
+                for z, x, y, data in rows:
+                    existing = dst.execute(
+                        "SELECT tile_data FROM tiles WHERE zoom_level = ? "
+                        "AND tile_column = ? AND tile_row = ?", (z, x, y),
+                    ).fetchone()
+                    if existing is not None:
+                        data = gzip.compress(
+                            gzip.decompress(existing[0]) + gzip.decompress(data)
+                        )
+                    dst.execute(
+                        "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                        (z, x, y, data),
+                    )
+                source_metadata = dict(src.execute("SELECT name, value FROM metadata"))
+            vector_layers.extend(
+                json.loads(source_metadata.get("json", "{}")).get("vector_layers", [])
+            )
+            source_bounds = [float(v) for v in source_metadata["bounds"].split(",")]
+            bounds = [
+                *np.minimum(bounds[:2], source_bounds[:2]),
+                *np.maximum(bounds[2:], source_bounds[2:]),
+            ]
+
+        metadata.update(
+            name=Path(path).stem,
+            minzoom=str(min(layer["minzoom"] for layer in vector_layers)),
+            maxzoom=str(max(layer["maxzoom"] for layer in vector_layers)),
+            bounds=",".join(f"{v:.7f}" for v in bounds),
+            center=(
+                f"{(bounds[0] + bounds[2]) / 2:.7f},{(bounds[1] + bounds[3]) / 2:.7f},"
+                f"{min(layer['minzoom'] for layer in vector_layers)}"
+            ),
+            json=json.dumps({"vector_layers": __merge_vector_layers(vector_layers)}),
+        )
+        dst.execute("DELETE FROM metadata")
+        dst.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+    os.replace(temp_path, path)
+    return path
+
+
+def __merge_vector_layers(vector_layers: list[dict]) -> list[dict]:
+    """Merge vector_layers entries of the same layer over several zoom bands"""
+    merged = {}
+    for layer in vector_layers:
+        if layer["id"] not in merged:
+            merged[layer["id"]] = {**layer, "fields": dict(layer["fields"])}
+            continue
+        entry = merged[layer["id"]]
+        entry["minzoom"] = min(entry["minzoom"], layer["minzoom"])
+        entry["maxzoom"] = max(entry["maxzoom"], layer["maxzoom"])
+        entry["fields"].update(layer["fields"])
+    return list(merged.values())
@@ -0,0 +1,89 @@
+import sys
+import json
+from pathlib import Path
+
+import pytest
+
+# the package is used from src/, as by batch_process.py
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from global_hydrography.metadata import (  # noqa: E402
+    MetadataCache, METADATA_CACHE_VERSION, TDX_HEADER_CROSSWALK,
+)
+from global_hydrography.preprocess import TDXPreprocessor  # noqa: E402
+from global_hydrography.delineation.mnsi import (  # noqa: E402
+    LINK, MNSI_FIELDS, ELEMENT_COUNT, dissolve_root_field, modified_nest_set_index,
+)
+from global_hydrography.process import (  # noqa: E402
+    compute_nested_dissolve_groups, create_basins_mnsi,
+    create_dissolve_groups_pyramid,
+)
+from benchmarks.synthetic import synthetic_tdx_region  # noqa: E402
+
+TDX_HYDRO_REGION = 1020000010
+TDX_HEADER_NUMBER = 101
+# (max_elements, min_elements) of dissolve levels small enough for the
+# synthetic regions to have several groups at every level
+TEST_DISSOLVE_LEVELS = ((20, 12), (100, 60), (500, 300))
+
+
+@pytest.fixture
+def preprocessor(tmp_path: Path) -> TDXPreprocessor:
+    """A TDXPreprocessor reading the header crosswalk from a snapshot,
+    never from the internet"""
+    snapshot_dir = tmp_path / "snapshots"
+    snapshot_dir.mkdir()
+    with open(snapshot_dir / f"{TDX_HEADER_CROSSWALK}.json", "w") as f:
+        json.dump({
+            "version": METADATA_CACHE_VERSION,
+            "name": TDX_HEADER_CROSSWALK,
+            "fetched_at": 0,
+            "data": {str(TDX_HYDRO_REGION): TDX_HEADER_NUMBER},
+        }, f)
+    return TDXPreprocessor(MetadataCache(
+        cache_dir=tmp_path / "cache", offline=True, snapshot_dir=snapshot_dir,
+    ))
+
+
+@pytest.fixture
+def tdx_region_dir(tmp_path: Path) -> Path:
+    """A directory with a small synthetic region's raw TDX GeoPackages"""
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    streamnet_gdf, basins_gdf = synthetic_tdx_region(500, n_roots=5)
+    # layer metadata as in NGA's files, which `batch_process` prints
+    layer_metadata = {"DBF_DATE_LAST_UPDATE": "2023-05-01"}
+    streamnet_gdf.to_file(
+        input_dir / f"TDX_streamnet_{TDX_HYDRO_REGION}_01.gpkg",
+        layer_metadata=layer_metadata,
+    )
+    basins_gdf.to_file(
+        input_dir / f"TDX_streamreach_basins_{TDX_HYDRO_REGION}_01.gpkg",
+        layer_metadata=layer_metadata,
+    )
+    return input_dir
+
+
+@pytest.fixture(scope="session")
+def processed_region() -> tuple:
+    """A synthetic region processed in memory as by `batch_process`, with one
+    large tree and several small ones. Shared by tests, so not to be modified.
+
+    Returns: A tuple of GeoDataFrames
+        streams_gdf: streams with MNSI and dissolve group fields.
+        basins_gdf: basins with the same fields copied from streams.
+        groups_gdf: the dissolve groups pyramid.
+    """
+    streamnet_gdf, basins_gdf = synthetic_tdx_region(3_000, n_roots=5)
+    streams_gdf = modified_nest_set_index(streamnet_gdf).set_index(LINK)
+    streams_gdf = compute_nested_dissolve_groups(streams_gdf, TEST_DISSOLVE_LEVELS)
+    basins_gdf = basins_gdf.rename(columns={"streamID": LINK}).set_index(LINK)
+    basins_gdf, _ = create_basins_mnsi(basins_gdf, streams_gdf, [
+        *MNSI_FIELDS,
+        ELEMENT_COUNT,
+        *[dissolve_root_field(level) for level in range(len(TEST_DISSOLVE_LEVELS))],
+    ])
+    groups_gdf = create_dissolve_groups_pyramid(
+        basins_gdf, streams_gdf, n_levels=len(TEST_DISSOLVE_LEVELS),
+    )
+    return (streams_gdf, basins_gdf, groups_gdf)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from global_hydrography.delineation.aggregate import (
+    TDX_LENGTH, UPSTREAM_AREA, UPSTREAM_LENGTH,
+    UpstreamAggregator, add_upstream_aggregates,
+)
+from global_hydrography.delineation.delineate import subset_network
+from global_hydrography.delineation.mnsi import LINK, MNSIIndex, modified_nest_set_index
+from benchmarks.synthetic import synthetic_network
+
+
+@pytest.fixture
+def network() -> pd.DataFrame:
+    """A network with MNSI fields, an integer and a float column with gaps,
+    and LINKNO as index"""
+    df = modified_nest_set_index(synthetic_network(3_000, n_roots=20)).set_index(LINK)
+    rng = np.random.default_rng(0)
+    df["count"] = rng.integers(0, 1_000, len(df))
+    df["value"] = rng.random(len(df)) * 100
+    df.loc[df.index[::11], "value"] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_upstream_totals_match_brute_force(network, use_index):
+    mnsi_index = MNSIIndex(network) if use_index else None
+    aggregator = UpstreamAggregator(network, ["count", "value"], mnsi_index)
+    linkids = network.index[::13].to_numpy()
+
+    totals = aggregator.to_frame(linkids)
+
+    for linkid in linkids:
+        upstream = subset_network(network, linkid)
+        assert aggregator.total("count", linkid) == upstream["count"].sum()
+        assert aggregator.total("value", linkid) == pytest.approx(upstream["value"].sum())
+        assert totals.at[linkid, "count"] == upstream["count"].sum()
+        assert totals.at[linkid, "value"] == pytest.approx(upstream["value"].sum())
+    assert totals["count"].dtype == np.int64
+    assert np.array_equal(aggregator.totals("count"), aggregator.to_frame()["count"])
+
+    with pytest.raises(KeyError):
+        aggregator.total("count", network.index.max() + 1)
+
+
+def test_add_upstream_aggregates_match_brute_force(network):
+    """Reaches without a basin add no area, and basins without a reach are
+    ignored"""
+    rng = np.random.default_rng(1)
+    streams_df = network.assign(**{TDX_LENGTH: rng.random(len(network)) * 5_000})
+    basin_area = pd.Series(rng.random(len(network)), index=network.index)
+    basin_area = pd.concat([
+        basin_area.iloc[100:],
+        pd.Series([1e6], index=[network.index.max() + 1]),
+    ]).sample(frac=1, random_state=0)
+
+    result = add_upstream_aggregates(streams_df, basin_area)
+
+    for linkid in network.index[::13]:
+        upstream = subset_network(network, linkid).index
+        assert result.at[linkid, UPSTREAM_LENGTH] == pytest.approx(
+            streams_df.loc[upstream, TDX_LENGTH].sum() / 1000
+        )
+        assert result.at[linkid, UPSTREAM_AREA] == pytest.approx(
+            basin_area.reindex(upstream).sum()
+        )
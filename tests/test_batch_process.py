@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import signal
+import time
+
+import geopandas as gpd
+import pyarrow.parquet as pq
+
+import batch_process
+from global_hydrography import instrument
+from global_hydrography.io import TDXHydroDownloader
+from global_hydrography.preprocess import GLOBAL_LINKNO_MULTIPLIER
+
+from conftest import TDX_HYDRO_REGION, TDX_HEADER_NUMBER
+
+
+def test_convert_tdx_region_to_parquet_without_metrics(
+    tdx_region_dir, preprocessor, tmp_path, monkeypatch,
+):
+    monkeypatch.setattr(instrument, "_enabled", False)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+
+    paths = batch_process.convert_tdx_region_to_parquet(
+        tdx_region_dir, output_dir, TDX_HYDRO_REGION, preprocessor, batch_size=64,
+    )
+
+    streams_gdf, basins_gdf = (gpd.read_parquet(path) for path in paths)
+    assert len(streams_gdf) == len(basins_gdf) == 500
+    offset = TDX_HEADER_NUMBER * GLOBAL_LINKNO_MULTIPLIER
+    assert (streams_gdf["LINKNO"] >= offset).all()
+    assert (basins_gdf["LINKNO"] >= offset).all()
+
+
+def test_convert_tdx_region_to_parquet_counts_rows(
+    tdx_region_dir, preprocessor, tmp_path, monkeypatch,
+):
+    monkeypatch.setattr(instrument, "_enabled", True)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+
+    with instrument.collect() as metrics:
+        batch_process.convert_tdx_region_to_parquet(
+            tdx_region_dir, output_dir, TDX_HYDRO_REGION, preprocessor, batch_size=64,
+        )
+
+    streamed = [s for s in metrics.stages if s["stage"].startswith("stream ")]
+    assert [s["rows"] for s in streamed] == [500, 500]
+    assert [s["iterations"] for s in streamed] == [8, 8]
+
+
+
+def test_incremental_outputs_depend_on_arrow_native(
+    tdx_region_dir, preprocessor, tmp_path, monkeypatch,
+):
+    """Outputs written by one path are not reused when the other is asked
+    for, while a repeated run of the same path is"""
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    arrow_runs = []
+    process_arrow = batch_process.process_tdx_streams_basins_arrow
+    def recording_process_arrow(*args, **kwargs):
+        arrow_runs.append(args)
+        return process_arrow(*args, **kwargs)
+    monkeypatch.setattr(
+        batch_process, "process_tdx_streams_basins_arrow", recording_process_arrow,
+    )
+
+    for arrow_native in (False, True, True):
+        batch_process.process_tdx_streams_basins(
+            tdx_region_dir, output_dir, TDX_HYDRO_REGION, preprocessor,
+            arrow_native=arrow_native, incremental=True,
+        )
+
+    assert len(arrow_runs) == 1
+
+
+
+def test_arrow_native_writes_the_same_geoparquet_metadata(
+    tdx_region_dir, preprocessor, tmp_path,
+):
+    """Both paths write the same 'geo' metadata, other than the library
+    that wrote it"""
+    def geo_metadata(path) -> dict:
+        geo = json.loads(pq.read_schema(path).metadata[b"geo"])
+        geo.pop("creator", None)
+        return geo
+
+    paths = {}
+    for arrow_native in (False, True):
+        output_dir = tmp_path / f"arrow_native_{arrow_native}"
+        output_dir.mkdir()
+        paths[arrow_native] = batch_process.process_tdx_streams_basins(
+            tdx_region_dir, output_dir, TDX_HYDRO_REGION, preprocessor,
+            arrow_native=arrow_native,
+        )
+
+    for gdf_path, arrow_path in zip(paths[False], paths[True]):
+        assert geo_metadata(arrow_path) == geo_metadata(gdf_path), arrow_path.name
+    streamnet_geometry = geo_metadata(paths[True][0])["columns"]["geometry"]
+    assert streamnet_geometry["geometry_types"] == ["LineString"]
+    assert "bbox" in streamnet_geometry
+
+
+OOM_REGION = 1020011530
+
+
+def fake_process_region(input_dir, output_dir, tdx_hydro_region, *args) -> list[str]:
+    """Stands in for _process_region, dying like a worker killed for running
+    out of memory when given OOM_REGION"""
+    if tdx_hydro_region == OOM_REGION:
+        os.kill(os.getpid(), signal.SIGKILL)
+    time.sleep(0.5)
+    return []
+
+
+def test_process_regions_survives_a_killed_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_process, "_process_region", fake_process_region)
+    monkeypatch.setattr(batch_process, "estimate_region_memory", lambda *args: 1)
+    regions = [TDX_HYDRO_REGION, OOM_REGION, 1020018110]
+
+    manifest = batch_process.process_regions(
+        regions, tmp_path, tmp_path, max_workers=3, max_retries=1,
+    )
+
+    assert manifest[str(TDX_HYDRO_REGION)] == {
+        "attempts": 1, "status": "done", "outputs": [],
+    }
+    assert manifest["1020018110"]["status"] == "done"
+    # only the region killing its worker uses up its retries
+    assert manifest[str(OOM_REGION)]["status"] == "failed"
+    assert manifest[str(OOM_REGION)]["attempts"] == 2
+    assert "BrokenProcessPool" in manifest[str(OOM_REGION)]["error"]
+
+
+UNREACHABLE_REGION = 1020021940
+
+
+async def fake_get_download_size(self, hybas_id, dataset_names) -> int:
+    return 10
+
+
+async def fake_download_region(self, hybas_id, dataset_names) -> list[dict]:
+    if hybas_id == UNREACHABLE_REGION:
+        raise ConnectionError("host unreachable")
+    return [
+        {"file": f"{hybas_id}-{dataset}.gpkg", "status": "downloaded",
+         "path": self.download_dir / f"{hybas_id}-{dataset}.gpkg"}
+        for dataset in dataset_names
+    ]
+
+
+def test_download_and_process_regions_records_failed_downloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_process, "_process_region", fake_process_region)
+    monkeypatch.setattr(TDXHydroDownloader, "get_download_size", fake_get_download_size)
+    monkeypatch.setattr(TDXHydroDownloader, "download_region", fake_download_region)
+    regions = [TDX_HYDRO_REGION, UNREACHABLE_REGION, 1020018110]
+
+    # the budget fits one region at a time, so a reservation that is not
+    # released blocks the remaining regions
+    manifest = asyncio.run(asyncio.wait_for(
+        batch_process.download_and_process_regions(
+            regions, tmp_path, tmp_path, disk_budget=10, max_workers=2,
+        ),
+        timeout=60,
+    ))
+
+    assert manifest[str(UNREACHABLE_REGION)]["status"] == "failed"
+    assert "host unreachable" in manifest[str(UNREACHABLE_REGION)]["error"]
+    assert manifest[str(TDX_HYDRO_REGION)]["status"] == "done"
+    assert manifest["1020018110"]["status"] == "done"
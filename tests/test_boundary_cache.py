@@ -0,0 +1,47 @@
+import shapely
+
+from global_hydrography.delineation.boundary_cache import (
+    BoundaryCache,
+    estimate_geometry_size,
+)
+
+REGION = 1020000010
+
+
+def boundary(i: int) -> shapely.Geometry:
+    return shapely.Point(i, 0).buffer(1, quad_segs=1 + i % 8)
+
+
+def disk_bytes(cache_dir) -> int:
+    return sum(path.stat().st_size for path in cache_dir.glob("*/*/*.wkb"))
+
+
+def test_usage_stays_within_budgets(tmp_path):
+    cache = BoundaryCache(tmp_path, memory_budget=5_000, disk_budget=4_000)
+
+    for i in range(100):
+        cache.put(REGION, i % 60, "a", boundary(i))
+        stats = cache.stats
+        assert stats["memory_usage"] <= 5_000
+        assert stats["disk_usage"] == disk_bytes(tmp_path) <= 4_000
+
+    linknos = [i for i in range(60) if cache.get(REGION, i, "a") is not None]
+    assert linknos and len(linknos) < 60
+
+
+def test_usage_is_released_by_invalidation(tmp_path):
+    cache = BoundaryCache(tmp_path)
+    for i in range(10):
+        cache.put(REGION, i, "a", boundary(i))
+    assert cache.stats["memory_usage"] == sum(
+        estimate_geometry_size(boundary(i)) for i in range(10)
+    )
+
+    # a new fingerprint drops the region's entries from both tiers
+    cache.put(REGION, 0, "b", boundary(0))
+
+    stats = cache.stats
+    assert stats["memory_usage"] == estimate_geometry_size(boundary(0))
+    assert stats["disk_usage"] == disk_bytes(tmp_path) == len(shapely.to_wkb(boundary(0)))
+    # reopening the cache counts the same bytes on disk
+    assert BoundaryCache(tmp_path).stats["disk_usage"] == stats["disk_usage"]
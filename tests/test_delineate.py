@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+import geopandas as gpd
+import shapely
+
+from global_hydrography.delineation import delineate
+from global_hydrography.delineation.delineate import (
+    delineate_linknos,
+    get_watershed_boundary,
+    get_watershed_boundary_from_groups,
+    get_linknos_by_latlon,
+    subset_network,
+)
+from global_hydrography.delineation.mnsi import LINK, DISCOVER, FINISH, ROOT, MNSIIndex
+from benchmarks.synthetic import CELL_SIZE
+
+
+def assert_same_boundary(boundary, expected) -> None:
+    """Boundaries unioned in a different order may differ in their vertices,
+    but not in the area they cover"""
+    assert boundary.symmetric_difference(expected).area <= 1e-9 * expected.area
+
+
+def nested_linknos(basins_gdf) -> list[int]:
+    """The outlet of the largest tree, and links nested at several depths
+    upstream of it and of each other"""
+    root_id = basins_gdf[ROOT].value_counts().index[0]
+    tree = basins_gdf.loc[basins_gdf[ROOT] == root_id]
+    tree = tree.assign(size=tree[FINISH] - tree[DISCOVER])
+    outlet = tree["size"].idxmax()
+    # the largest watersheds of a few sizes, each within the outlet's
+    linknos = [outlet]
+    for size in (1000, 300, 60, 5):
+        linknos.append(tree.loc[tree["size"] <= size, "size"].idxmax())
+    return linknos
+
+
+def brute_force_linknos(basins_gdf, lats, lons, max_distance=None) -> list[int]:
+    """The lowest LINKNO of the basins containing, or else nearest to, each
+    point, by measuring the distance to every basin"""
+    points = shapely.points(np.asarray(lons), np.asarray(lats))
+    distances = shapely.distance(
+        basins_gdf.geometry.to_numpy()[np.newaxis, :], points[:, np.newaxis],
+    )
+    linknos = []
+    for distance in distances:
+        nearest = distance.min()
+        if nearest > 0 and (max_distance is None or nearest > max_distance):
+            linknos.append(-1)
+        else:
+            linknos.append(basins_gdf.index[distance == nearest].min())
+    return linknos
+
+
+@pytest.fixture
+def gappy_basins(processed_region):
+    """The region's basins with every tenth basin removed, leaving gaps"""
+    _, basins_gdf, _ = processed_region
+    return basins_gdf.iloc[np.arange(len(basins_gdf)) % 10 != 0]
+
+
+def test_get_linknos_by_latlon_picks_lowest_linkno_on_shared_edges(gappy_basins):
+    """Cell corners and edge midpoints are on the boundaries of up to four
+    basins, and go to the lowest of their LINKNOs"""
+    bounds = gappy_basins.total_bounds
+    xs = np.arange(bounds[0], bounds[2], CELL_SIZE / 2)[:40]
+    ys = np.arange(bounds[1], bounds[3], CELL_SIZE / 2)[:40]
+    lons, lats = (a.ravel() for a in np.meshgrid(xs, ys))
+
+    linknos = get_linknos_by_latlon(gappy_basins, lats, lons)
+
+    assert linknos.tolist() == brute_force_linknos(gappy_basins, lats, lons)
+
+
+def test_get_linknos_by_latlon_falls_back_to_nearest_basin(processed_region, gappy_basins):
+    """A point in the middle of a removed basin is in a gap, so is only
+    found within max_distance of the neighbouring basins"""
+    _, basins_gdf, _ = processed_region
+    removed = shapely.centroid(basins_gdf.geometry.to_numpy()[:300:10])
+    lats, lons = shapely.get_y(removed), shapely.get_x(removed)
+
+    assert (get_linknos_by_latlon(gappy_basins, lats, lons) == -1).all()
+    too_near = get_linknos_by_latlon(gappy_basins, lats, lons, CELL_SIZE / 4)
+    assert (too_near == -1).all()
+    linknos = get_linknos_by_latlon(gappy_basins, lats, lons, CELL_SIZE)
+    assert (linknos > -1).all()
+    assert linknos.tolist() == brute_force_linknos(
+        gappy_basins, lats, lons, CELL_SIZE,
+    )
+
+
+def test_get_linknos_by_latlon_breaks_nearest_ties_by_lowest_linkno():
+    basins_gdf = gpd.GeoDataFrame(
+        {LINK: [5, 3, 4]},
+        geometry=[shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1), shapely.box(0, 3, 3, 4)],
+    ).set_index(LINK)
+
+    linknos = get_linknos_by_latlon(basins_gdf, [0.5, 0.5], [1.5, 0.5], max_distance=1)
+
+    assert linknos.tolist() == [3, 5]
+
+
+@pytest.mark.parametrize("use_indexes", [False, True])
+def test_watershed_boundary_from_groups_matches_basins(processed_region, use_indexes):
+    """Boundaries assembled from groups equal the union of the upstream
+    basins, for group roots, links within groups, outlets and headwaters"""
+    _, basins_gdf, groups_gdf = processed_region
+    if use_indexes:
+        mnsi_index, groups_index = MNSIIndex(basins_gdf), MNSIIndex(groups_gdf)
+    else:
+        mnsi_index, groups_index = None, None
+    linknos = [*nested_linknos(basins_gdf), *basins_gdf.index[::37]]
+
+    for linkid in linknos:
+        boundary = get_watershed_boundary_from_groups(
+            basins_gdf, groups_gdf, linkid, mnsi_index, groups_index,
+        )
+        expected = get_watershed_boundary(subset_network(basins_gdf, linkid))
+        assert_same_boundary(boundary, expected)
+
+
+@pytest.mark.parametrize("use_groups", [False, True])
+def test_delineate_linknos_matches_per_point_boundaries(processed_region, use_groups):
+    _, basins_gdf, groups_gdf = processed_region
+    linknos = nested_linknos(basins_gdf)
+
+    results = list(delineate_linknos(
+        basins_gdf, linknos, groups_gdf if use_groups else None,
+    ))
+
+    assert sorted(linkid for linkid, _, _ in results) == sorted(linknos)
+    for linkid, root_id, boundary in results:
+        expected = get_watershed_boundary(subset_network(basins_gdf, linkid))
+        assert root_id == basins_gdf.at[linkid, ROOT]
+        assert_same_boundary(boundary, expected)
+
+
+def test_delineate_linknos_fills_around_nested_watersheds_with_groups(
+    processed_region, monkeypatch,
+):
+    """A large outlet with a small nested watershed is assembled from a few
+    groups, not from each of its upstream basins"""
+    _, basins_gdf, groups_gdf = processed_region
+    outlet, *_, small = nested_linknos(basins_gdf)
+    n_pieces = []
+    def recording_boundary(pieces, *args, **kwargs):
+        n_pieces.append(len(pieces))
+        return get_watershed_boundary(pieces, *args, **kwargs)
+    monkeypatch.setattr(delineate, "get_watershed_boundary", recording_boundary)
+
+    results = dict(
+        (linkid, boundary)
+        for linkid, _, boundary in delineate_linknos(
+            basins_gdf, [outlet, small], groups_gdf,
+        )
+    )
+
+    n_upstream = len(subset_network(basins_gdf, outlet))
+    assert n_pieces[-1] < n_upstream / 10
+    expected = get_watershed_boundary(subset_network(basins_gdf, outlet))
+    assert_same_boundary(results[outlet], expected)
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from global_hydrography.delineation.downstream import DownstreamIndex
+from global_hydrography.delineation.mnsi import LINK, DS_LINK, modified_nest_set_index
+from benchmarks.synthetic import synthetic_network
+
+
+@pytest.fixture
+def network() -> pd.DataFrame:
+    return modified_nest_set_index(synthetic_network(3_000, n_roots=10)).set_index(LINK)
+
+
+def walk_to_root(network: pd.DataFrame, linkid: int) -> list[int]:
+    """LINKNOs from linkid to its outlet, following DSLINKNO one at a time"""
+    downstream = network[DS_LINK].to_dict()
+    path = [linkid]
+    while downstream[path[-1]] != -1:
+        path.append(downstream[path[-1]])
+    return path
+
+
+def test_paths_to_root_match_walks(network):
+    index = DownstreamIndex(network)
+    linkids = network.index[::7].to_numpy()
+    paths = [walk_to_root(network, linkid) for linkid in linkids]
+
+    for linkid, path in zip(linkids, paths):
+        assert index.path_to_root(linkid).tolist() == path
+    offsets, linknos = index.paths_to_root(linkids)
+    for i, path in enumerate(paths):
+        assert linknos[offsets[i]:offsets[i + 1]].tolist() == path
+
+    positions = index.positions(linkids)
+    assert index.depth[positions].tolist() == [len(path) - 1 for path in paths]
+    k = np.arange(len(linkids)) % 12
+    expected = [path[min(i, len(path) - 1)] for path, i in zip(paths, k)]
+    assert index.ancestors(linkids, k).tolist() == expected
+
+    lengths = np.random.default_rng(0).random(len(network))
+    totals = index.distance_to_root(lengths)
+    length_of = dict(zip(network.index, lengths))
+    for position, path in zip(positions, paths):
+        assert totals[position] == pytest.approx(sum(length_of[l] for l in path))
+
+
+def test_confluences_match_walks(network):
+    rng = np.random.default_rng(1)
+    # random pairs, in the same tree or not, and every tenth link paired
+    # with its own outlet
+    a = rng.choice(network.index, 500)
+    b = np.where(
+        np.arange(500) % 10 == 0,
+        [walk_to_root(network, linkid)[-1] for linkid in a],
+        rng.choice(network.index, 500),
+    )
+    index = DownstreamIndex(network)
+    lengths = rng.random(len(network))
+    length_of = dict(zip(network.index, lengths))
+
+    confluences = index.confluences(a, b)
+    upstream = index.is_upstream(a, b)
+    distances = index.river_distances(a, b, index.distance_to_root(lengths))
+
+    for i in range(len(a)):
+        path_a, path_b = walk_to_root(network, a[i]), walk_to_root(network, b[i])
+        assert upstream[i] == (b[i] in path_a)
+        common = [linkid for linkid in path_a if linkid in set(path_b)]
+        if not common:
+            assert confluences[i] == -1
+            assert np.isnan(distances[i])
+            continue
+        assert confluences[i] == common[0]
+        # from each upstream end down to, but not through, the confluence
+        expected = (
+            sum(length_of[l] for l in path_a[:path_a.index(common[0])])
+            + sum(length_of[l] for l in path_b[:path_b.index(common[0])])
+        )
+        assert distances[i] == pytest.approx(expected)
+    assert (confluences == -1).any() and (confluences > -1).any()
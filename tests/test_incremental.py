@@ -0,0 +1,78 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from global_hydrography.delineation.mnsi import (
+    LINK, US_LEFT, US_RIGHT, ROOT, MNSI_FIELDS, ELEMENT_COUNT,
+    dissolve_root_field, modified_nest_set_index,
+)
+from global_hydrography.incremental import (
+    StageCache, cached_nested_dissolve_groups, cached_nested_set_index,
+    untouched_rows,
+)
+from benchmarks.synthetic import synthetic_network
+from conftest import TEST_DISSOLVE_LEVELS
+
+DISSOLVE_FIELDS = [
+    ELEMENT_COUNT,
+    *[dissolve_root_field(level) for level in range(len(TEST_DISSOLVE_LEVELS))],
+]
+
+
+@pytest.fixture
+def network() -> pd.DataFrame:
+    return synthetic_network(3_000, n_roots=20).set_index(LINK)
+
+
+def remove_headwater(df: pd.DataFrame, linkid: int) -> pd.DataFrame:
+    """df without the headwater reach linkid, unlinked from its downstream
+    reach"""
+    df = df.drop(index=linkid)
+    for field in (US_LEFT, US_RIGHT):
+        df.loc[df[field] == linkid, field] = -1
+    return df
+
+
+def process(df: pd.DataFrame, cache: StageCache | None) -> pd.DataFrame:
+    df = cached_nested_set_index(df.copy(), cache)
+    return cached_nested_dissolve_groups(df, cache, TEST_DISSOLVE_LEVELS)
+
+
+@pytest.mark.parametrize("tree", ["small", "large"])
+def test_carry_forward_after_removing_a_reach_equals_full_recompute(
+    network, tree, tmp_path, caplog,
+):
+    cache = StageCache(tmp_path)
+    previous = process(network, cache)
+    tree_sizes = previous[ROOT].value_counts()
+    root_id = tree_sizes.index[-1] if tree == "small" else tree_sizes.index[0]
+    in_tree = previous[ROOT] == root_id
+    headwaters = previous.index[in_tree & (previous[US_LEFT] == -1)]
+    changed = remove_headwater(network, headwaters[0])
+
+    with caplog.at_level(logging.INFO, logger="global_hydrography.incremental"):
+        result = process(changed, cache)
+    # both stages carried forward every tree but the changed one
+    carried = f"Carrying forward {(~in_tree).sum()} of {len(changed)} reaches"
+    assert sum(carried in message for message in caplog.messages) == 2
+
+    expected = process(changed, None)
+    assert list(result.columns) == list(expected.columns)
+    for field in [*MNSI_FIELDS, *DISSOLVE_FIELDS]:
+        assert np.array_equal(result[field], expected[field]), field
+        assert result[field].dtype == expected[field].dtype, field
+
+
+def test_untouched_rows_are_the_unchanged_trees(network):
+    previous = modified_nest_set_index(network.copy())
+    root_id = previous[ROOT].value_counts().index[0]
+    in_tree = previous[ROOT] == root_id
+    headwater = previous.index[in_tree & (previous[US_LEFT] == -1)][0]
+    changed = remove_headwater(network, headwater)
+
+    df_positions, previous_positions = untouched_rows(changed, previous)
+
+    assert (changed.index[df_positions] == previous.index[previous_positions]).all()
+    assert sorted(changed.index[df_positions]) == sorted(previous.index[~in_tree])
@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+import pytest
+
+from global_hydrography import instrument
+
+
+def test_stage_peak_rss_is_per_stage(monkeypatch):
+    """A stage's peak memory is its own, not the process's high-water mark
+    left by an earlier, larger stage"""
+    pytest.importorskip("psutil")
+    monkeypatch.setattr(instrument, "_enabled", True)
+    large = 512 * 2**20
+
+    with instrument.collect() as metrics:
+        with instrument.stage("large"):
+            array = np.ones(large, dtype=np.uint8)
+            # long enough to be sampled
+            time.sleep(3 * instrument.RSS_SAMPLE_INTERVAL)
+            del array
+        with instrument.stage("small"):
+            array = np.ones(2**20, dtype=np.uint8)
+            del array
+
+    large_stage, small_stage = metrics.stages
+    assert large_stage["peak_rss_bytes"] >= large
+    assert small_stage["peak_rss_bytes"] < large_stage["peak_rss_bytes"] - large // 2
+    # the process's high-water mark still includes the large stage
+    assert small_stage["max_rss_bytes"] >= large
+    assert "process max RSS" in instrument.format_metrics(small_stage)
+
+
+def test_missing_psutil_is_reported_once(monkeypatch, caplog):
+    monkeypatch.setattr(instrument, "_enabled", True)
+    monkeypatch.setattr(instrument, "psutil", None)
+    monkeypatch.setattr(instrument, "_warned_no_psutil", False)
+
+    with instrument.collect() as metrics:
+        for name in ("first", "second"):
+            with instrument.stage(name):
+                pass
+
+    assert [s["peak_rss_bytes"] for s in metrics.stages] == [None, None]
+    warnings = [r for r in caplog.records if "psutil" in r.getMessage()]
+    assert len(warnings) == 1
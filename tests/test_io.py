@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import os
+import random
+from pathlib import Path
+from typing import Callable
+
+import pytest
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from global_hydrography.io import (
+    TDXHydroDownloader,
+    linkno_index_path,
+    read_upstream_basins,
+    write_delineation_parquet,
+    write_linkno_index,
+)
+from global_hydrography.delineation.delineate import subset_network
+from global_hydrography.delineation.mnsi import LINK, ROOT, modified_nest_set_index
+from global_hydrography.process import create_basins_mnsi
+from benchmarks.synthetic import synthetic_tdx_region
+
+HYBAS_IDS = [1020000010, 1020011530]
+DATASETS = ["streamnet", "basins"]
+
+
+@pytest.fixture
+def remote_files() -> dict[str, bytes]:
+    """Contents of the files on the stand-in host, by file name"""
+    rng = random.Random(0)
+    return {
+        f"{hybas_id}-{dataset}-gpkg": rng.randbytes(rng.randint(100_000, 300_000))
+        for hybas_id in HYBAS_IDS
+        for dataset in DATASETS
+    }
+
+
+@pytest.fixture
+def host_requests() -> list[tuple[str, int]]:
+    """File name and starting byte of each GET received by the host"""
+    return []
+
+
+@pytest.fixture
+def flaky_host(remote_files: dict[str, bytes], host_requests: list) -> Callable:
+    """A stand-in for NGA's download.php that sends files slowly, honours
+    Range and If-Range requests, and drops the first two connections for
+    each file part way through the transfer"""
+    async def download(request: web.Request) -> web.StreamResponse:
+        data = remote_files.get(request.query["file"])
+        if data is None:
+            raise web.HTTPNotFound()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if request.method == "HEAD":
+            return web.Response(
+                headers={"Content-Length": str(len(data)), "ETag": etag},
+            )
+
+        start, status = 0, 200
+        if "Range" in request.headers and (
+            request.headers.get("If-Range", etag) == etag
+        ):
+            start, status = int(request.headers["Range"][6:].split("-")[0]), 206
+        attempt = sum(name == request.query["file"] for name, _ in host_requests)
+        host_requests.append((request.query["file"], start))
+        if start >= len(data):
+            raise web.HTTPRequestRangeNotSatisfiable()
+
+        response = web.StreamResponse(
+            status=status,
+            headers={"Content-Length": str(len(data) - start), "ETag": etag},
+        )
+        await response.prepare(request)
+        drop_at = start + len(data) // 3 if attempt < 2 else None
+        for position in range(start, len(data), 16_384):
+            if drop_at is not None and position >= drop_at:
+                request.transport.close()
+                return response
+            await response.write(data[position:position + 16_384])
+            await asyncio.sleep(0.001)
+        await response.write_eof()
+        return response
+
+    return download
+
+
+def run_downloader(handler: Callable, download_dir, hybas_ids) -> list[dict]:
+    """Run download_files against handler served on a local port"""
+    async def run() -> list[dict]:
+        app = web.Application()
+        app.router.add_route("*", "/download.php", handler)
+        async with TestServer(app) as server:
+            downloader = TDXHydroDownloader(
+                download_dir=download_dir, max_retries=4, backoff=0.01,
+            )
+            downloader.ROOT_URL = str(server.make_url("/download.php"))
+            return await downloader.download_files(hybas_ids, DATASETS)
+    return asyncio.run(run())
+
+
+def test_download_files_resumes_dropped_connections(
+    flaky_host, host_requests, remote_files, tmp_path,
+):
+    results = run_downloader(flaky_host, tmp_path, HYBAS_IDS)
+
+    assert [r["status"] for r in results] == ["downloaded"] * len(remote_files)
+    for name, data in remote_files.items():
+        assert (tmp_path / name.replace("-gpkg", ".gpkg")).read_bytes() == data
+    assert not list(tmp_path.glob("*.part"))
+    # every file was resumed with a Range request after a dropped connection
+    resumed = {name for name, start in host_requests if start}
+    assert resumed == set(remote_files)
+
+
+def test_download_files_skips_complete_files(
+    flaky_host, host_requests, remote_files, tmp_path,
+):
+    run_downloader(flaky_host, tmp_path, HYBAS_IDS)
+    request_count = len(host_requests)
+
+    results = run_downloader(flaky_host, tmp_path, HYBAS_IDS)
+
+    assert [r["status"] for r in results] == ["skipped"] * len(remote_files)
+    assert len(host_requests) == request_count
+
+
+def test_download_files_restarts_files_replaced_on_the_host(
+    flaky_host, remote_files, tmp_path,
+):
+    """A file replaced between attempts is downloaded again from the start,
+    not resumed onto the part of the old version, even at the same size"""
+    rng = random.Random(1)
+    replaced = {}
+    async def replacing_host(request: web.Request) -> web.StreamResponse:
+        response = await flaky_host(request)
+        name = request.query["file"]
+        if request.method == "GET" and name not in replaced:
+            replaced[name] = rng.randbytes(len(remote_files[name]))
+            remote_files[name] = replaced[name]
+        return response
+
+    results = run_downloader(replacing_host, tmp_path, HYBAS_IDS)
+
+    assert [r["status"] for r in results] == ["downloaded"] * len(remote_files)
+    for name, data in replaced.items():
+        assert (tmp_path / name.replace("-gpkg", ".gpkg")).read_bytes() == data
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_download_files_discards_part_files_larger_than_remote(
+    flaky_host, remote_files, tmp_path,
+):
+    for name, data in remote_files.items():
+        part_path = tmp_path / name.replace("-gpkg", ".gpkg.part")
+        part_path.write_bytes(data + b"stale")
+
+    results = run_downloader(flaky_host, tmp_path, HYBAS_IDS)
+
+    assert [r["status"] for r in results] == ["downloaded"] * len(remote_files)
+    for name, data in remote_files.items():
+        assert (tmp_path / name.replace("-gpkg", ".gpkg")).read_bytes() == data
+
+
+def test_download_files_reports_missing_files(flaky_host, tmp_path):
+    results = run_downloader(flaky_host, tmp_path, [9999999999])
+
+    assert [r["status"] for r in results] == ["failed"] * len(DATASETS)
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.fixture
+def delineation_parquet(tmp_path: Path) -> tuple[gpd.GeoDataFrame, Path]:
+    """A synthetic region's basins with MNSI fields, and the delineation
+    layout file written from them"""
+    streamnet_gdf, basins_gdf = synthetic_tdx_region(2_000, n_roots=20)
+    streams_mnsi_gdf = modified_nest_set_index(streamnet_gdf).set_index(LINK)
+    basins_gdf = basins_gdf.rename(columns={"streamID": LINK}).set_index(LINK)
+    basins_mnsi_gdf, _ = create_basins_mnsi(basins_gdf, streams_mnsi_gdf)
+    path = write_delineation_parquet(
+        basins_mnsi_gdf, tmp_path / "basins.parquet", row_group_size=100,
+    )
+    return (basins_mnsi_gdf, path)
+
+
+def test_read_upstream_basins_uses_linkno_index(
+    delineation_parquet: tuple[gpd.GeoDataFrame, Path],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """LINKNOs are found in the sorted index, not by reading the whole file,
+    and the upstream basins match `subset_network`"""
+    gdf, path = delineation_parquet
+    index_path = linkno_index_path(path)
+    assert index_path.exists()
+    index = pq.read_table(index_path)
+    assert index.column(LINK).to_pylist() == sorted(gdf.index)
+
+    # rewrite the index in small row groups, so pruning can be seen
+    write_linkno_index(index, path, row_group_size=100)
+    assert pq.ParquetFile(index_path).num_row_groups > 1
+
+    read_paths = []
+    read_table = pq.read_table
+    def recording_read_table(source, *args, **kwargs):
+        read_paths.append(Path(source))
+        return read_table(source, *args, **kwargs)
+    monkeypatch.setattr(pq, "read_table", recording_read_table)
+
+    for linkid in gdf.index[::97]:
+        upstream = read_upstream_basins(path, linkid)
+        expected = subset_network(gdf, linkid)
+        assert sorted(upstream.index) == sorted(expected.index)
+    assert index_path in read_paths
+
+
+def test_read_upstream_basins_ignores_stale_linkno_index(
+    delineation_parquet: tuple[gpd.GeoDataFrame, Path],
+) -> None:
+    """An index older than its file, as left by a rewrite that didn't write
+    one, is ignored rather than trusted"""
+    gdf, path = delineation_parquet
+    index_path = linkno_index_path(path)
+    # an index whose MNSI fields point every LINKNO at the wrong basins
+    stale = pq.read_table(index_path).to_pandas()
+    stale[ROOT] = -1
+    pq.write_table(pa.Table.from_pandas(stale, preserve_index=False), index_path)
+    stat = os.stat(path)
+    os.utime(index_path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+
+    linkid = gdf.index[0]
+    upstream = read_upstream_basins(path, linkid)
+    assert sorted(upstream.index) == sorted(subset_network(gdf, linkid).index)
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+import fsspec
+
+from global_hydrography import metadata
+from global_hydrography.metadata import MetadataCache
+
+
+def test_slow_fetch_keeps_its_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata, "LOCK_TIMEOUT", 0.3)
+    monkeypatch.setattr(metadata, "LOCK_HEARTBEAT", 0.05)
+    cache = MetadataCache(tmp_path, offline=False)
+    fetches = []
+
+    def slow_fetch():
+        fetches.append("slow")
+        time.sleep(1.0)
+        return {"a": 1}
+
+    def fetch():
+        fetches.append("fast")
+        return {"a": 2}
+
+    results = []
+    fetcher = threading.Thread(
+        target=lambda: results.append(cache.get("entry", slow_fetch)),
+    )
+    fetcher.start()
+    while not cache.path("entry").with_suffix(".lock").exists():
+        time.sleep(0.01)
+    # waits past LOCK_TIMEOUT for the slow fetch, rather than stealing its lock
+    results.append(MetadataCache(tmp_path, offline=False).get("entry", fetch))
+    fetcher.join()
+
+    assert fetches == ["slow"]
+    assert results == [{"a": 1}, {"a": 1}]
+    assert not cache.path("entry").with_suffix(".lock").exists()
+
+
+def test_stale_lock_is_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata, "LOCK_TIMEOUT", 0.3)
+    cache = MetadataCache(tmp_path, offline=False)
+    lock_path = cache.path("entry").with_suffix(".lock")
+    lock_path.parent.mkdir(parents=True)
+    lock_path.touch()
+    os.utime(lock_path, (time.time() - 10, time.time() - 10))
+
+    assert cache.get("entry", lambda: [1, 2]) == [1, 2]
+    assert not lock_path.exists()
+
+
+def test_snapshots_serve_an_offline_cold_start(tmp_path, monkeypatch):
+    from global_hydrography import preprocess
+    from global_hydrography.io import TDXHydroDownloader
+    from global_hydrography.preprocess import TDXPreprocessor
+
+    monkeypatch.setattr(
+        preprocess, "fetch_tdx_header_crosswalk", lambda: {"1020000010": 101},
+    )
+    monkeypatch.setattr(
+        TDXHydroDownloader, "_TDXHydroDownloader__fetch_hybas_ids",
+        lambda self, filename: [1020000010, 1020011530],
+    )
+    snapshot_dir = tmp_path / "data"
+    monkeypatch.setattr("sys.argv", [
+        "metadata", "--cache-dir", str(tmp_path / "cache"),
+        "--snapshot-dir", str(snapshot_dir),
+    ])
+    metadata.main()
+
+    # a new machine, with an empty cache and no internet access
+    cold_cache = MetadataCache(
+        tmp_path / "cold", offline=True, snapshot_dir=snapshot_dir,
+    )
+    assert TDXPreprocessor(cold_cache).tdx_header_crosswalk == {1020000010: 101}
+    assert TDXHydroDownloader(
+        fsspec.filesystem("http"), tmp_path, metadata_cache=cold_cache,
+    ).get_hybas_ids() == [1020000010, 1020011530]
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from global_hydrography.delineation.mnsi import (
+    LINK, DS_LINK, US_LEFT, US_RIGHT, MNSI_FIELDS, ROOT, DISCOVER, FINISH,
+    ARRAY_ENGINE, DICT_ENGINE,
+    MNSIIndex, modified_nest_set_index,
+)
+from global_hydrography.delineation.delineate import subset_network
+from benchmarks.synthetic import synthetic_network
+
+LINK_FIELDS = [LINK, DS_LINK, US_LEFT, US_RIGHT]
+
+
+@pytest.fixture
+def network():
+    return synthetic_network(2_000, n_roots=10)
+
+
+def test_engines_agree(network):
+    by_array = modified_nest_set_index(network.copy(), engine=ARRAY_ENGINE)
+    by_dict = modified_nest_set_index(network.copy(), engine=DICT_ENGINE)
+
+    assert list(by_array.columns) == list(by_dict.columns)
+    for field in MNSI_FIELDS:
+        assert np.array_equal(by_array[field], by_dict[field]), field
+        assert by_array[field].dtype == by_dict[field].dtype, field
+
+
+@pytest.mark.parametrize("dtype", ["int64", "int32"])
+def test_validate_with_linkno_index(network, dtype):
+    """Validation works on frames indexed by LINKNO, as the pipeline passes
+    them, and keeps the LINKNO dtype"""
+    df = network.astype({field: dtype for field in LINK_FIELDS}).set_index(LINK)
+
+    result = modified_nest_set_index(df, validate=True)
+
+    expected = modified_nest_set_index(
+        network.copy(), engine=DICT_ENGINE,
+    ).set_index(LINK).loc[result.index]
+    for field in MNSI_FIELDS:
+        assert np.array_equal(result[field], expected[field]), field
+    assert result[ROOT].dtype == dtype
+
+
+
+@pytest.mark.parametrize("sort", [False, True])
+def test_mnsi_index_matches_mask_subsets(network, sort):
+    """Upstream positions from binary searches select the same rows as
+    masking on the MNSI fields, whether or not rows are sorted"""
+    df = modified_nest_set_index(network).set_index(LINK)
+    if sort:
+        df = df.sort_values([ROOT, DISCOVER])
+    index = MNSIIndex(df)
+    assert index.is_sorted == sort
+
+    for linkid in df.index[::7]:
+        expected = subset_network(df, linkid)
+        positions = index.upstream_positions(linkid)
+        assert isinstance(positions, slice) == sort
+        assert sorted(df.index[positions]) == sorted(expected.index)
+        assert sorted(index.subset(df, linkid).index) == sorted(expected.index)
+        assert index.upstream_count(linkid) == len(expected)
+
+        row = df.loc[linkid]
+        by_range = index.range_positions(row[ROOT], row[DISCOVER], row[FINISH])
+        assert sorted(df.index[by_range]) == sorted(expected.index)
+
+    starts, stops = index.upstream_ranges()
+    assert np.array_equal(stops - starts, df[FINISH] - df[DISCOVER])
+
+
+def test_mnsi_index_rejects_unknown_links_and_frames(network):
+    df = modified_nest_set_index(network).set_index(LINK)
+    index = MNSIIndex(df)
+
+    with pytest.raises(KeyError):
+        index.position(df.index.max() + 1)
+    with pytest.raises(KeyError):
+        index.positions([df.index[0], df.index.max() + 1])
+    with pytest.raises(ValueError):
+        index.subset(df.iloc[1:], df.index[0])
+    assert df.iloc[index.range_positions(-5, 0, 10)].empty
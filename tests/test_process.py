@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from global_hydrography.delineation.mnsi import (
+    LINK, DS_LINK, US_LEFT, US_RIGHT, ROOT, ELEMENT_COUNT, DISSOLVE_ROOT_ID,
+    DISSOLVE_LEVEL, PARENT_DISSOLVE_ROOT_ID, MNSI_FIELDS,
+    dissolve_root_field, modified_nest_set_index,
+)
+from global_hydrography.process import compute_dissolve_groups, match_basins_to_streams
+from benchmarks.synthetic import synthetic_network
+from conftest import TEST_DISSOLVE_LEVELS
+
+MAX_ELEMENTS, MIN_ELEMENTS = 200, 125
+
+
+@pytest.fixture(params=[0, 1, 2])
+def dissolve_groups(request) -> pd.DataFrame:
+    """Dissolve groups of a synthetic network with trees larger and smaller
+    than MAX_ELEMENTS"""
+    df = synthetic_network(5_000, n_roots=20, seed=request.param)
+    df = modified_nest_set_index(df).set_index(LINK)
+    return compute_dissolve_groups(df, MAX_ELEMENTS, MIN_ELEMENTS)
+
+
+def test_dissolve_groups_are_connected_subtrees(dissolve_groups):
+    """Each group is its root and reaches draining to it within the group,
+    with the group size as the root's ELEMENT_COUNT"""
+    gdf = dissolve_groups
+    group_ids = gdf[DISSOLVE_ROOT_ID]
+    is_group_root = gdf.index == group_ids.to_numpy()
+
+    # every other member drains to a member of its own group
+    members = gdf[~is_group_root]
+    assert (group_ids.loc[members[DS_LINK]].to_numpy() == members[DISSOLVE_ROOT_ID]).all()
+    # and every group root drains out of its group, or is an outlet
+    roots = gdf[is_group_root]
+    downstream = roots[DS_LINK][roots[DS_LINK] > -1]
+    assert (group_ids.loc[downstream].to_numpy() != downstream.index).all()
+
+    sizes = group_ids.value_counts()
+    assert (roots[ELEMENT_COUNT] == sizes.loc[roots.index]).all()
+
+
+def test_dissolve_group_sizes(dissolve_groups):
+    """Groups have at most max_elements. Groups of min_elements or fewer
+    either close off at an outlet, or were cut by the fallback because
+    their downstream reach had more than max_elements even after cutting"""
+    gdf = dissolve_groups
+    sizes = gdf[DISSOLVE_ROOT_ID].value_counts()
+    assert sizes.max() <= MAX_ELEMENTS
+
+    small = sizes.index[sizes <= MIN_ELEMENTS]
+    cut = small[gdf.loc[small, DS_LINK].to_numpy() > -1]
+    # most groups are within (min_elements, max_elements]
+    assert len(cut) < len(sizes) / 10
+    for linkid in cut:
+        downstream = gdf.loc[gdf.at[linkid, DS_LINK]]
+        upstream = [downstream[US_LEFT], downstream[US_RIGHT]]
+        count = 1 + gdf.loc[[u for u in upstream if u > -1], ELEMENT_COUNT].sum()
+        assert count > MAX_ELEMENTS, linkid
+
+
+def test_small_trees_are_one_dissolve_group(dissolve_groups):
+    gdf = dissolve_groups
+    tree_sizes = gdf[ROOT].value_counts()
+    small_trees = tree_sizes.index[tree_sizes <= MAX_ELEMENTS]
+    assert len(small_trees)
+
+    small = gdf[gdf[ROOT].isin(small_trees)]
+    outlets = small[small[DS_LINK] == -1]
+    outlet_of_tree = pd.Series(outlets.index, index=outlets[ROOT])
+    expected = outlet_of_tree.loc[small[ROOT]].to_numpy()
+    assert np.array_equal(small[DISSOLVE_ROOT_ID].to_numpy(), expected)
+
+
+def test_nested_dissolve_groups_are_unions_of_finer_groups(processed_region):
+    streams_gdf, _, _ = processed_region
+    for level, (max_elements, _) in enumerate(TEST_DISSOLVE_LEVELS):
+        group_ids = streams_gdf[dissolve_root_field(level)]
+        sizes = group_ids.value_counts()
+        assert sizes.max() <= max_elements, level
+        # groups are rooted at one of their own reaches
+        assert (group_ids.loc[sizes.index].to_numpy() == sizes.index).all()
+        if level:
+            finer_ids = streams_gdf[dissolve_root_field(level - 1)]
+            coarse_per_finer = group_ids.groupby(finer_ids).nunique()
+            assert (coarse_per_finer == 1).all(), level
+            assert len(sizes) < finer_ids.nunique()
+
+
+# areas in degrees are only compared with each other
+@pytest.mark.filterwarnings("ignore:Geometry is in a geographic CRS")
+def test_dissolve_groups_pyramid(processed_region):
+    """Each group's polygon covers its basins, and its fields agree with
+    the group fields of the streams"""
+    streams_gdf, basins_gdf, groups_gdf = processed_region
+    n_levels = len(TEST_DISSOLVE_LEVELS)
+    assert sorted(groups_gdf[DISSOLVE_LEVEL].unique()) == list(range(n_levels))
+
+    areas = basins_gdf.area
+    for level in range(n_levels):
+        field = dissolve_root_field(level)
+        groups = groups_gdf.loc[groups_gdf[DISSOLVE_LEVEL] == level]
+        groups = groups.set_index(DISSOLVE_ROOT_ID)
+        assert sorted(groups.index) == sorted(streams_gdf[field].unique())
+
+        sizes = streams_gdf[field].value_counts().loc[groups.index]
+        assert (groups[ELEMENT_COUNT] == sizes).all()
+        for f in MNSI_FIELDS:
+            assert (groups[f] == streams_gdf.loc[groups.index, f]).all(), f
+        group_areas = areas.groupby(basins_gdf[field]).sum().loc[groups.index]
+        assert np.allclose(groups.area, group_areas)
+
+        if level + 1 < n_levels:
+            parents = streams_gdf.loc[groups.index, dissolve_root_field(level + 1)]
+            assert (groups[PARENT_DISSOLVE_ROOT_ID] == parents).all()
+            # the element counts of each group's children add up to its own
+            coarser = groups_gdf.loc[groups_gdf[DISSOLVE_LEVEL] == level + 1]
+            child_counts = groups[ELEMENT_COUNT].groupby(
+                groups[PARENT_DISSOLVE_ROOT_ID]
+            ).sum()
+            assert (
+                child_counts.loc[coarser[DISSOLVE_ROOT_ID]].to_numpy()
+                == coarser[ELEMENT_COUNT].to_numpy()
+            ).all()
+        else:
+            assert (groups[PARENT_DISSOLVE_ROOT_ID] == -1).all()
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_match_basins_to_streams_matches_merge(seed):
+    """Matches agree with a DataFrame merge, with unmatched LINKNOs on both
+    sides and rows in shuffled order"""
+    rng = np.random.default_rng(seed)
+    links = rng.permutation(10_000) + 1
+    basins_links = rng.permutation(links[:8_000])
+    streams_links = rng.permutation(links[1_000:])
+
+    match = match_basins_to_streams(basins_links, streams_links)
+
+    merged = pd.merge(
+        pd.DataFrame({LINK: basins_links, "basin": np.arange(len(basins_links))}),
+        pd.DataFrame({LINK: streams_links, "stream": np.arange(len(streams_links))}),
+        on=LINK, how="outer",
+    )
+    matched = merged.dropna().sort_values("basin")
+    assert np.array_equal(match.basins, matched["basin"])
+    assert np.array_equal(match.streams, matched["stream"])
+    assert np.array_equal(
+        match.basins_no_stream, np.sort(merged.loc[merged["stream"].isna(), "basin"]),
+    )
+    assert np.array_equal(
+        match.streams_no_basin, np.sort(merged.loc[merged["basin"].isna(), "stream"]),
+    )
+    assert match.stats() == {
+        "matched": 7_000, "basins_no_stream": 1_000, "streams_no_basin": 2_000,
+    }
+
+
+def test_match_basins_to_streams_with_no_streams():
+    basins_links = np.array([3, 1, 2])
+
+    match = match_basins_to_streams(basins_links, np.array([], dtype=np.int64))
+
+    assert len(match.basins) == len(match.streams) == 0
+    assert match.basins_no_stream.tolist() == [0, 1, 2]
+    assert len(match.streams_no_basin) == 0
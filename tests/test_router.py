@@ -0,0 +1,95 @@
+import os
+
+import geopandas as gpd
+import shapely
+
+from global_hydrography.delineation import router as router_module
+from global_hydrography.delineation.router import (
+    RegionRouter,
+    parquet_fingerprint,
+    region_parquet_path,
+)
+
+from conftest import TDX_HYDRO_REGION
+
+
+def write_region(directory, n_basins: int) -> None:
+    basins_gdf = gpd.GeoDataFrame(
+        {"LINKNO": range(n_basins)},
+        geometry=[shapely.box(i, 0, i + 1, 1) for i in range(n_basins)],
+        crs="EPSG:4326",
+    ).set_index("LINKNO")
+    basins_gdf.to_parquet(region_parquet_path(directory, TDX_HYDRO_REGION))
+
+
+def make_router(tmp_path, **kwargs) -> RegionRouter:
+    hydrobasins_path = tmp_path / "hydrobasins.geojson"
+    gpd.GeoDataFrame(
+        {"HYBAS_ID": [TDX_HYDRO_REGION]},
+        geometry=[shapely.box(0, 0, 10, 1)],
+        crs="EPSG:4326",
+    ).to_file(hydrobasins_path)
+    return RegionRouter(tmp_path, hydrobasins_path, **kwargs)
+
+
+def test_region_is_kept_with_the_fingerprint_it_was_read_with(tmp_path):
+    write_region(tmp_path, 3)
+    router = make_router(tmp_path)
+    path = router.region_path(TDX_HYDRO_REGION)
+
+    gdf, fingerprint = router.get_region_with_fingerprint(TDX_HYDRO_REGION)
+
+    assert fingerprint == parquet_fingerprint(path)
+    assert router.get_region(TDX_HYDRO_REGION) is gdf
+    assert router.cache_stats["hits"] == 1
+
+
+def rewrite_region(directory, n_basins: int) -> None:
+    """Rewrite the region's file, with a later mtime even on coarse clocks"""
+    path = region_parquet_path(directory, TDX_HYDRO_REGION)
+    stat = os.stat(path)
+    write_region(directory, n_basins)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_region_is_reloaded_when_its_file_changes(tmp_path):
+    write_region(tmp_path, 3)
+    router = make_router(tmp_path, fingerprint_interval=0)
+    path = router.region_path(TDX_HYDRO_REGION)
+    old_gdf, old_fingerprint = router.get_region_with_fingerprint(TDX_HYDRO_REGION)
+
+    rewrite_region(tmp_path, 5)
+    gdf, fingerprint = router.get_region_with_fingerprint(TDX_HYDRO_REGION)
+
+    assert gdf is not old_gdf and len(gdf) == 5
+    assert fingerprint != old_fingerprint
+    assert fingerprint == parquet_fingerprint(path)
+    assert router.cached_regions == [TDX_HYDRO_REGION]
+
+
+def test_region_file_is_checked_once_per_interval(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(router_module.time, "monotonic", lambda: clock[0])
+    fingerprints = []
+    def counting_fingerprint(path):
+        fingerprints.append(path)
+        return parquet_fingerprint(path)
+    monkeypatch.setattr(router_module, "parquet_fingerprint", counting_fingerprint)
+    write_region(tmp_path, 3)
+    router = make_router(tmp_path, fingerprint_interval=10)
+    old_gdf = router.get_region(TDX_HYDRO_REGION)
+    assert len(fingerprints) == 1
+
+    # hits within the interval don't stat the file, nor see it change
+    rewrite_region(tmp_path, 5)
+    for _ in range(5):
+        clock[0] += 1
+        assert router.get_region(TDX_HYDRO_REGION) is old_gdf
+    assert len(fingerprints) == 1
+
+    clock[0] += 5
+    gdf = router.get_region(TDX_HYDRO_REGION)
+    assert gdf is not old_gdf and len(gdf) == 5
+    # the check, then the fingerprint of the reload
+    assert len(fingerprints) == 3
+    assert router.cache_stats["hits"] == 5
@@ -0,0 +1,35 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from global_hydrography.delineation.service import (
+    DelineationService,
+    UNMATCHED_ENDPOINT,
+    create_app,
+)
+
+from test_router import make_router, write_region
+
+
+def test_metrics_are_kept_by_route(tmp_path):
+    """Requests are counted under their route, and paths matching no route
+    share one endpoint, so metrics stay bounded"""
+    write_region(tmp_path, 3)
+    service = DelineationService(make_router(tmp_path))
+
+    async def requests() -> dict:
+        async with TestClient(TestServer(create_app(service))) as client:
+            for i in range(20):
+                await client.get(f"/no-such-path/{i}")
+            await client.get("/health")
+            await client.get("/health?verbose=1")
+            await client.post("/health")
+            response = await client.get("/metrics")
+            return await response.json()
+
+    metrics = asyncio.run(requests())
+
+    assert set(metrics["responses"]) == {"/health", UNMATCHED_ENDPOINT}
+    assert metrics["responses"]["/health"] == {"200": 2}
+    assert metrics["responses"][UNMATCHED_ENDPOINT] == {"404": 20, "405": 1}
+    assert set(metrics["latency"]) == set(metrics["responses"])
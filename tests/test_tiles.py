@@ -0,0 +1,78 @@
+import gzip
+import json
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pyogrio
+import pytest
+
+from global_hydrography.delineation.mnsi import LINK, DISSOLVE_LEVEL, DISSOLVE_ROOT_ID
+from global_hydrography.tiles import (
+    BASINS_LAYER, STREAMS_LAYER, STREAM_ORDER, ZoomBand, create_tiles,
+)
+
+# bands fine enough for the synthetic region, which is a few km across
+ZOOM_BANDS = (
+    ZoomBand(8, 9, min_stream_order=3, dissolve_level=2),
+    ZoomBand(10, 11, min_stream_order=2, dissolve_level=0),
+    ZoomBand(12, 13, min_stream_order=1, dissolve_level=None),
+)
+
+
+@pytest.fixture(scope="module")
+def region_tiles(processed_region, tmp_path_factory):
+    streams_gdf, basins_gdf, groups_gdf = processed_region
+    path = tmp_path_factory.mktemp("tiles") / "region.mbtiles"
+    return create_tiles(streams_gdf, basins_gdf, groups_gdf, path, ZOOM_BANDS)
+
+
+def decode_tile(data: bytes, tmp_path) -> dict:
+    """Features of each layer of a gzipped MVT tile, read by GDAL"""
+    tile_path = tmp_path / "tile.pbf"
+    tile_path.write_bytes(gzip.decompress(data))
+    return {
+        layer: pyogrio.read_dataframe(tile_path, layer=layer)
+        for layer, _ in pyogrio.list_layers(tile_path)
+    }
+
+
+def test_create_tiles_metadata(processed_region, region_tiles):
+    _, basins_gdf, _ = processed_region
+    with closing(sqlite3.connect(region_tiles)) as db:
+        metadata = dict(db.execute("SELECT name, value FROM metadata"))
+        zooms = [z for z, in db.execute("SELECT DISTINCT zoom_level FROM tiles")]
+
+    assert metadata["format"] == "pbf"
+    assert (metadata["minzoom"], metadata["maxzoom"]) == ("8", "13")
+    assert sorted(zooms) == list(range(8, 14))
+    bounds = [float(v) for v in metadata["bounds"].split(",")]
+    assert np.allclose(bounds, basins_gdf.total_bounds, atol=1e-7)
+    vector_layers = json.loads(metadata["json"])["vector_layers"]
+    assert sorted(layer["id"] for layer in vector_layers) == [BASINS_LAYER, STREAMS_LAYER]
+    for layer in vector_layers:
+        assert (layer["minzoom"], layer["maxzoom"]) == (8, 13)
+
+
+@pytest.mark.parametrize("band", ZOOM_BANDS)
+def test_merged_tiles_have_both_layers(processed_region, region_tiles, band, tmp_path):
+    """At each band's coarsest zoom the synthetic region is in one tile, which
+    holds the band's streams and basins as two layers of the merged tile"""
+    streams_gdf, basins_gdf, groups_gdf = processed_region
+    with closing(sqlite3.connect(region_tiles)) as db:
+        data, = db.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? "
+            "ORDER BY length(tile_data) DESC LIMIT 1", (band.min_zoom,),
+        ).fetchone()
+
+    layers = decode_tile(data, tmp_path)
+
+    assert sorted(layers) == [BASINS_LAYER, STREAMS_LAYER]
+    streams = streams_gdf.index[streams_gdf[STREAM_ORDER] >= band.min_stream_order]
+    assert sorted(layers[STREAMS_LAYER][LINK]) == sorted(streams)
+    if band.dissolve_level is None:
+        basins = basins_gdf.index
+    else:
+        groups = groups_gdf.loc[groups_gdf[DISSOLVE_LEVEL] == band.dissolve_level]
+        basins = groups[DISSOLVE_ROOT_ID]
+    assert sorted(layers[BASINS_LAYER][LINK]) == sorted(basins)